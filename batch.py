@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Copy one face onto many saves at once. The source save is only parsed once,
+and the targets are handled in parallel by a pool of processes. A target
+that fails doesn't stop the others.
+"""
+
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import os
+import traceback
+
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from common import FaceTransferException, GameError
+import extract
+from facetransfer import apply_face
+from preset import load_face
+import tracing
+
+
+class BatchResult(NamedTuple):
+    fname: str
+    # None if the transfer worked
+    error: Optional[str]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+# The face every worker process applies, set once when the worker starts
+# instead of being sent along with every target
+_face = None # type: Dict[str, Any]
+
+
+def _init_worker(face: Dict[str, Any]) -> None:
+    global _face
+    _face = face
+
+
+def _apply(face: Dict[str, Any], targetfname: str,
+           compression: extract.CompressionStrategy) -> BatchResult:
+    try:
+        apply_face(face, targetfname, compression)
+    except (FaceTransferException, GameError, OSError) as e:
+        return BatchResult(targetfname, str(e))
+    except Exception as e:
+        # Anything else is a bug, so keep the traceback around
+        traceback.print_exc()
+        return BatchResult(targetfname, '{}: {}'.format(type(e).__name__, e))
+    return BatchResult(targetfname, None)
+
+
+def _apply_in_worker(targetfname: str,
+                     compression: extract.CompressionStrategy) -> BatchResult:
+    return _apply(_face, targetfname, compression)
+
+
+def transfer_face_batch(sourcefname: str, targetfnames: List[str],
+                        workers: int = None,
+                        compression: extract.CompressionStrategy = None,
+                        callback: Callable[[BatchResult], None] = None
+                        ) -> List[BatchResult]:
+    """
+    Copy the face of the source (a save or a preset) to every target save,
+    in place (see facetransfer.apply_face). Return one result per target, in the same
+    order as targetfnames (without duplicates, since two processes writing
+    the same file would be a mess). Names that lead to the same file, like
+    a relative and an absolute path or a symlink, count as duplicates, and
+    only the first of them is used. callback, if given, is called with
+    every result as soon as it's done.
+
+    workers is the number of processes to use (by default one per CPU).
+    With workers=1 everything is done in this process.
+    """
+    face = load_face(sourcefname)
+    # The real path of every target, with the name it was first given as
+    targets = {} # type: Dict[str, str]
+    for fname in targetfnames:
+        targets.setdefault(os.path.realpath(fname), fname)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(targets)))
+    results = {} # type: Dict[str, BatchResult]
+    if workers == 1:
+        for path, fname in targets.items():
+            results[path] = _apply(face, fname, compression)
+            if callback is not None:
+                callback(results[path])
+    else:
+        with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                 initargs=(face,)) as pool:
+            futures = {pool.submit(_apply_in_worker, fname, compression): path
+                       for path, fname in targets.items()}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    # A worker died, which takes every target it hadn't
+                    # finished down with it
+                    result = BatchResult(targets[path], 'A worker process died')
+                except Exception as e:
+                    traceback.print_exc()
+                    result = BatchResult(targets[path], '{}: {}'.format(type(e).__name__, e))
+                results[path] = result
+                if callback is not None:
+                    callback(result)
+    return [results[path] for path in targets]
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Copy the face of one save '
+                                                 'to a lot of other saves')
+    parser.add_argument('source', help='a save or a face preset')
+    parser.add_argument('targets', nargs='+')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='how many processes to use (default: one per CPU)')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='save a Chrome trace of the run (only this process '
+                             'is traced, so use -j 1 to see everything)')
+    args = parser.parse_args()
+    if args.trace:
+        tracing.enable()
+
+    def report(result: BatchResult) -> None:
+        if result.ok:
+            print('OK      {}'.format(result.fname))
+        else:
+            print('FAILED  {}: {}'.format(result.fname, result.error))
+
+    try:
+        results = transfer_face_batch(args.source, args.targets,
+                                      args.workers, callback=report)
+    except (FaceTransferException, GameError) as e:
+        sys.exit('Can\'t read the source save: {}'.format(e))
+    if args.trace:
+        tracing.write_chrome_trace(args.trace)
+        print(tracing.format_summary())
+    failed = sum(not r.ok for r in results)
+    print('{} of {} transfers done'.format(len(results) - failed, len(results)))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the parsing, merging and encoding stages and for a whole
+transfer, run on the saves in testdata/test_extract_data, any other save
+directories given and synthetic Fallout 4 saves (see gensave, a 10 MB one
+unless other sizes are asked for). The bundled saves are all from Skyrim,
+so the Fallout 4-only benchmarks only run on the synthetic ones. Every
+result has the best and median time, the throughput in MB/s and the peak
+memory (from tracemalloc, in a separate run so it doesn't slow down the
+timed ones).
+
+Results are saved as JSON, and a stored result file can be used as a
+baseline to flag anything that got slower or hungrier.
+"""
+
+from datetime import datetime
+import gc
+import json
+import os
+import os.path
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from changeforms import ChangeFormIndex
+import extract
+import facetransfer
+from formidarray import FormIDArray
+import gensave
+import undo
+
+
+BUNDLEDDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'testdata', 'test_extract_data')
+SAVEEXTENSIONS = ('.ess', '.fos')
+# How much worse than the baseline something has to be to be a regression
+THRESHOLD = 0.15
+# The size in MB of the save that is generated if no sizes are given
+DEFAULTGENERATE = 10.0
+# The seed of the generated save transfer_face takes the face from
+SOURCESEED = 1000
+
+# A benchmark takes the save's path and contents and a temporary directory
+# to use, and returns the function to time and the number of bytes it
+# processes, or None if it doesn't apply to the save
+Benchmark = Callable[[str, bytes, str], Optional[Tuple[Callable[[], Any], int]]]
+
+
+def find_saves(directories: Iterable[str]) -> List[str]:
+    out = []
+    for directory in directories:
+        out.extend(sorted(os.path.join(directory, fname) for fname in os.listdir(directory)
+                          if os.path.splitext(fname)[1].lower() in SAVEEXTENSIONS))
+    return out
+
+
+def generate_saves(directory: str, sizes: Iterable[float]) -> List[str]:
+    """ Generate a Fallout 4 save of every size (in MB) in the directory. """
+    out = []
+    for n, size in enumerate(sizes):
+        fname = os.path.join(directory, 'synthetic-{}MB.fos'.format(size))
+        with open(fname, 'wb') as f:
+            gensave.write_save(f, gensave.spec_for_size(int(size * 1e6), seed=n))
+        out.append(fname)
+    return out
+
+
+def _parsed(rawdata: bytes) -> Tuple[str, Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+    game, data = extract.parse_savedata(rawdata)
+    cfdata = extract.parse_changeforms(data['changeforms'])
+    player = extract.parse_player(cfdata['playerdata'],
+                                  cfdata['playerchangeflags'], game)
+    return game, data, cfdata, player
+
+
+def bench_parse_savedata(fname, rawdata, tempdir):
+    return (lambda: extract.parse_savedata(rawdata)), len(rawdata)
+
+
+def bench_parse_changeforms(fname, rawdata, tempdir):
+    _, data = extract.parse_savedata(rawdata)
+    changeforms = data['changeforms']
+    return (lambda: extract.parse_changeforms(changeforms)), len(changeforms)
+
+
+def bench_parse_player(fname, rawdata, tempdir):
+    game, _, cfdata, _ = _parsed(rawdata)
+    playerdata, flags = cfdata['playerdata'], cfdata['playerchangeflags']
+    return (lambda: extract.parse_player(playerdata, flags, game)), len(playerdata)
+
+
+def bench_merge_player(fname, rawdata, tempdir):
+    game, _, cfdata, player = _parsed(rawdata)
+    if game != 'fallout4':
+        return None
+    flags = cfdata['playerchangeflags']
+    return (lambda: extract.merge_player(player, flags, player, flags, game)), \
+        len(cfdata['playerdata'])
+
+
+def bench_encode_player(fname, rawdata, tempdir):
+    game, _, cfdata, player = _parsed(rawdata)
+    return (lambda: extract.encode_player(player, game)), len(cfdata['playerdata'])
+
+
+def bench_encode_changeforms(fname, rawdata, tempdir):
+    _, data, cfdata, _ = _parsed(rawdata)
+    # Force a recompression, like after a real merge
+    cfdata['playerdata'] = bytes(cfdata['playerdata'])
+    cfdata.pop('playeroriginaldata', None)
+    return (lambda: extract.encode_changeforms(cfdata)), len(data['changeforms'])
+
+
+def bench_encode_savedata(fname, rawdata, tempdir):
+    _, data = extract.parse_savedata(rawdata)
+    return (lambda: extract.encode_savedata(data)), len(rawdata)
+
+
+def bench_resolve_refids(fname, rawdata, tempdir):
+    _, data = extract.parse_savedata(rawdata)
+    refids = ChangeFormIndex.build(data['changeforms'], data['changeformcount']).refids
+    formids = FormIDArray(data['formidarray'])
+    return (lambda: formids.resolve_refids(refids)), len(refids) * 3
+
+
+def bench_transfer_face(fname, rawdata, tempdir):
+    # Skyrim faces can't be merged
+    if not rawdata.startswith(b'FO4_SAVEGAME'):
+        return None
+    # A face from another save, or the transfer wouldn't change anything
+    source = os.path.join(tempdir, 'source.fos')
+    with open(source, 'wb') as f:
+        gensave.write_save(f, gensave.SaveSpec(seed=SOURCESEED))
+    target = os.path.join(tempdir, 'target' + os.path.splitext(fname)[1])
+
+    def transfer():
+        # The save has to be copied every time, so that's included
+        shutil.copyfile(fname, target)
+        facetransfer.transfer_face(source, target)
+        os.remove(undo.journal_path(target))
+    return transfer, len(rawdata)
+
+
+benchmarks = [
+    ('parse_savedata', bench_parse_savedata),
+    ('parse_changeforms', bench_parse_changeforms),
+    ('parse_player', bench_parse_player),
+    ('merge_player', bench_merge_player),
+    ('encode_player', bench_encode_player),
+    ('encode_changeforms', bench_encode_changeforms),
+    ('encode_savedata', bench_encode_savedata),
+    ('resolve_refids', bench_resolve_refids),
+    ('transfer_face', bench_transfer_face),
+] # type: List[Tuple[str, Benchmark]]
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Tuple[List[float], int]:
+    """ Return the time of every run and the peak memory of one more. """
+    times = []
+    gcenabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    finally:
+        if gcenabled:
+            gc.enable()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+def run(saves: List[str], repeat: int = 5, only: List[str] = None,
+        report: Callable[[Dict[str, Any]], None] = None) -> Dict[str, Any]:
+    """
+    Run the benchmarks (all of them, or the ones named in only) on every
+    save and return the results, ready to be saved as JSON. report, if
+    given, is called with every result as it's done.
+    """
+    results = []
+    for fname in saves:
+        with open(fname, 'rb') as f:
+            rawdata = f.read()
+        for name, benchmark in benchmarks:
+            if only and name not in only:
+                continue
+            with tempfile.TemporaryDirectory() as tempdir:
+                result = _run_one(name, benchmark, fname, rawdata, tempdir, repeat)
+            if result is None:
+                continue
+            results.append(result)
+            if report is not None:
+                report(result)
+    return {'meta': {'time': datetime.now().isoformat(timespec='seconds'),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'repeat': repeat},
+            'results': results}
+
+
+def _run_one(name: str, benchmark: Benchmark, fname: str, rawdata: bytes,
+             tempdir: str, repeat: int) -> Optional[Dict[str, Any]]:
+    prepared = benchmark(fname, rawdata, tempdir)
+    if prepared is None:
+        return None
+    func, nbytes = prepared
+    times, peak = measure(func, repeat)
+    best = min(times)
+    return {'benchmark': name, 'save': os.path.basename(fname),
+            'bytes': nbytes, 'best': best,
+            'median': statistics.median(times),
+            'mbps': nbytes / best / 1e6 if best else None,
+            'peakmemory': peak}
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any],
+            threshold: float = THRESHOLD) -> List[str]:
+    """
+    Return a description of every result that is more than threshold (as
+    a fraction) slower or uses more memory than the same benchmark on the
+    same save in the baseline.
+    """
+    old = {(r['benchmark'], r['save']): r for r in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        key = (result['benchmark'], result['save'])
+        if key not in old:
+            continue
+        for field, unit, scale in (('best', 'ms', 1000), ('peakmemory', 'KiB', 1 / 1024)):
+            before, now = old[key][field], result[field]
+            if before and now > before * (1 + threshold):
+                regressions.append('{} on {}: {} {:.2f} -> {:.2f} {} (+{:.0%})'.format(
+                    key[0], key[1], field, before * scale, now * scale, unit,
+                    now / before - 1))
+    return regressions
+
+
+def format_result(result: Dict[str, Any]) -> str:
+    return '{:<20} {:<50.50} {:>9.3f} ms {:>9.1f} MB/s {:>9.0f} KiB'.format(
+        result['benchmark'], result['save'], result['best'] * 1000,
+        result['mbps'] or 0, result['peakmemory'] / 1024)
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Benchmark the save file code')
+    parser.add_argument('directories', nargs='*',
+                        help='more directories with saves to run on')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='how many times to time everything (default: %(default)s)')
+    parser.add_argument('-b', '--benchmark', action='append', dest='only',
+                        choices=[name for name, _ in benchmarks],
+                        help='only run this benchmark (can be given more than once)')
+    parser.add_argument('-g', '--generate', type=float, action='append',
+                        metavar='MB', help='also run on a generated Fallout 4 save '
+                                           'of about this size (can be given more than '
+                                           'once, 0 for none, default: {})'
+                                           .format(DEFAULTGENERATE))
+    parser.add_argument('-o', '--output', help='save the results as JSON to this file')
+    parser.add_argument('-c', '--compare', metavar='BASELINE',
+                        help='compare with earlier results and fail on regressions')
+    parser.add_argument('-t', '--threshold', type=float, default=THRESHOLD,
+                        help='how much worse counts as a regression (default: %(default)s)')
+    args = parser.parse_args()
+    sizes = [DEFAULTGENERATE] if args.generate is None else args.generate
+    with tempfile.TemporaryDirectory() as gendir:
+        saves = find_saves([BUNDLEDDIR] + args.directories) \
+            + generate_saves(gendir, [size for size in sizes if size > 0])
+        results = run(saves, args.repeat, args.only,
+                      report=lambda result: print(format_result(result)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+        print('No regressions')
@@ -0,0 +1,201 @@
+"""
+Find out what a save's changeforms table is made of: how many records of
+every form type there are, how much space they take, how well they
+compress and which records are the biggest.
+
+Everything is worked out from a ChangeFormIndex, so the table is only
+gone through once. With NumPy the totals are done on the whole columns at
+a time (see ChangeFormIndex.table), otherwise with plain loops over the
+index arrays. Both give the exact same results.
+"""
+
+import heapq
+
+from typing import Dict, List, NamedTuple, Optional
+
+from changeforms import ChangeFormIndex, ChangeFormRecord
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# The percentiles of the record sizes that are reported, in percent
+PERCENTILES = (50, 90, 99)
+# How many of the biggest records are reported
+TOP = 20
+
+# The changeform types, from UESP's description of Skyrim saves. Fallout 4
+# uses other numbers, so its types are only shown as numbers.
+cftypenames = {
+    'skyrim': [
+        'REFR', 'ACHR', 'PMIS', 'PGRE', 'PBEA', 'PFLA', 'CELL', 'INFO',
+        'QUST', 'NPC_', 'ACTI', 'TACT', 'ARMO', 'BOOK', 'CONT', 'DOOR',
+        'INGR', 'LIGH', 'MISC', 'APPA', 'STAT', 'MSTT', 'FURN', 'WEAP',
+        'AMMO', 'KEYM', 'ALCH', 'IDLM', 'NOTE', 'ECZN', 'CLAS', 'FACT',
+        'PACK', 'NAVM', 'WOOP', 'MGEF', 'SMQN', 'SCEN', 'LCTN', 'RELA',
+        'PHZD', 'PBAR', 'PCON', 'FLST', 'LVLN', 'LVLI', 'LVSP', 'PARW',
+        'ENCH',
+    ],
+} # type: Dict[str, List[str]]
+
+
+class TypeStats(NamedTuple):
+    cftype: int
+    count: int
+    # The size of the records in the table, headers included
+    size: int
+    # The size of their data once decompressed
+    datasize: int
+    # How many of them are compressed, and the compressed and uncompressed
+    # size of those
+    compressed: int
+    compressedlength: int
+    uncompressedlength: int
+    # The record size at every percentile in PERCENTILES
+    percentiles: List[int]
+    largest: int
+
+    @property
+    def ratio(self) -> Optional[float]:
+        """ How well the compressed records compress, if there are any. """
+        return _ratio(self.uncompressedlength, self.compressedlength)
+
+
+class BloatReport(NamedTuple):
+    game: Optional[str]
+    count: int
+    size: int
+    datasize: int
+    compressed: int
+    compressedlength: int
+    uncompressedlength: int
+    # Biggest first
+    types: List[TypeStats]
+    biggest: List[ChangeFormRecord]
+
+    @property
+    def ratio(self) -> Optional[float]:
+        return _ratio(self.uncompressedlength, self.compressedlength)
+
+
+def cftype_name(cftype: int, game: str = None) -> str:
+    names = cftypenames.get(game, [])
+    if cftype < len(names):
+        return '{} ({})'.format(names[cftype], cftype)
+    return str(cftype)
+
+
+def _percentile(sortedsizes, start: int, count: int, percent: int) -> int:
+    """ The nearest-rank percentile of sortedsizes[start:start+count]. """
+    return int(sortedsizes[start + max(0, (percent * count + 99) // 100 - 1)])
+
+
+def _ratio(uncompressed: int, compressed: int) -> Optional[float]:
+    return uncompressed / compressed if compressed else None
+
+
+def bloat_report(index: ChangeFormIndex, game: str = None,
+                 top: int = TOP) -> BloatReport:
+    """
+    Return the totals and size percentiles per form type and the top
+    biggest records of the indexed table.
+    """
+    if numpy is not None:
+        types, biggest = _numpy_stats(index, top)
+    else:
+        types, biggest = _python_stats(index, top)
+    types.sort(key=lambda t: (-t.size, t.cftype))
+    return BloatReport(
+        game, len(index), sum(t.size for t in types),
+        sum(t.datasize for t in types), sum(t.compressed for t in types),
+        sum(t.compressedlength for t in types),
+        sum(t.uncompressedlength for t in types),
+        types, [index.record(row) for row in biggest])
+
+
+def _numpy_stats(index: ChangeFormIndex, top: int):
+    table = index.table()
+    cftypes = table['cftype']
+    reallengths = table['reallength'].astype(numpy.int64)
+    uncompressed = table['uncompressedlength'].astype(numpy.int64)
+    sizes = table['dataoffset'].astype(numpy.int64) - table['offset'] + reallengths
+    iscompressed = uncompressed > 0
+    datasizes = numpy.where(iscompressed, uncompressed, reallengths)
+    # Sorted by type and then size, so every type is one run, in size order
+    order = numpy.lexsort((sizes, cftypes))
+    sortedsizes = sizes[order]
+    present, starts, counts = numpy.unique(cftypes[order], return_index=True,
+                                           return_counts=True)
+
+    def totals(values):
+        return numpy.add.reduceat(values[order], starts) if len(order) else []
+    sizetotals = totals(sizes)
+    datatotals = totals(datasizes)
+    compressedcounts = totals(iscompressed.astype(numpy.int64))
+    compressedlengths = totals(numpy.where(iscompressed, reallengths, 0))
+    uncompressedlengths = totals(uncompressed)
+    types = []
+    for n, cftype in enumerate(present):
+        start, count = int(starts[n]), int(counts[n])
+        types.append(TypeStats(
+            int(cftype), count, int(sizetotals[n]), int(datatotals[n]),
+            int(compressedcounts[n]), int(compressedlengths[n]),
+            int(uncompressedlengths[n]),
+            [_percentile(sortedsizes, start, count, p) for p in PERCENTILES],
+            int(sortedsizes[start + count - 1])))
+    # Biggest first, and in file order when they're the same size
+    biggest = numpy.lexsort((numpy.arange(len(sizes)), -sizes))[:top]
+    return types, [int(row) for row in biggest]
+
+
+def _python_stats(index: ChangeFormIndex, top: int):
+    sizes = [dataoffset - offset + reallength for offset, dataoffset, reallength
+             in zip(index.offsets, index.dataoffsets, index.reallengths)]
+    bytype = {} # type: Dict[int, List[int]]
+    for row, cftype in enumerate(index.cftypes):
+        bytype.setdefault(cftype, []).append(row)
+    types = []
+    for cftype, rows in sorted(bytype.items()):
+        sortedsizes = sorted(sizes[row] for row in rows)
+        compressed = [row for row in rows if index.uncompressedlengths[row]]
+        count = len(rows)
+        types.append(TypeStats(
+            cftype, count, sum(sortedsizes),
+            sum(index.uncompressedlengths[row] or index.reallengths[row]
+                for row in rows),
+            len(compressed), sum(index.reallengths[row] for row in compressed),
+            sum(index.uncompressedlengths[row] for row in compressed),
+            [_percentile(sortedsizes, 0, count, p) for p in PERCENTILES],
+            sortedsizes[-1]))
+    biggest = heapq.nsmallest(top, range(len(sizes)), key=lambda row: (-sizes[row], row))
+    return types, biggest
+
+
+def format_bloat_report(report: BloatReport, name: str = '') -> str:
+    lines = ['{}{} changeforms, {:.1f} KiB ({:.1f} KiB decompressed, '
+             '{} compressed{})'.format(
+                 name + ': ' if name else '', report.count, report.size / 1024,
+                 report.datasize / 1024, report.compressed,
+                 ', {:.2f}x'.format(report.ratio) if report.ratio else ''),
+             '',
+             '{:<12} {:>7} {:>10} {:>6} {:>8} {}  {:>9} {:>6}'.format(
+                 'type', 'count', 'KiB', 'share', 'mean',
+                 ' '.join('{:>7}'.format('p{}'.format(p)) for p in PERCENTILES),
+                 'max', 'ratio')]
+    for t in report.types:
+        lines.append('{:<12} {:>7} {:>10.1f} {:>6.1%} {:>8.0f} {}  {:>9} {:>6}'.format(
+            cftype_name(t.cftype, report.game), t.count, t.size / 1024,
+            t.size / report.size, t.size / t.count,
+            ' '.join('{:>7}'.format(size) for size in t.percentiles),
+            t.largest, '{:.2f}x'.format(t.ratio) if t.ratio else '-'))
+    lines.extend(['', 'Biggest records:',
+                  '{:<8} {:<12} {:>10} {:>12} {:>10}'.format(
+                      'refid', 'type', 'bytes', 'decompressed', 'offset')])
+    for record in report.biggest:
+        lines.append('{:06x}   {:<12} {:>10} {:>12} {:>10}'.format(
+            record.refid, cftype_name(record.cftype, report.game),
+            record.dataoffset - record.offset + record.reallength,
+            record.uncompressedlength or record.reallength, record.offset))
+    return '\n'.join(lines)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+A catalog of all saves in a directory, kept in an SQLite database. Only the
+headers (the same fields the GUI shows) and the file stats are stored.
+Rescanning only reads the saves that are new or have a different size or
+mtime since the last scan, so after the first scan listing and filtering
+even a huge save directory is just a database query.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import os.path
+import sqlite3
+import struct
+
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+from common import GameError
+import extract
+
+
+SAVEEXTENSIONS = ('.ess', '.fos')
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS saves (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    game TEXT,
+    savenumber INTEGER,
+    name TEXT,
+    level INTEGER,
+    location TEXT,
+    race TEXT,
+    gender INTEGER,
+    playingtime TEXT,
+    -- Why the header couldn't be read, if it couldn't
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS saves_directory ON saves (directory);
+'''
+
+_columns = ('path', 'directory', 'size', 'mtime', 'game', 'savenumber',
+            'name', 'level', 'location', 'race', 'gender', 'playingtime',
+            'error')
+
+
+class CatalogEntry(NamedTuple):
+    path: str
+    directory: str
+    size: int
+    mtime: int
+    game: Optional[str]
+    savenumber: Optional[int]
+    name: Optional[str]
+    level: Optional[int]
+    location: Optional[str]
+    race: Optional[str]
+    gender: Optional[int]
+    playingtime: Optional[str]
+    error: Optional[str]
+
+
+class ScanResult(NamedTuple):
+    added: int
+    updated: int
+    removed: int
+    unchanged: int
+
+
+def read_entry(path: str, size: int, mtime: int) -> CatalogEntry:
+    """ Read the header of a save and return its catalog entry. """
+    directory = os.path.dirname(path)
+    try:
+        with open(path, 'rb') as f:
+            game, header = extract.parse_header(f, screenshot=False)
+    except (GameError, OSError, UnicodeDecodeError, IndexError, struct.error) as e:
+        return CatalogEntry(path, directory, size, mtime, *[None] * 8, str(e))
+    return CatalogEntry(path, directory, size, mtime, game,
+                        header['savenumber'], header['playername'],
+                        header['playerlevel'], header['playerlocation'],
+                        header['playerraceeditorid'], header['playersex'],
+                        header['gamedate'], None)
+
+
+def _read_entries(files: List[Tuple[str, int, int]]) -> List[CatalogEntry]:
+    return [read_entry(*f) for f in files]
+
+
+class SaveCatalog:
+    """
+    The catalog database. Use it as a context manager or call close() when
+    done.
+    """
+    def __init__(self, dbpath: str) -> None:
+        self.dbpath = dbpath
+        self.db = sqlite3.connect(dbpath)
+        self.db.executescript(_schema)
+
+    def __enter__(self) -> 'SaveCatalog':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def scan(self, directory: str, workers: int = None,
+             chunksize: int = 32) -> ScanResult:
+        """
+        Bring the catalog up to date with the saves in the directory (not
+        its subdirectories). Only saves that are new or changed are read.
+
+        The headers are read by workers processes (by default one per CPU),
+        chunksize saves at a time. With workers=1 everything is done in
+        this process.
+        """
+        directory = os.path.abspath(directory)
+        known = {path: (size, mtime) for path, size, mtime in self.db.execute(
+            'SELECT path, size, mtime FROM saves WHERE directory = ?', (directory,))}
+        tofetch = []
+        unchanged = 0
+        found = set()
+        with os.scandir(directory) as it:
+            for dirent in it:
+                if not dirent.is_file() \
+                        or os.path.splitext(dirent.name)[1].lower() not in SAVEEXTENSIONS:
+                    continue
+                stat = dirent.stat()
+                found.add(dirent.path)
+                if known.get(dirent.path) == (stat.st_size, stat.st_mtime_ns):
+                    unchanged += 1
+                else:
+                    tofetch.append((dirent.path, stat.st_size, stat.st_mtime_ns))
+        entries = self._read_all(tofetch, workers, chunksize)
+        removed = [(path,) for path in known if path not in found]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO saves VALUES ({})'
+                                .format(', '.join('?' * len(_columns))), entries)
+            self.db.executemany('DELETE FROM saves WHERE path = ?', removed)
+        added = sum(e.path not in known for e in entries)
+        return ScanResult(added, len(entries) - added, len(removed), unchanged)
+
+    @staticmethod
+    def _read_all(files: List[Tuple[str, int, int]], workers: Optional[int],
+                  chunksize: int) -> List[CatalogEntry]:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        chunks = [files[n:n+chunksize] for n in range(0, len(files), chunksize)]
+        workers = min(workers, len(chunks))
+        if workers <= 1:
+            return _read_entries(files)
+        with ProcessPoolExecutor(workers) as pool:
+            return [e for chunk in pool.map(_read_entries, chunks) for e in chunk]
+
+    def find(self, directory: str = None, orderby: str = 'mtime',
+             descending: bool = True, **filters: Any) -> List[CatalogEntry]:
+        """
+        Return the catalog entries matching all filters (column=value, like
+        game='fallout4' or gender=1), sorted by a column. name, location
+        and race match case-insensitive substrings. Saves that couldn't be
+        read are only included if error=True is given.
+        """
+        if orderby not in _columns:
+            raise ValueError('Unknown column: {}'.format(orderby))
+        where = []
+        args = [] # type: List[Any]
+        if directory is not None:
+            where.append('directory = ?')
+            args.append(os.path.abspath(directory))
+        if not filters.pop('error', False):
+            where.append('error IS NULL')
+        for key, value in filters.items():
+            if key not in _columns:
+                raise ValueError('Unknown column: {}'.format(key))
+            if key in ('name', 'location', 'race'):
+                where.append('{} LIKE ?'.format(key))
+                args.append('%{}%'.format(value))
+            else:
+                where.append('{} = ?'.format(key))
+                args.append(value)
+        query = 'SELECT * FROM saves'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY {} {}'.format(orderby, 'DESC' if descending else 'ASC')
+        return [CatalogEntry(*row) for row in self.db.execute(query, args)]
+
+    def get(self, path: str) -> Optional[CatalogEntry]:
+        row = self.db.execute('SELECT * FROM saves WHERE path = ?',
+                              (os.path.abspath(path),)).fetchone()
+        return None if row is None else CatalogEntry(*row)
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def default_dbpath() -> str:
+    return os.path.join(os.path.expanduser('~'), '.facetransfer-catalog.sqlite')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Scan and list save directories')
+    parser.add_argument('directory')
+    parser.add_argument('--db', default=default_dbpath(),
+                        help='the catalog database (default: %(default)s)')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='how many processes to scan with (default: one per CPU)')
+    parser.add_argument('--name', help='only list saves with this in the name')
+    parser.add_argument('--race', help='only list saves with this race')
+    args = parser.parse_args()
+    with SaveCatalog(args.db) as catalog:
+        result = catalog.scan(args.directory, args.workers)
+        print('{0.added} new, {0.updated} changed, {0.removed} removed, '
+              '{0.unchanged} unchanged'.format(result))
+        filters = {k: v for k, v in (('name', args.name), ('race', args.race)) if v}
+        for entry in catalog.find(args.directory, **filters):
+            print('{0.savenumber:>5} {0.name:<20} {0.level:>3} {0.race:<15} '
+                  '{0.location}'.format(entry))
@@ -0,0 +1,393 @@
+"""
+Tools for working with all of the records in a changeforms table, and not
+just the player's, without going through the table more than once.
+"""
+
+from array import array
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import zlib
+
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Set
+
+from common import GameError
+import extract
+import tracing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+ChangeFormRecord = namedtuple('ChangeFormRecord', [
+    'refid', 'changeflags', 'cftype', 'version', 'reallength',
+    'uncompressedlength', 'offset', 'dataoffset'
+])
+ChangeFormRecord.__doc__ = """
+The header of one changeform record. changeflags is the raw uint32 and
+refid is an int (see extract.default_refid). offset is where the record
+starts in the changeforms table and dataoffset is where its data starts.
+An uncompressedlength of 0 means the data isn't compressed.
+"""
+
+# Called with the refid, change flags (raw uint32) and type of a record
+Predicate = Callable[[int, int, int], bool]
+# Called with the refid and the compressed data, see parse_changeforms
+Decompressor = Callable[[int, bytes], bytes]
+
+
+class ChangeForm:
+    """
+    One changeform record: its header (all fields of ChangeFormRecord can be
+    used as attributes) and its data, which is only decompressed the first
+    time it's used.
+    """
+    __slots__ = ('record', 'rawbody', '_decompress', '_data')
+
+    def __init__(self, record: ChangeFormRecord, rawdata: bytes,
+                 decompress: Decompressor = None) -> None:
+        """ rawdata is the whole changeforms table the record is from. """
+        self.record = record
+        self.rawbody = rawdata[record.dataoffset:record.dataoffset+record.reallength]
+        self._decompress = decompress
+        self._data = None # type: bytes
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.record, name)
+
+    def __repr__(self) -> str:
+        return '<ChangeForm {:06x} type {} at {}>'.format(
+            self.record.refid, self.record.cftype, self.record.offset)
+
+    @property
+    def flags(self) -> Set[int]:
+        """ The change flags as a set, like extract.flags returns them. """
+        return extract.flagset(self.record.changeflags)
+
+    @property
+    def data(self) -> bytes:
+        """ The (decompressed if needed) data of the record. """
+        if self._data is None:
+            if not self.record.uncompressedlength:
+                self._data = bytes(self.rawbody)
+            elif self._decompress is not None:
+                self._data = self._decompress(self.record.refid, self.rawbody)
+            else:
+                self._data = zlib.decompress(self.rawbody)
+        return self._data
+
+
+def _matcher(refids: Iterable[int] = None, predicate: Predicate = None) -> Predicate:
+    """ Combine a set of refids and a predicate into one predicate. """
+    if refids is not None:
+        refids = frozenset(refids)
+    if refids is not None and predicate is not None:
+        return lambda refid, changeflags, cftype: \
+            refid in refids and predicate(refid, changeflags, cftype)
+    if refids is not None:
+        return lambda refid, changeflags, cftype: refid in refids
+    if predicate is not None:
+        return predicate
+    return lambda refid, changeflags, cftype: True
+
+
+def find_changeforms(rawdata: bytes, refids: Iterable[int] = None,
+                     predicate: Predicate = None, count: int = None,
+                     decompress: Decompressor = None) -> List[ChangeForm]:
+    """
+    Go through the changeforms table once and return every record whose
+    refid is in refids and/or that predicate returns True for, in file
+    order. Nothing is decompressed until a record's data is used.
+
+    If only refids is given, the scan stops as soon as all of them are
+    found. Use ChangeFormIndex.select instead if there already is an index.
+    """
+    match = _matcher(refids, predicate)
+    remaining = set(refids) if refids is not None and predicate is None else None
+    header = extract.changeformheader
+    end = len(rawdata)
+    if count is None:
+        count = end
+    out = []
+    i = 0
+    row = 0
+    while i < end and row < count:
+        headerlength, (refid, changeflags, cftype, version, reallength,
+                       uncompressedlength) = header(i, rawdata)
+        if match(refid, changeflags, cftype):
+            record = ChangeFormRecord(refid, changeflags, cftype, version,
+                                      reallength, uncompressedlength, i,
+                                      i + headerlength)
+            out.append(ChangeForm(record, rawdata, decompress))
+            if remaining is not None:
+                remaining.discard(refid)
+                if not remaining:
+                    break
+        i += headerlength + reallength
+        row += 1
+    if i > end:
+        raise GameError('The changeforms table is truncated')
+    return out
+
+
+class ChangeFormIndex:
+    """
+    An index of every record in a changeforms table, built in one pass.
+
+    The headers are kept in one array per field, and a refid can be looked
+    up in constant time. When a refid is in the table more than once, the
+    first record is the one that's found.
+    """
+    _columns = ('refids', 'changeflags', 'cftypes', 'versions', 'reallengths',
+                'uncompressedlengths', 'offsets', 'dataoffsets')
+
+    def __init__(self) -> None:
+        self.refids = array('I')
+        self.changeflags = array('I')
+        self.cftypes = array('B')
+        self.versions = array('B')
+        self.reallengths = array('I')
+        self.uncompressedlengths = array('I')
+        self.offsets = array('I')
+        self.dataoffsets = array('I')
+        # Built on the first lookup
+        self._rows = None # type: Dict[int, int]
+
+    @classmethod
+    @tracing.traced('build_cfindex')
+    def build(cls, rawdata: bytes, count: int = None) -> 'ChangeFormIndex':
+        """
+        Index the changeforms table in rawdata. If count (the save's
+        changeformcount) is given, stop after that many records.
+        """
+        index = cls()
+        refids, changeflags = index.refids, index.changeflags
+        cftypes, versions = index.cftypes, index.versions
+        reallengths = index.reallengths
+        uncompressedlengths = index.uncompressedlengths
+        offsets, dataoffsets = index.offsets, index.dataoffsets
+        header = extract.changeformheader
+        end = len(rawdata)
+        if count is None:
+            count = end
+        i = 0
+        row = 0
+        while i < end and row < count:
+            headerlength, (refid, flags, cftype, version, reallength,
+                           uncompressedlength) = header(i, rawdata)
+            refids.append(refid)
+            changeflags.append(flags)
+            cftypes.append(cftype)
+            versions.append(version)
+            reallengths.append(reallength)
+            uncompressedlengths.append(uncompressedlength)
+            offsets.append(i)
+            dataoffsets.append(i + headerlength)
+            i += headerlength + reallength
+            row += 1
+        if i > end:
+            raise GameError('The changeforms table is truncated')
+        return index
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __contains__(self, refid: int) -> bool:
+        return refid in self.rows
+
+    @property
+    def rows(self) -> Dict[int, int]:
+        """ A dict with the row of every refid. """
+        if self._rows is None:
+            # Go backwards so that the first of any duplicates wins
+            n = len(self.refids)
+            self._rows = dict(zip(reversed(self.refids), range(n-1, -1, -1)))
+        return self._rows
+
+    def __iter__(self) -> Iterator[ChangeFormRecord]:
+        return (self.record(row) for row in range(len(self)))
+
+    def row_of(self, refid: int) -> int:
+        """ Return the row of the record with the refid. """
+        try:
+            return self.rows[refid]
+        except KeyError:
+            raise GameError('No changeform with refid {:06x} found'.format(refid)) from None
+
+    def offset_of(self, refid: int) -> int:
+        """ Return where the record with the refid starts in the table. """
+        return self.offsets[self.row_of(refid)]
+
+    def record(self, row: int) -> ChangeFormRecord:
+        return ChangeFormRecord(
+            self.refids[row], self.changeflags[row], self.cftypes[row],
+            self.versions[row], self.reallengths[row],
+            self.uncompressedlengths[row], self.offsets[row],
+            self.dataoffsets[row]
+        )
+
+    def find(self, refid: int) -> ChangeFormRecord:
+        """ Return the record header with the refid. """
+        return self.record(self.row_of(refid))
+
+    def select(self, rawdata: bytes, refids: Iterable[int] = None,
+               predicate: Predicate = None,
+               decompress: Decompressor = None) -> List[ChangeForm]:
+        """
+        Same as find_changeforms, but with the index instead of a scan.
+        rawdata has to be the table the index was built from.
+        """
+        if refids is not None and predicate is None:
+            rows = sorted({self.rows[r] for r in refids if r in self.rows})
+        else:
+            match = _matcher(refids, predicate)
+            rows = [row for row, (refid, changeflags, cftype)
+                    in enumerate(zip(self.refids, self.changeflags, self.cftypes))
+                    if match(refid, changeflags, cftype)]
+        return [ChangeForm(self.record(row), rawdata, decompress) for row in rows]
+
+    def table(self):
+        """
+        Return the whole index as a NumPy structured array, with one row
+        per record and the fields of ChangeFormRecord as columns. This
+        needs NumPy, which is optional everywhere else.
+        """
+        if numpy is None:
+            raise ImportError('NumPy is needed for the changeform table')
+        table = numpy.empty(len(self), dtype=[
+            (field, numpy.dtype(column.typecode))
+            for field, column in zip(ChangeFormRecord._fields, self.columns())])
+        for field, column in zip(ChangeFormRecord._fields, self.columns()):
+            table[field] = numpy.asarray(column)
+        return table
+
+    def columns(self) -> List[array]:
+        """ Return all the column arrays, in the order of _columns. """
+        return [getattr(self, name) for name in self._columns]
+
+    def to_bytes(self) -> bytes:
+        """
+        Return the index as bytes that from_bytes can load. The arrays are
+        dumped as they are, so it only loads on a machine with the same
+        byte order and item sizes.
+        """
+        return b''.join(column.tobytes() for column in self.columns())
+
+    @classmethod
+    def from_bytes(cls, data: bytes, count: int) -> 'ChangeFormIndex':
+        """ Load an index of count records, dumped with to_bytes. """
+        index = cls()
+        i = 0
+        for column in index.columns():
+            size = count * column.itemsize
+            column.frombytes(data[i:i+size])
+            i += size
+        if i != len(data):
+            raise ValueError('Index data has the wrong size')
+        return index
+
+
+def _decompress_rows(rawdata: bytes, rows: Iterable[int],
+                     dataoffsets: array, reallengths: array,
+                     uncompressedlengths: array) -> List[bytes]:
+    out = []
+    for row in rows:
+        start = dataoffsets[row]
+        body = rawdata[start:start+reallengths[row]]
+        out.append(zlib.decompress(body) if uncompressedlengths[row] else bytes(body))
+    return out
+
+
+@tracing.traced('decompress_all')
+def decompress_all(rawdata: bytes, index: ChangeFormIndex, workers: int = None,
+                   batchsize: int = 256) -> List[bytes]:
+    """
+    Return the data of every record in the table, decompressed if needed,
+    in file order. The records are split into batches of batchsize and
+    decompressed on a pool of workers threads (zlib lets go of the GIL
+    while it works). workers defaults to the number of CPUs.
+
+    rawdata has to be the table the index was built from.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    columns = (index.dataoffsets, index.reallengths, index.uncompressedlengths)
+    batches = [range(start, min(start + batchsize, len(index)))
+               for start in range(0, len(index), batchsize)]
+    if workers <= 1 or len(batches) <= 1:
+        return _decompress_rows(rawdata, range(len(index)), *columns)
+    out = [] # type: List[bytes]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for bodies in pool.map(lambda rows: _decompress_rows(rawdata, rows, *columns),
+                               batches):
+            out.extend(bodies)
+    return out
+
+
+class BodyCache:
+    """
+    A least recently used cache of decompressed changeform bodies. It's
+    limited by the total size of the bodies it holds, not by their number.
+
+    The keys should be something like (save identity, refid), see
+    SaveFile.identity. It's safe to use from several threads.
+    """
+    def __init__(self, maxbytes: int = 64 * 1024 * 1024) -> None:
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._bodies = OrderedDict() # type: Dict[Hashable, bytes]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._bodies)
+
+    def __repr__(self) -> str:
+        return '<BodyCache {} bodies, {}/{} bytes, {} hits, {} misses>'.format(
+            len(self), self.size, self.maxbytes, self.hits, self.misses)
+
+    def get(self, key: Hashable, load: Callable[[], bytes]) -> bytes:
+        """
+        Return the body for key. If it isn't in the cache, call load to get
+        it and add it to the cache.
+        """
+        with self._lock:
+            body = self._bodies.get(key)
+            if body is not None:
+                self._bodies.move_to_end(key)
+                self.hits += 1
+                return body
+            self.misses += 1
+        # Decompress outside the lock so other threads aren't held up
+        body = load()
+        if len(body) > self.maxbytes:
+            return body
+        with self._lock:
+            if key not in self._bodies:
+                self._bodies[key] = body
+                self.size += len(body)
+            while self.size > self.maxbytes:
+                _, oldbody = self._bodies.popitem(last=False)
+                self.size -= len(oldbody)
+        return body
+
+    def clear(self) -> None:
+        """ Empty the cache and reset the counters. """
+        with self._lock:
+            self._bodies.clear()
+            self.size = self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """ Return the number of hits and misses and the current size. """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'bodies': len(self._bodies), 'size': self.size,
+                    'maxbytes': self.maxbytes}
+
+
+# The cache shared by all SaveFiles
+bodycache = BodyCache()
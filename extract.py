@@ -3,14 +3,17 @@ This module contains all low-level game independant functions used to
 manipulate and extract data in save game files.
 """
 
-from collections import OrderedDict
+from collections import namedtuple, OrderedDict
+import io
+import os
 import struct
-import traceback
+import time
 import zlib
 
-from typing import Any, Dict, List, Set, Tuple
+from typing import Any, Dict, IO, List, Set, Tuple
 
 from common import GameError
+import tracing
 
 # ========= Encode/decode functions ==========================================
 
@@ -113,6 +116,42 @@ def flags(i: int, data: bytes) -> Set[int]:
 def encode_flags(flags: Set[int]) -> bytes:
     return encode_uint32(sum(pow(2, x) for x in flags))
 
+def flagset(value: int) -> Set[int]:
+    """ Same as flags, but for an already decoded uint32. """
+    return {n for n in range(32) if value >> n & 1}
+
+# refid (3 bytes, big-endian), change flags, type and version
+_changeformhead = struct.Struct('<3sIBB')
+_changeformlengths = [struct.Struct('<BB'), struct.Struct('<HH'),
+                      struct.Struct('<II')]
+
+def changeformheader(i: int, data: bytes) -> Tuple[int, Tuple[int, int, int, int, int, int]]:
+    """
+    Decode the header of the changeform record starting at i. Return the
+    header's length and a tuple with the refid (as an int), the raw change
+    flags, the type (without the length size bits), the version, the real
+    length and the uncompressed length (0 if not compressed).
+
+    The record's data starts right after the header and is
+    real length bytes long.
+    """
+    refid, changeflags, cftype, version = _changeformhead.unpack_from(data, i)
+    sizeflag = cftype >> 6
+    if sizeflag == 3:
+        raise GameError('Invalid changeform length size at offset {}'.format(i))
+    lengths = _changeformlengths[sizeflag]
+    reallength, uncompressedlength = lengths.unpack_from(data, i + 9)
+    return 9 + lengths.size, (int.from_bytes(refid, 'big'), changeflags,
+                              cftype & 63, version, reallength,
+                              uncompressedlength)
+
+def default_refid(refidnr: int) -> int:
+    """
+    Return the refid (as an int) of a form from the main game ESM, like the
+    player (7).
+    """
+    return 0x400000 | refidnr
+
 # ========= Main functions ===================================================
 
 mainlayout = [
@@ -164,6 +203,11 @@ mainlayout = [
     (bytes_, 'unknown3table', {'length': 'unknown3tablesize'})
 ]
 
+magiclengths = {args['game']: args['length']
+                for func, key, args in mainlayout if key == 'magic'}
+shotcolorlengths = {args['game']: args['colorlength']
+                    for func, key, args in mainlayout if key == 'screenshotdata'}
+
 skyrimplayerlayout = [
     # Flag 1
     (bytes_, 'actorbasedata', {'length': 24, 'flag': 1}),
@@ -238,6 +282,227 @@ fallout4playerlayout = [
     (float32, 'bodysliderlarge', {'flag': 14})
 ]
 
+# ========= Compiled layouts =================================================
+
+# Typefuncs that always take up the same number of bytes, and the struct
+# format they map to. float32 is kept as raw bytes, same as the typefunc.
+_fixedformats = {uint8: 'B', uint16: 'H', uint32: 'I', float32: '4s'}
+# Typefuncs that are just a slice of the data when given a constant length
+_slicefuncs = {bytes_: ('length', 'chunksize', 1),
+               refids: ('num', None, 3),
+               formids: ('num', None, 4)}
+# Typefuncs that return slices of the data, which is all they do
+_bulkfuncs = {bytes_, refids, formids, screenshot}
+
+
+def _encoder(typefunc):
+    return globals()['encode_' + typefunc.__name__.rstrip('_')]
+
+
+class _FixedRun:
+    """
+    A run of consecutive fixed-width fields that are read and written with
+    one single struct call.
+    """
+    __slots__ = ('keys', 'offsets', 'struct', 'size', 'flag', 'ispresent',
+                 'bulk')
+
+    def __init__(self, flag, ispresent):
+        self.keys = []  # type: List[str]
+        # Where each key starts, relative to the start of the run
+        self.offsets = []  # type: List[int]
+        self.bulk = 0
+        self.struct = None  # type: struct.Struct
+        self.size = 0
+        self.flag = flag
+        self.ispresent = ispresent
+
+    def decode(self, i: int, rawdata: bytes, data: Dict[str, Any]) -> int:
+        data.update(zip(self.keys, self.struct.unpack_from(rawdata, i)))
+        return i + self.size
+
+    def encode(self, data: Dict[str, Any]) -> bytes:
+        return self.struct.pack(*[data[k] for k in self.keys])
+
+
+class _Field:
+    """
+    A single variable-width field, decoded with its typefunc.
+    """
+    __slots__ = ('keys', 'offsets', 'typefunc', 'encoder', 'args', 'varargs',
+                 'flag', 'ispresent', 'bulk')
+
+    def __init__(self, typefunc, key, args, varargs, flag, ispresent):
+        self.keys = [key]
+        self.offsets = [0]
+        self.typefunc = typefunc
+        self.encoder = _encoder(typefunc)
+        self.args = args
+        self.varargs = varargs
+        self.flag = flag
+        self.ispresent = ispresent
+        # Bulk fields are plain slices of the data and can be memoryviews
+        self.bulk = int(typefunc in _bulkfuncs)
+
+    def decode(self, i: int, rawdata: bytes, data: Dict[str, Any]) -> int:
+        if self.varargs:
+            args = dict(self.args)
+            for argname, key in self.varargs:
+                args[argname] = data[key]
+            offset, data[self.keys[0]] = self.typefunc(i, rawdata, **args)
+        else:
+            offset, data[self.keys[0]] = self.typefunc(i, rawdata, **self.args)
+        return i + offset
+
+    def encode(self, data: Dict[str, Any]) -> bytes:
+        return self.encoder(data[self.keys[0]])
+
+
+class LayoutPlan:
+    """
+    A layout (like mainlayout) compiled for one game, so that decoding and
+    encoding doesn't have to interpret the layout list on every call.
+
+    Don't create these directly, use compile_layout so they get reused.
+    """
+    def __init__(self, layout, game: str) -> None:
+        self.game = game
+        self.steps = []  # type: List[Any]
+        self.encoders = {}  # type: Dict[str, Any]
+        self._flagsteps = {}  # type: Dict[frozenset, List[Any]]
+        run = None
+        for typefunc, key, rawargs in layout:
+            # Skip game-specific lines for the wrong game
+            if rawargs.get('game', game) != game:
+                continue
+            self.encoders[key] = _encoder(typefunc)
+            flag = rawargs.get('flag')
+            ispresent = rawargs.get('ispresent')
+            args = {k: v for k, v in rawargs.items()
+                    if k not in ('game', 'flag', 'ispresent')}
+            fmt = self._fixedformat(typefunc, args)
+            if fmt is None:
+                run = None
+                varargs = [(k, v) for k, v in args.items() if isinstance(v, str)]
+                constargs = {k: v for k, v in args.items() if not isinstance(v, str)}
+                self.steps.append(_Field(typefunc, key, constargs, varargs,
+                                         flag, ispresent))
+                continue
+            if run is None or run.flag != flag or run.ispresent != ispresent:
+                run = _FixedRun(flag, ispresent)
+                self.steps.append(run)
+            run.keys.append(key)
+            run.offsets.append(run.size)
+            run.struct = struct.Struct(
+                (run.struct.format if run.struct else '<') + fmt)
+            run.size = run.struct.size
+
+    @staticmethod
+    def _fixedformat(typefunc, args):
+        """ Return the struct format of a field, or None if it has none. """
+        if typefunc in _fixedformats and not args:
+            return _fixedformats[typefunc]
+        if typefunc in _slicefuncs:
+            lengtharg, chunkarg, unitsize = _slicefuncs[typefunc]
+            length = args.get(lengtharg)
+            chunksize = args.get(chunkarg, 1) if chunkarg else unitsize
+            if set(args) - {lengtharg, chunkarg} or not isinstance(length, int) \
+                    or not isinstance(chunksize, int):
+                return None
+            return '{}s'.format(length * chunksize)
+        return None
+
+    def steps_for(self, flags=None) -> List[Any]:
+        """
+        Return the steps that are active for the given changeflags. If flags
+        is None, all steps are active.
+        """
+        if flags is None:
+            return self.steps
+        key = frozenset(flags)
+        steps = self._flagsteps.get(key)
+        if steps is None:
+            steps = [s for s in self.steps if s.flag is None or s.flag in key]
+            self._flagsteps[key] = steps
+        return steps
+
+    def decode(self, rawdata: bytes, flags=None, i: int = 0,
+               zerocopy: bool = False, until: str = None) -> Tuple[int, Dict[str, Any]]:
+        """
+        Decode rawdata starting at offset i. Return the offset where the
+        decoding stopped and the decoded data.
+
+        If zerocopy is True, the bulk fields (bytes, formids, refids and the
+        screenshot) are memoryviews into rawdata instead of copies.
+
+        If until is a key, stop decoding after that key.
+        """
+        data = OrderedDict() # type: Dict[str, Any]
+        # Indexed with step.bulk, so bulk steps read from the view
+        buffers = (rawdata, memoryview(rawdata) if zerocopy else rawdata)
+        for step in self.steps_for(flags):
+            if step.ispresent is not None and not data[step.ispresent]:
+                continue
+            i = step.decode(i, buffers[step.bulk], data)
+            if until in data:
+                break
+        return i, data
+
+    def encode(self, data: Dict[str, Any]) -> bytes:
+        """
+        Encode a data dict back into bytes. The fused struct calls are only
+        used if the dict has its keys in the layout's order, otherwise every
+        value is encoded on its own, in the dict's order.
+        """
+        return b''.join(self.encode_segments(data))
+
+    def encode_segments(self, data: Dict[str, Any]) -> List[bytes]:
+        """
+        Same as encode but return the list of encoded chunks without joining
+        them. Bulk values are passed through as they are, and a value that
+        is itself a list of segments is spliced into the list.
+        """
+        chunks = []
+        keys = []  # type: List[str]
+        try:
+            for step in self.steps:
+                if step.keys[0] in data:
+                    chunks.append(step.encode(data))
+                    keys.extend(step.keys)
+        except (KeyError, struct.error):
+            keys = []
+        if keys != list(data):
+            encoders = self.encoders
+            chunks = [encoders[key](value) for key, value in data.items()]
+        segments = []  # type: List[bytes]
+        for chunk in chunks:
+            if isinstance(chunk, list):
+                segments.extend(chunk)
+            else:
+                segments.append(chunk)
+        return segments
+
+
+_plans = {} # type: Dict[Tuple[int, str], Tuple[Any, LayoutPlan]]
+
+def compile_layout(layout, game: str) -> LayoutPlan:
+    """
+    Return the compiled plan for the layout and game. Every (layout, game)
+    pair is only compiled once.
+    """
+    key = (id(layout), game)
+    cached = _plans.get(key)
+    # The layout is kept in the cache as well so the id stays valid
+    if cached is None or cached[0] is not layout:
+        cached = (layout, LayoutPlan(layout, game))
+        _plans[key] = cached
+    return cached[1]
+
+
+playerlayouts = {'skyrim': skyrimplayerlayout,
+                 'fallout4': fallout4playerlayout}
+
+@tracing.traced('merge_player')
 def merge_player(sourcedata, sourceflags, targetdata, targetflags, game):
     """
     Take the facial data from the sourcedata and apply it onto the targetdata.
@@ -278,26 +543,9 @@ def parse_player(rawdata: bytes, flags: List[int], game: str):
     In goes some bytes and out comes a nice dict you can do shit with.
     The flags should be in the format you get from parse_changeforms.
     """
-    if game == 'skyrim':
-        layout = skyrimplayerlayout
-    elif game == 'fallout4':
-        layout = fallout4playerlayout
-    data = OrderedDict() # type: Dict[str, Any]
-    i = 0
-    for typefunc, key, rawargs in layout:
-        # Skip flag-specific lines if the flag isn't active
-        if 'flag' in rawargs and rawargs['flag'] not in flags:
-            continue
-        if 'ispresent' in rawargs and data[rawargs['ispresent']] == False:
-            continue
-        args = {k: data[v] if isinstance(v, str) else v
-                for k,v in rawargs.items() if k not in ('flag', 'ispresent')}
-        try:
-            offset, data[key] = typefunc(i, rawdata, **args)
-        except Exception as e:
-            print('ERROR IN KEY:', key)
-            raise
-        i += offset
+    plan = compile_layout(playerlayouts[game], game)
+    with tracing.span('parse_player', len(rawdata)):
+        i, data = plan.decode(rawdata, flags)
     # Make sure nothing is dropped
     assert i == len(rawdata)
     return data
@@ -308,63 +556,132 @@ def encode_player(data: Dict[str, Any], game: str):
     In goes a nice player dict and out goes a nice array of bytes ready to be
     dumped in an unsuspecting changeform dict. Woo.
     """
-    if game == 'skyrim':
-        layout = skyrimplayerlayout
-    elif game == 'fallout4':
-        layout = fallout4playerlayout
-    rawdata = bytes()
-    def encodefunc(f):
-        return globals()['encode_' + f.__name__.rstrip('_')]
-    funcs = {name:encodefunc(func) for func, name, args in layout}
-    for key, value in data.items():
-        rawvalue = funcs[key](value)
-        rawdata += rawvalue
+    with tracing.span('encode_player') as span:
+        rawdata = compile_layout(playerlayouts[game], game).encode(data)
+        span.add_bytes(len(rawdata))
     return rawdata
 
 
-def parse_changeforms(rawdata: bytes, refidnr=7):
+@tracing.traced('parse_changeforms')
+def parse_changeforms(rawdata: bytes, refidnr=7, zerocopy=False, index=None,
+                      decompress=None):
     """
     Convert the changeforms table to a useful dict with the different parts of
     the player's changeform and the preceding and succeeding bytes.
 
     The dict it returns is ready to be passed to encode_changeforms to convert
     it back to bytes.
+
+    If zerocopy is True (or rawdata already is a memoryview), the head and
+    tail will be memoryviews into rawdata instead of copies.
+
+    If index is a changeforms.ChangeFormIndex of rawdata, it's used to find
+    the changeform instead of going through the table.
+
+    decompress, if given, is called with the refid (as an int) and the
+    compressed data instead of zlib.decompress, e.g. to use a cache.
     """
-    def uint(b, sizeflag):
-        return struct.unpack(['B', 'H', 'I'][sizeflag], b)[0]
-    i = 0
-    cfstart = 0
+    if zerocopy:
+        rawdata = memoryview(rawdata)
+    refid = default_refid(refidnr)
+    if index is not None:
+        cfstart = index.offset_of(refid)
+    else:
+        # Go through the changeforms until the player is found
+        cfstart = i = 0
+        while True:
+            if i >= len(rawdata):
+                raise GameError('No changeform with refid {:06x} found'.format(refid))
+            headerlength, header = changeformheader(i, rawdata)
+            if header[0] == refid:
+                cfstart = i
+                break
+            i += headerlength + header[4]
+    headerlength, header = changeformheader(cfstart, rawdata)
+    _, changeflags, cftype, version, reallength, uncompressedlength = header
+    i = cfstart + headerlength + reallength
+    if i > len(rawdata):
+        raise GameError('The changeform with refid {:06x} is truncated'.format(refid))
     data = OrderedDict() # type: Dict[str, Any]
-    # Go through the changeforms until the player is found
-    while True:
-        cfstart = i
-        refid = rawdata[i:i+3]
-        changeflags = flags(i+3, rawdata)
-        _, cftype = uint8(i+7, rawdata)
-        _, version = uint8(i+8, rawdata)
-        i += 9
-        lnsize = [1,2,4][cftype >> 6]
-        reallength = uint(rawdata[i:i+lnsize], cftype >> 6)
-        uncompressedlength = uint(rawdata[i+lnsize:i+lnsize*2], cftype >> 6)
-        i += lnsize * 2 + reallength
-        # This is the players refid
-        if refid == bytes([64,0,refidnr]):
-            data['changeformshead'] = rawdata[:cfstart]
-            data['playerrefid'] = refid
-            data['playerchangeflags'] = changeflags
-            data['playercftype'] = cftype & 63
-            data['playerversion'] = version
-            data['playerreallength'] = reallength
-            data['playeruncompressedlength'] = uncompressedlength
-            if uncompressedlength:
-                data['playerdata'] = zlib.decompress(rawdata[i-reallength:i])
-            else:
-                data['playerdata'] = rawdata[i-reallength:i]
-            data['changeformstail'] = rawdata[i:]
-            return data
+    data['changeformshead'] = rawdata[:cfstart]
+    data['playerrefid'] = refid.to_bytes(3, 'big')
+    data['playerchangeflags'] = flagset(changeflags)
+    data['playercftype'] = cftype
+    data['playerversion'] = version
+    data['playerreallength'] = reallength
+    data['playeruncompressedlength'] = uncompressedlength
+    if not uncompressedlength:
+        data['playerdata'] = bytes(rawdata[i-reallength:i])
+    elif decompress is not None:
+        with tracing.span('inflate', reallength):
+            data['playerdata'] = decompress(refid, rawdata[i-reallength:i])
+    else:
+        with tracing.span('inflate', reallength):
+            data['playerdata'] = zlib.decompress(rawdata[i-reallength:i])
+    if uncompressedlength:
+        # Kept so that unchanged data doesn't have to be compressed again
+        data['playeroriginaldata'] = data['playerdata']
+        data['playercompresseddata'] = rawdata[i-reallength:i]
+    data['changeformstail'] = rawdata[i:]
+    return data
+
+
+class CompressionStat(namedtuple('CompressionStat', [
+        'refid', 'seconds', 'rawsize', 'compressedsize', 'passthrough'])):
+    """ How long one record took to compress, and how well it went. """
+    __slots__ = ()
 
+    @property
+    def ratio(self) -> float:
+        """ The compressed size as a fraction of the uncompressed size. """
+        return self.compressedsize / self.rawsize if self.rawsize else 1.0
 
-def encode_changeforms(data: Dict[str, Any]) -> bytes:
+
+class CompressionStrategy:
+    """
+    Decides how changeform data is compressed when it's encoded.
+
+    With passthrough on, data that is unchanged since it was parsed isn't
+    compressed again; the original compressed bytes are reused as they are.
+    Otherwise it's compressed with zlib using the given level (0-9, or -1
+    for zlib's default) and strategy (like zlib.Z_FILTERED).
+
+    The time, sizes and ratio of every compressed record end up in stats.
+    """
+    def __init__(self, level: int = zlib.Z_DEFAULT_COMPRESSION,
+                 strategy: int = zlib.Z_DEFAULT_STRATEGY,
+                 passthrough: bool = True) -> None:
+        self.level = level
+        self.strategy = strategy
+        self.passthrough = passthrough
+        self.stats = [] # type: List[CompressionStat]
+
+    def compress(self, data: bytes, refid: int = None, original: bytes = None,
+                 originalcompressed: bytes = None) -> bytes:
+        """
+        Return data compressed. original and originalcompressed are the
+        record's data as it was parsed, before and after decompression.
+        """
+        start = time.perf_counter()
+        passthrough = self.passthrough and originalcompressed is not None \
+                and original is not None \
+                and (data is original or data == original)
+        if passthrough:
+            compressed = originalcompressed
+        else:
+            with tracing.span('compress', len(data), level=self.level):
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                              zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                              self.strategy)
+                compressed = compressor.compress(data) + compressor.flush()
+        self.stats.append(CompressionStat(refid, time.perf_counter() - start,
+                                          len(data), len(compressed),
+                                          passthrough))
+        return compressed
+
+
+def encode_changeforms(data: Dict[str, Any],
+                       compression: CompressionStrategy = None) -> bytes:
     """
     Convert the dict with data from the changeform struct back into a byte
     object, ready to be inserted into the main save data dict.
@@ -373,9 +690,28 @@ def encode_changeforms(data: Dict[str, Any]) -> bytes:
     parts in it so the playeruncompressedlength and playerreallength should
     not be modified outside of this function.
     """
+    return b''.join(encode_changeforms_segments(data, compression))
+
+
+@tracing.traced('encode_changeforms')
+def encode_changeforms_segments(data: Dict[str, Any],
+                                compression: CompressionStrategy = None) -> List[bytes]:
+    """
+    Same as encode_changeforms but return a list of segments instead of
+    joining them. The head and tail are passed through untouched, and the
+    list can be put straight into the main save data dict.
+
+    compression decides how the data is compressed. By default unchanged
+    data keeps its original compressed bytes, and changed data is compressed
+    with zlib's default settings.
+    """
+    if compression is None:
+        compression = CompressionStrategy()
     # Only compress the data if the data was compressed before
     if data['playeruncompressedlength']:
-        playerdata = zlib.compress(data['playerdata'])
+        playerdata = compression.compress(
+            data['playerdata'], int.from_bytes(data['playerrefid'], 'big'),
+            data.get('playeroriginaldata'), data.get('playercompresseddata'))
         uncompressedlength = len(data['playerdata'])
     else:
         playerdata = data['playerdata']
@@ -384,7 +720,7 @@ def encode_changeforms(data: Dict[str, Any]) -> bytes:
     cftype = data['playercftype']
     # Fix the whole thing with variable uint sizes for the data lengths
     if reallength > 0xffff or uncompressedlength > 0xffff:
-        cftype |= 192
+        cftype |= 128
         reallength = encode_uint32(reallength)
         uncompressedlength = encode_uint32(uncompressedlength)
     elif reallength > 0xff or uncompressedlength > 0xff:
@@ -395,43 +731,71 @@ def encode_changeforms(data: Dict[str, Any]) -> bytes:
         reallength = encode_uint8(reallength)
         uncompressedlength = encode_uint8(uncompressedlength)
     # Build the actual bytechunk
-    rawdata = data['changeformshead'] + data['playerrefid']
-    rawdata += encode_flags(data['playerchangeflags'])
-    rawdata += encode_uint8(cftype)
-    rawdata += encode_uint8(data['playerversion'])
-    rawdata += reallength + uncompressedlength + playerdata
-    rawdata += data['changeformstail']
-    return rawdata
+    return [data['changeformshead'],
+            b''.join([data['playerrefid'],
+                      encode_flags(data['playerchangeflags']),
+                      encode_uint8(cftype), encode_uint8(data['playerversion']),
+                      reallength, uncompressedlength]),
+            playerdata,
+            data['changeformstail']]
+
 
+@tracing.traced('parse_header')
+def parse_header(f: IO[bytes], screenshot: bool = True) -> Tuple[str, Dict[str, Any]]:
+    """
+    Read and decode only the start of an open save file, up to and
+    including the screenshot. Nothing after the screenshot is read.
+    If screenshot is False, stop right before the screenshot data.
 
-def parse_savedata(rawdata: bytes) -> Tuple[str, Dict[str, Any]]:
+    The dict has the same keys as the start of the one from parse_savedata.
+    """
+    rawdata = f.read(17)
+    if rawdata[:13] == b'TESV_SAVEGAME':
+        game = 'skyrim'
+    elif rawdata[:12] == b'FO4_SAVEGAME':
+        game = 'fallout4'
+    else:
+        raise GameError('Game not recognized. Magic is "{}"'.format(rawdata[:12].decode()))
+    # The header size includes the screenshot's width and height
+    magiclength = magiclengths[game]
+    _, headersize = uint32(magiclength, rawdata)
+    headerend = magiclength + 4 + headersize
+    rawdata += f.read(headerend - len(rawdata))
+    if len(rawdata) < headerend:
+        raise GameError('The file is too short to be a save file')
+    if not screenshot:
+        i, data = compile_layout(mainlayout, game).decode(rawdata, until='shotheight')
+        assert i == headerend
+        return game, data
+    shotwidth, shotheight = struct.unpack('<II', rawdata[headerend-8:headerend])
+    shotend = headerend + shotwidth * shotheight * shotcolorlengths[game]
+    rawdata += f.read(shotend - headerend)
+    if len(rawdata) < shotend:
+        raise GameError('The file is too short to be a save file')
+    i, data = compile_layout(mainlayout, game).decode(rawdata, until='screenshotdata')
+    assert i == shotend
+    return game, data
+
+def parse_savedata(rawdata: bytes, zerocopy=False) -> Tuple[str, Dict[str, Any]]:
     """
     Convert the entirety of a save file (as a bytes object) into an ordered
     dict with all the data from the save file in a more accessible format.
 
     The dict is also ready to be passed to encode_savedata to be converted
     back to a save file.
+
+    If zerocopy is True, the screenshot, the data tables and the other bulk
+    fields are memoryviews into rawdata instead of copies. Keep rawdata
+    around (and unchanged) for as long as the dict is used.
     """
     if rawdata[:13] == b'TESV_SAVEGAME':
         game = 'skyrim'
     elif rawdata[:12] == b'FO4_SAVEGAME':
         game = 'fallout4'
     else:
-        raise GameError('Game not recognized. Magic is "{}"'.format(rawdata[:12].decode()))
-    data = OrderedDict() # type: Dict[str, Any]
-    i = 0
-    for typefunc, key, rawargs in mainlayout:
-        # Skip game-specific lines for the wrong game
-        if rawargs.get('game', game) != game:
-            continue
-        # All string args should be variable names and replaced by
-        # their values, and the key 'game' should be removed
-        # DO NOT EDIT THE FUCKING ARGS DICT DIRECTLY
-        # OR EVERYTHING WILL BLOW UP b/c fuck mutability
-        args = {k: data[v] if isinstance(v, str) else v
-                for k,v in rawargs.items() if k != 'game'}
-        offset, data[key] = typefunc(i, rawdata, **args)
-        i += offset
+        raise GameError('Game not recognized. Magic is "{}"'.format(bytes(rawdata[:12]).decode()))
+    with tracing.span('parse_savedata', len(rawdata)):
+        i, data = compile_layout(mainlayout, game).decode(rawdata, zerocopy=zerocopy)
     assert i == len(rawdata)
     return game, data
 
@@ -446,8 +810,9 @@ def update_savedata_offsets(data: Dict[str, Any]) -> None:
     """
     # changeForms
     oldcflength = data['globaldatatable3offset'] - data['changeformsoffset']
-    if len(data['changeforms']) != oldcflength:
-        cflengthdiff = len(data['changeforms']) - oldcflength
+    cflength = buffer_length(data['changeforms'])
+    if cflength != oldcflength:
+        cflengthdiff = cflength - oldcflength
         data['globaldatatable3offset'] += cflengthdiff
         data['formidarraycountoffset'] += cflengthdiff
         data['unknowntable3offset'] += cflengthdiff
@@ -461,6 +826,21 @@ def encode_savedata(data: Dict[str, Any]) -> bytes:
     offsets etc) and merge it into bytes ready to be written to the disc as a
     save file.
     """
+    return b''.join(encode_savedata_segments(data))
+
+
+@tracing.traced('encode_savedata')
+def encode_savedata_segments(data: Dict[str, Any]) -> List[bytes]:
+    """
+    Same as encode_savedata but return a list of buffer segments instead of
+    one big bytes object. The bulk fields are not copied, so if they are
+    memoryviews the segments point into the original save.
+
+    Any bulk field (like changeforms) may be a list of segments itself, such
+    as the one from encode_changeforms_segments.
+
+    Pass the list to write_segments to write it to a file.
+    """
     if data['magic'] == b'TESV_SAVEGAME':
         game = 'skyrim'
     elif data['magic'] == b'FO4_SAVEGAME':
@@ -468,12 +848,50 @@ def encode_savedata(data: Dict[str, Any]) -> bytes:
     else:
         raise GameError('Game not recognized. Magic is "{}"'.format(data['magic'].decode()))
     update_savedata_offsets(data)
-    rawdata = bytes()
-    def encodefunc(f):
-        return globals()['encode_' + f.__name__.rstrip('_')]
-    funcs = {name:encodefunc(func) for func, name, args in mainlayout
-             if args.get('game', game) == game}
-    for key, value in data.items():
-        rawvalue = funcs[key](value)
-        rawdata += rawvalue
-    return rawdata
+    return compile_layout(mainlayout, game).encode_segments(data)
+
+
+def buffer_length(data) -> int:
+    """ Return the length of a bytes-like object or a list of segments. """
+    if isinstance(data, list):
+        return sum(len(x) for x in data)
+    return len(data)
+
+
+# Don't give writev more buffers than the OS allows in one call
+try:
+    _iovmax = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _iovmax = 1024
+if _iovmax <= 0:
+    _iovmax = 1024
+
+@tracing.traced('write_segments')
+def write_segments(f: IO[bytes], segments: List[bytes]) -> int:
+    """
+    Write a list of segments to an open binary file without joining them
+    first. Use vectored writes if the OS has them and f is a real file.
+    Return the number of bytes written.
+    """
+    segments = [s for s in segments if len(s)]
+    total = sum(len(s) for s in segments)
+    try:
+        fd = f.fileno() if hasattr(os, 'writev') else None
+    except io.UnsupportedOperation:
+        # Like io.BytesIO
+        fd = None
+    if fd is None:
+        for segment in segments:
+            f.write(segment)
+        return total
+    f.flush()
+    i = 0
+    while i < len(segments):
+        written = os.writev(fd, segments[i:i+_iovmax])
+        # Skip whatever was written, and keep the rest of a partial segment
+        while i < len(segments) and written >= len(segments[i]):
+            written -= len(segments[i])
+            i += 1
+        if written:
+            segments[i] = memoryview(segments[i])[written:]
+    return total
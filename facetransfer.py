@@ -1,21 +1,39 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from os import rename
 import os.path
 import sys
-from tempfile import NamedTemporaryFile
+import threading
+import traceback
+from typing import Any, Callable, Dict, Optional, Tuple
 from tkinter import Menu, PhotoImage, StringVar, Tk
-from tkinter import TOP, RIGHT, BOTH, DISABLED, W, E, N, X, SUNKEN
-from tkinter.ttk import Button, Entry, Frame, Label, LabelFrame
+from tkinter import TOP, LEFT, RIGHT, BOTH, DISABLED, NORMAL, W, E, N, X, SUNKEN
+from tkinter.ttk import Button, Entry, Frame, Label, LabelFrame, Progressbar
 from tkinter.messagebox import showerror, showinfo
 from tkinter.filedialog import askopenfilename
 
-from common import GameError
+from common import FaceTransferException, GameError
 import extract
+import profiling
+from savefile import SaveFile
+import screenshot
+import tracing
+from splice import changeform_patches
+from undo import patch_save, UndoJournal
 
 version = '0.1'
 
+# Where to cache the changeform indexes of opened saves, if anywhere
+cachedir = os.environ.get('FACETRANSFER_CACHE_DIR') or None
+
+# Profiles every job the GUI runs, if FACETRANSFER_PROFILE is set (see
+# profiling.from_environment). Profiled jobs run one at a time.
+profiler = None # type: Optional[profiling.Profiler]
+
+# How often the GUI checks on its background jobs, in milliseconds
+POLLINTERVAL = 50
+
 
 def get_save_path():
     """ Get the path to the Skyrim savegame folder, using some windoze magic """
@@ -46,6 +64,40 @@ def format_playing_time(timestamp):
     return ' '.join(out)
 
 
+class Cancelled(Exception):
+    """ Raised inside a background job that has been cancelled. """
+
+
+class Job:
+    """
+    Something the GUI runs on a worker thread. The worker says what it's
+    doing with step(), which is also where it stops if the job has been
+    cancelled. Nothing in a job may touch any widgets.
+    """
+    def __init__(self, func: Callable[['Job'], Any]) -> None:
+        self.status = ''
+        self._cancelled = threading.Event()
+        self._func = func
+        self.future = None # type: Future
+
+    def run(self) -> Any:
+        self.step('Starting')
+        return self._func(self)
+
+    def step(self, status: str) -> None:
+        if self._cancelled.is_set():
+            raise Cancelled()
+        self.status = status
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        self.future.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+
 class MainWindow(Frame):
     def __init__(self, root):
         super().__init__(root)
@@ -59,8 +111,9 @@ class MainWindow(Frame):
         menubar = Menu(self)
         menu = Menu(menubar, tearoff=0)
         menu.add_command(label='About', command=self.show_about_dialog)
+        menu.add_command(label='Undo a transfer', command=self.undo_transfer)
         #menu.add_command(label='Visit Nexus page')
-        menu.add_command(label='Quit', command=lambda:root.destroy())
+        menu.add_command(label='Quit', command=self.quit_app)
         menubar.add_cascade(label='Menu', menu=menu)
         root.config(menu=menubar)
         # Source/target box
@@ -68,6 +121,15 @@ class MainWindow(Frame):
         self.screen = {}
         self.widgets = {}
         self.screenshot = {}
+        self.headers = {}
+        # The source's face, and the size and mtime of the source when it
+        # was read
+        self.face = None # type: Tuple[Tuple[int, int], Dict[str, Any]]
+        # Two workers, so the source and target can be loaded at once
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        # The running job of each slot (source, target or transfer) and
+        # what to call with its result
+        self.jobs = {} # type: Dict[str, Tuple[Job, Callable[[Any], None], str]]
         browsefuncs = {'source': self.source_browse, 'target': self.target_browse}
         for t in ('source', 'target'):
             self.field[t] = StringVar()
@@ -80,10 +142,24 @@ class MainWindow(Frame):
         self.btntransfer = Button(self, text='Transfer',
                                   command=self.execute_transfer)
         self.btntransfer.pack(side=RIGHT)
+        self.btncancel = Button(self, text='Cancel', command=self.cancel_jobs,
+                                state=DISABLED)
+        self.btncancel.pack(side=RIGHT)
+        self.progressbar = Progressbar(self, mode='indeterminate', length=80)
+        self.progressbar.pack(side=LEFT)
+        self.statusvar = StringVar()
+        Label(self, textvariable=self.statusvar).pack(side=LEFT, padx=4)
         # Warning labels
         self.warninglabelvar = StringVar()
         self.warninglabel = Label(root, textvariable=self.warninglabelvar)
         self.pack(fill=BOTH, expand=1, padx=8, pady=8)
+        root.protocol('WM_DELETE_WINDOW', self.quit_app)
+
+    def quit_app(self):
+        # Don't wait for anything but a transfer that's already writing
+        self.cancel_jobs()
+        self.executor.shutdown(wait=False)
+        self.master.destroy()
 
     def add_file_info_box(self, mainframe, name, labeldict, btncallback, fvar):
         """
@@ -121,6 +197,76 @@ class MainWindow(Frame):
                  'above.\n\nRunning on python version: {1}'
                  ''.format(version, python_version()))
 
+    def undo_transfer(self):
+        fname = askopenfilename(initialdir=self.savedir,
+                                filetypes=self.wildcard,
+                                title='Pick a save to undo the last transfer of')
+        if not fname:
+            return
+        try:
+            meta = UndoJournal(os.path.normpath(fname)).undo()
+        except FaceTransferException as e:
+            showerror('Error: can\'t undo', str(e))
+            return
+        showinfo('Done', 'The transfer from {} has been undone!'.format(meta['time']))
+
+    def start_job(self, slot: str, func: Callable[[Job], Any],
+                  callback: Callable[[Any], None], errortitle: str) -> None:
+        """
+        Run func(job) on a worker thread, replacing (and cancelling) the
+        job that is already running in the slot, if any. callback is called
+        with the result on the main thread.
+        """
+        if slot in self.jobs:
+            self.jobs[slot][0].cancel()
+        if profiler is not None:
+            func = profiler.wrap(slot, func)
+        job = Job(func)
+        job.future = self.executor.submit(job.run)
+        if not self.jobs:
+            self.after(POLLINTERVAL, self.poll_jobs)
+        self.jobs[slot] = (job, callback, errortitle)
+        self.update_progress()
+
+    def poll_jobs(self) -> None:
+        """ Hand the results of finished jobs to their callbacks. """
+        for slot, (job, callback, errortitle) in list(self.jobs.items()):
+            if not job.future.done():
+                continue
+            del self.jobs[slot]
+            if job.cancelled:
+                continue
+            try:
+                result = job.future.result()
+            except Cancelled:
+                continue
+            except (FaceTransferException, GameError, OSError) as e:
+                showerror(errortitle, str(e))
+                continue
+            except Exception:
+                traceback.print_exc()
+                showerror('Oops', 'Something went wrong! Look at the error log.')
+                continue
+            callback(result)
+        self.update_progress()
+        if self.jobs:
+            self.after(POLLINTERVAL, self.poll_jobs)
+
+    def update_progress(self) -> None:
+        if self.jobs:
+            self.statusvar.set(' / '.join(job.status for job, _, _ in self.jobs.values()))
+            self.progressbar.start()
+            self.btncancel.config(state=NORMAL)
+        else:
+            self.statusvar.set('')
+            self.progressbar.stop()
+            self.btncancel.config(state=DISABLED)
+        self.btntransfer.config(state=DISABLED if self.jobs else NORMAL)
+
+    def cancel_jobs(self) -> None:
+        for job, _, _ in self.jobs.values():
+            job.cancel()
+
     def source_browse(self):
         self.browse('source')
 
@@ -133,39 +279,31 @@ class MainWindow(Frame):
         if not fname:
             return
         fname = os.path.normpath(fname)
-        try:
-            info, game = get_ui_data(fname)
-        except GameError as e:
-            showerror('Error: format not recognized', str(e))
-            return
+        self.start_job(t, lambda job: load_save(job, fname, t == 'source'),
+                       lambda result: self.save_loaded(t, fname, *result),
+                       'Error: can\'t load the save')
+
+    def save_loaded(self, t, fname, game, header, thumbnail, face):
         if game != 'fallout4':
             showerror('Error: wrong game', 'The file doesn\'t seem to be a Fallout 4 save file.')
             return
+        other = {'source': 'target', 'target': 'source'}[t]
+        if other in self.headers:
+            headers = {t: (game, header), other: self.headers[other]}
+            try:
+                check_compatible(*headers['source'], *headers['target'])
+            except FaceTransferException as e:
+                showerror('Error: incompatible saves', str(e))
+                return
+        self.headers[t] = (game, header)
         self.field[t].set(fname)
-        for k,v in info.items():
-            if k == 'screenshot':
-                w, h, shotdata = v
-                if len(shotdata)/w/h == 4:
-                    shotdata = bytes([b for n,b in enumerate(shotdata) if (n+1)%4 != 0])
-                tfile = NamedTemporaryFile('wb', suffix='.ppm', delete=False)
-                if h == 384:
-                    rows = list(zip(*[iter(shotdata)]*w*3))
-                    tempshotdata = []
-                    for y in range(0, len(rows), 2):
-                        for x in range(0, len(rows[0]), 6):
-                            for n in [0,1,2]:
-                                newval = int((rows[y][x+n] + rows[y][x+n+3] + rows[y+1][x+n] + rows[y+1][x+n+3])/4)
-                                tempshotdata.append(newval)
-                    shotdata = bytes(tempshotdata)
-                    w, h = w//2, h//2
-                with tfile:
-                    tfile.write('P6\n{0} {1}\n255\n'.format(w,h).encode())
-                    tfile.write(shotdata)
-                img = PhotoImage(file=tfile.name)
-                os.remove(tfile.name) # Remove the tempfile
-                self.screenshot[t].config(image=img, relief=SUNKEN)
-                self.screenshot[t].image = img
-            elif k == 'playing time':
+        if t == 'source':
+            self.face = face
+        img = PhotoImage(data=thumbnail)
+        self.screenshot[t].config(image=img, relief=SUNKEN)
+        self.screenshot[t].image = img
+        for k,v in ui_data(header).items():
+            if k == 'playing time':
                 self.widgets[t][k].set(format_playing_time(v))
             elif k == 'gender':
                 self.widgets[t][k].set(['Male', 'Female'][v])
@@ -173,94 +311,183 @@ class MainWindow(Frame):
                 self.widgets[t][k].set(v)
 
     def execute_transfer(self):
-        if not self.field['target'].get() or not self.field['source'].get():
+        sourcefname = self.field['source'].get()
+        targetfname = self.field['target'].get()
+        if not targetfname or not sourcefname:
             showerror('Error: files missing', 'You have to pick a source and a target file.')
             return
-        if self.widgets['target']['gender'].get() != self.widgets['source']['gender'].get():
-            showerror('Error: different gender', 'Both saves must have the same player gender.')
-            return
-        if self.widgets['target']['race'].get() != self.widgets['source']['race'].get():
-            showerror('Error: different race', 'Both saves must have the same player race.')
-            return
-        success = transfer_face(self.field['source'].get(),
-                                             self.field['target'].get())
-        if success:
-            showinfo('Done', 'The face has been copied to the target file!')
-        else:
-            showerror('Oops', 'Something went wrong! Look at the error log.')
+        loaded = self.face
 
+        def transfer(job):
+            if loaded is not None and loaded[0] == file_stamp(sourcefname):
+                face = loaded[1]
+            else:
+                # The source has changed since it was loaded
+                job.step('Reading the face')
+                with SaveFile(sourcefname, cachedir) as source:
+                    face = extract_face(source)
+            apply_face(face, targetfname, checkpoint=job.step)
 
+        self.start_job('transfer', transfer,
+                       lambda result: showinfo('Done', 'The face has been copied '
+                                                       'to the target file!'),
+                       'Error: incompatible saves')
 
 
-def get_ui_data(fname):
+
+
+def file_stamp(fname: str) -> Tuple[int, int]:
+    """ Return the size and mtime of a file. """
+    stat = os.stat(fname)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def load_save(job: Job, fname: str, withface: bool = False):
     """
-    Return data useful for the UI to display, such as name, file info etc.
+    Read what the GUI shows about a save (and its face, if withface is
+    True) as a background job. Return the game, the header (without the
+    screenshot), the thumbnail and the file stamp with the face, or None.
+    """
+    job.step('Reading {}'.format(os.path.basename(fname)))
+    game, header = read_header(fname, screenshot=False)
+    face = None
+    if game == 'fallout4' and withface:
+        job.step('Reading the face')
+        stamp = file_stamp(fname)
+        with SaveFile(fname, cachedir) as save:
+            face = (stamp, extract_face(save))
+    job.step('Making the thumbnail')
+    return game, header, screenshot.thumbnail(fname), face
+
+
+def read_header(fname, screenshot=True):
+    """
+    Return the game and the header data (everything up to and including the
+    screenshot, unless screenshot is False) of a save file, without reading
+    the rest of it.
     """
     with open(fname, 'rb') as f:
-        rawdata = f.read()
-    game, data = extract.parse_savedata(rawdata)
+        return extract.parse_header(f, screenshot)
+
+
+def ui_data(header):
+    """
+    Return data useful for the UI to display, such as name, file info etc.
+    """
     out = {}
-    out['save number'] = data['savenumber']
-    out['name'] = data['playername']
-    out['level'] = data['playerlevel']
-    out['location'] = data['playerlocation']
-    out['race'] = data['playerraceeditorid']
-    out['gender'] = data['playersex']
-    out['playing time'] = data['gamedate']
-    out['screenshot'] = (data['shotwidth'], data['shotheight'], data['screenshotdata'])
-    return out, game
-
-
-def transfer_face(sourcefname: str, targetfname: str):
+    out['save number'] = header['savenumber']
+    out['name'] = header['playername']
+    out['level'] = header['playerlevel']
+    out['location'] = header['playerlocation']
+    out['race'] = header['playerraceeditorid']
+    out['gender'] = header['playersex']
+    out['playing time'] = header['gamedate']
+    if 'screenshotdata' in header:
+        out['screenshot'] = (header['shotwidth'], header['shotheight'],
+                             header['screenshotdata'])
+    return out
+
+
+def get_ui_data(fname):
     """
-    Copy facial data from one save file to another. This function should be
-    the main entry point for the UI.
+    Return data useful for the UI to display, such as name, file info etc.
+    """
+    game, header = read_header(fname)
+    return ui_data(header), game
+
+
+def check_compatible(sourcegame, sourcedata, targetgame, targetdata):
+    """
+    Raise a FaceTransferException if the face can't be copied from the
+    source to the target. Only the header fields are needed, so the data
+    can be from read_header as well as a full parse or a SaveFile.
     """
-    with open(sourcefname, 'rb') as f:
-        sourcerawdata = f.read()
-    with open(targetfname, 'rb') as f:
-        targetrawdata = f.read()
-    sourcegame, sourcedata = extract.parse_savedata(sourcerawdata)
-    targetgame, targetdata = extract.parse_savedata(targetrawdata)
     if sourcegame != targetgame:
-        raise Exception('Saves are not from the same game!')
+        raise FaceTransferException('Saves are not from the same game!')
     if sourcedata['playersex'] != targetdata['playersex']:
-        raise Exception('Characters must have the same gender!')
+        raise FaceTransferException('Characters must have the same gender!')
     if sourcedata['playerraceeditorid'] != targetdata['playerraceeditorid']:
-        raise Exception('Characters must be the same race!')
-    # Get the player data from the source save
-    sourcecfdata = extract.parse_changeforms(sourcedata['changeforms'])
-    sourceplayer = extract.parse_player(sourcecfdata['playerdata'],
-                                        sourcecfdata['playerchangeflags'],
-                                        sourcegame)
-    # Get the data from target save
-    targetcfdata = extract.parse_changeforms(targetdata['changeforms'])
-    targetplayer = extract.parse_player(targetcfdata['playerdata'],
-                                        targetcfdata['playerchangeflags'],
-                                        targetgame)
+        raise FaceTransferException('Characters must be the same race!')
+
+
+@tracing.traced('transfer_face')
+def transfer_face(sourcefname: str, targetfname: str,
+                  compression: extract.CompressionStrategy = None):
+    """
+    Copy facial data from one save file to another. This function should be
+    the main entry point for the UI.
+
+    compression decides how the new player data is compressed, see
+    extract.CompressionStrategy.
+    """
+    # Bail out early from the headers alone if it's never going to work
+    check_compatible(*read_header(sourcefname, screenshot=False),
+                     *read_header(targetfname, screenshot=False))
+    with SaveFile(sourcefname, cachedir) as source:
+        face = extract_face(source)
+    apply_face(face, targetfname, compression)
+    return True
+
+
+@tracing.traced('extract_face')
+def extract_face(source: SaveFile) -> Dict[str, Any]:
+    """
+    Return everything needed from the source save to give its face to
+    other saves: the game, the header fields check_compatible looks at, and
+    the parsed player data with its change flags. It's all plain data, so
+    it can be pickled and sent to other processes.
+    """
+    return {'game': source.game,
+            'playersex': source['playersex'],
+            'playerraceeditorid': source['playerraceeditorid'],
+            'player': dict(source.player),
+            'playerchangeflags': set(source.changeform()['playerchangeflags'])}
+
+
+@tracing.traced('apply_face')
+def apply_face(face: Dict[str, Any], targetfname: str,
+               compression: extract.CompressionStrategy = None,
+               checkpoint: Callable[[str], None] = None) -> None:
+    """
+    Give the target save the face from extract_face, in place. The old
+    version can be restored with undo.UndoJournal.
+
+    checkpoint, if given, is called with a description of every step
+    before it starts. It can raise an exception to stop everything before
+    the target is written.
+    """
+    if checkpoint is None:
+        checkpoint = lambda status: None
+    checkpoint('Checking the target')
+    check_compatible(face['game'], face, *read_header(targetfname, screenshot=False))
+    # Only the player's changeform and a few offsets are new, the rest is
+    # copied from the old file when it's written
+    with SaveFile(targetfname, cachedir) as target:
+        checkpoint('Merging the face')
+        patches = changeform_patches(target, merge_face(face, target),
+                                     compression)
+    checkpoint('Writing the target')
+    patch_save(targetfname, patches)
+
+
+@tracing.traced('merge_face')
+def merge_face(face: Dict[str, Any], target: SaveFile) -> Dict[str, Any]:
+    """
+    Return a copy of the target's player changeform dict (as from
+    extract.parse_changeforms) with the face from extract_face.
+    """
+    check_compatible(face['game'], face, target.game, target)
+    targetcfdata = dict(target.changeform())
     # Merge players, return target player with source's face
     newplayer, newflags = extract.merge_player(
-        sourceplayer, sourcecfdata['playerchangeflags'],
-        targetplayer, targetcfdata['playerchangeflags'],
-        sourcegame
+        face['player'], face['playerchangeflags'],
+        target.player, targetcfdata['playerchangeflags'],
+        face['game']
     )
     # Encode and put the new face and flags in the target changeform data
-    targetcfdata['playerdata'] = extract.encode_player(newplayer, sourcegame)
+    targetcfdata['playerdata'] = extract.encode_player(newplayer, face['game'])
     targetcfdata['playerchangeflags'] = newflags
-    # Encode the changeform data and put it in the target main data
-    targetdata['changeforms'] = extract.encode_changeforms(targetcfdata)
-    # Then encode the whole file
-    newrawdata = extract.encode_savedata(targetdata)
-    # Write to disk
-    i = 0
-    while os.path.isfile(targetfname+'.facebak'+str(i)):
-        i += 1
-    rename(targetfname, targetfname+'.facebak'+str(i))
-    with open(targetfname, 'wb') as f:
-        f.write(newrawdata)
-    return True
-
-
+    return targetcfdata
 
 
 # ======= Misc =====================
@@ -287,6 +514,12 @@ class ErrWrapper(object):
 
 if __name__=='__main__':
     errorlog = datetime.now().strftime('facetransfer_error_%Y-%m-%d_%H-%M-%S.txt')
+    tracefile = os.environ.get('FACETRANSFER_TRACE')
+    if tracefile:
+        import atexit
+        tracing.enable()
+        atexit.register(tracing.write_chrome_trace, tracefile)
+    profiler = profiling.from_environment()
     sys.stderr = ErrWrapper(sys.stderr, errorlog)
     root = Tk()
     MainWindow(root)
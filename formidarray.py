@@ -0,0 +1,201 @@
+"""
+Resolve refids (the 3-byte form references in saves) to real formids, a
+whole run of them at a time.
+
+The top two bits of a refid say what the other 22 are:
+
+    0: an index (starting at 1) in the save's formidarray, which holds the
+       formids of forms from plugins. 0 with an index of 0 is no form.
+    1: the formid of a form from the main game ESM
+    2: the formid of a form created in the game, in the 0xff load order slot
+
+The formidarray is used as it is in the save (a uint32 view of it), and
+runs of refids are turned into uint32s and sorted out by head with slice
+assignments and bytes.translate, so only the refids that point into the
+formidarray are looked up one by one. With NumPy everything is done with
+array operations.
+"""
+
+from array import array
+import sys
+
+from typing import Any, Dict, Iterable, List
+
+from common import GameError
+import extract
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# What the top byte of a little-endian refid (as in ChangeFormIndex.refids)
+# turns into: the head, the refid without the head, and the top byte of the
+# resolved formid
+_heads = bytes(b >> 6 for b in range(256))
+_lowbits = bytes(b & 63 for b in range(256))
+_createdbytes = bytes(0xff if b >> 6 == 2 else 0 for b in range(256))
+
+# Formids of created forms all have this load order slot
+CREATED = 0xff000000
+
+
+def refid_fields(game: str) -> List[str]:
+    """ Return the keys of the refid fields in a game's player layout. """
+    return [key for typefunc, key, _ in extract.playerlayouts[game]
+            if typefunc is extract.refids]
+
+
+class FormIDArray:
+    """
+    The formidarray of a save, for resolving refids. formidarray is the
+    raw field from parse_savedata or SaveFile, and isn't copied (on a
+    little-endian machine), so the same rules as for SaveFile's memoryviews
+    apply.
+    """
+    def __init__(self, formidarray: Any) -> None:
+        view = memoryview(formidarray).cast('B')
+        if len(view) % 4:
+            raise GameError('The formid array has a broken length')
+        self._raw = view
+        if sys.byteorder == 'little':
+            self.formids = view.cast('I') # type: Any
+        else:
+            self.formids = array('I', view.tobytes())
+            self.formids.byteswap()
+        # Built on the first reverse lookup
+        self._indexes = None # type: Dict[int, int]
+
+    def __len__(self) -> int:
+        return len(self.formids)
+
+    @property
+    def indexes(self) -> Dict[int, int]:
+        """ A dict with the refid index (from 1) of every formid in the array. """
+        if self._indexes is None:
+            # Go backwards so that the first of any duplicates wins
+            n = len(self.formids)
+            self._indexes = dict(zip(reversed(self.formids), range(n, 0, -1)))
+        return self._indexes
+
+    def resolve(self, refid: int) -> int:
+        """ Return the formid of one refid, given as an int. """
+        head, value = refid >> 22, refid & 0x3fffff
+        if head == 0:
+            if value == 0:
+                return 0
+            if value > len(self.formids):
+                raise GameError('Refid {:06x} is outside the formid array'.format(refid))
+            return self.formids[value - 1]
+        if head == 1:
+            return value
+        if head == 2:
+            return CREATED | value
+        raise GameError('Invalid refid {:06x}'.format(refid))
+
+    def resolve_run(self, data: bytes) -> array:
+        """
+        Return the formids of a run of 3-byte refids (like the refids
+        fields of a parsed player) as an array of uint32s.
+        """
+        if len(data) % 3:
+            raise GameError('A refid run has a broken length')
+        data = bytes(data)
+        # Lay them out as little-endian uint32s, with the head bits left in
+        wide = bytearray(len(data) // 3 * 4)
+        wide[0::4] = data[2::3]
+        wide[1::4] = data[1::3]
+        wide[2::4] = data[0::3]
+        return self._resolve_wide(wide)
+
+    def resolve_refids(self, refids: Iterable[int]) -> array:
+        """
+        Return the formids of refids given as ints (like the refids column
+        of a ChangeFormIndex) as an array of uint32s.
+        """
+        if not isinstance(refids, array) or refids.typecode != 'I':
+            refids = array('I', refids)
+        wide = bytearray(refids.tobytes())
+        if sys.byteorder != 'little':
+            swapped = array('I', wide)
+            swapped.byteswap()
+            wide = bytearray(swapped.tobytes())
+        return self._resolve_wide(wide)
+
+    def _resolve_wide(self, wide: bytearray) -> array:
+        """ Resolve little-endian uint32 refids. wide is changed. """
+        if numpy is not None:
+            return self._resolve_numpy(wide)
+        tops = bytes(wide[2::4])
+        heads = tops.translate(_heads)
+        if 3 in heads:
+            raise GameError('Invalid refid in the run')
+        wide[2::4] = tops.translate(_lowbits)
+        wide[3::4] = tops.translate(_createdbytes)
+        out = array('I')
+        out.frombytes(wide)
+        if sys.byteorder != 'little':
+            out.byteswap()
+        # Only the plugin refids have to be looked up
+        if 0 in heads:
+            formids = self.formids
+            n = len(formids)
+            start = heads.find(0)
+            while start != -1:
+                value = out[start]
+                if value:
+                    if value > n:
+                        raise GameError('Refid {:06x} is outside the formid array'
+                                        .format(value))
+                    out[start] = formids[value - 1]
+                start = heads.find(0, start + 1)
+        return out
+
+    def _resolve_numpy(self, wide: bytearray) -> array:
+        refids = numpy.frombuffer(wide, '<u4')
+        heads = refids >> 22
+        values = refids & 0x3fffff
+        if (heads == 3).any():
+            raise GameError('Invalid refid in the run')
+        out = numpy.where(heads == 2, values | CREATED, values).astype('<u4')
+        plugins = (heads == 0) & (values != 0)
+        if plugins.any():
+            indexes = values[plugins]
+            if indexes.max() > len(self.formids):
+                raise GameError('Refid {:06x} is outside the formid array'
+                                .format(int(indexes.max())))
+            out[plugins] = numpy.frombuffer(self._raw, '<u4')[indexes - 1]
+        result = array('I')
+        result.frombytes(out.tobytes())
+        if sys.byteorder != 'little':
+            result.byteswap()
+        return result
+
+    def refid_of(self, formid: int) -> int:
+        """
+        Return the refid (as an int) that stands for the formid. Forms from
+        the main game ESM get a head 1 refid, unless they can't fit in one.
+        """
+        if formid == 0:
+            return 0
+        if formid & CREATED == CREATED:
+            if formid & 0xffffff > 0x3fffff:
+                raise GameError('Created formid {:08x} doesn\'t fit in a refid'
+                                .format(formid))
+            return 2 << 22 | (formid & 0x3fffff)
+        if formid <= 0x3fffff:
+            return 1 << 22 | formid
+        index = self.indexes.get(formid)
+        if index is None or index > 0x3fffff:
+            raise GameError('Formid {:08x} is not in the formid array'.format(formid))
+        return index
+
+    def encode_run(self, formids: Iterable[int]) -> bytes:
+        """ Return the formids as a run of 3-byte refids. """
+        return b''.join(self.refid_of(formid).to_bytes(3, 'big') for formid in formids)
+
+    def resolve_player(self, player: Dict[str, Any], game: str) -> Dict[str, array]:
+        """ Return the formids of all the refid fields in a parsed player. """
+        return {key: self.resolve_run(player[key]) for key in refid_fields(game)
+                if key in player}
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Generate synthetic save files for testing and benchmarking at any scale,
+without needing real saves.
+
+The fields are filled in by walking mainlayout and the player layouts, so
+everything the parser reads is there and in the right place. The data
+itself is made up: random but compressible changeform records, a player
+with random data under every change flag, made-up plugins and a gradient
+screenshot. The game would never load these, but extract and SaveFile
+handle them just like real saves.
+"""
+
+from collections import OrderedDict
+import io
+import random
+import struct
+
+from typing import Any, Dict, IO, List, NamedTuple, Set
+
+import extract
+from extract import bytes_, float32, formids, refids, screenshot
+from extract import uint8, uint16, uint32, vsval, wstring
+
+
+class SaveSpec(NamedTuple):
+    game: str = 'fallout4'
+    # Not counting the player's record
+    changeforms: int = 1000
+    # The average size of a changeform record's data, before compression
+    recordsize: int = 500
+    # How many of the records (0-1) are compressed
+    compressed: float = 0.5
+    plugins: int = 20
+    shotwidth: int = 256
+    shotheight: int = 144
+    # Where in the changeforms table the player's record is (0-1)
+    playerposition: float = 0.5
+    # The change flags of the player's record
+    playerflags: frozenset = frozenset({5, 6, 11, 14, 24})
+    playername: str = 'Synthetic'
+    playerrace: str = ''
+    playersex: int = 0
+    seed: int = 0
+
+
+races = {'skyrim': 'NordRace', 'fallout4': 'HumanRace'}
+magics = {'skyrim': b'TESV_SAVEGAME', 'fallout4': b'FO4_SAVEGAME'}
+saveversions = {'skyrim': 9, 'fallout4': 11}
+formversions = {'skyrim': 74, 'fallout4': 68}
+gamedates = {'skyrim': '012.34.56', 'fallout4': '001d.02h.03m.0 days'}
+
+# How many formids there are in the formid array
+FORMIDS = 100
+
+# How many changeforms spec_for_size generates to find out how big they are
+SAMPLE = 2000
+
+# The type of the player's changeform record, and the range of the others
+PLAYERCFTYPE = 9
+CFTYPES = 48
+
+
+def _words(rng: random.Random, n: int = 1) -> str:
+    return ' '.join(''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                            for _ in range(rng.randint(3, 9))).capitalize()
+                    for _ in range(n))
+
+
+def _randbytes(rng: random.Random, n: int) -> bytes:
+    """ Same as rng.randbytes, which is only there since Python 3.9. """
+    return rng.getrandbits(8 * n).to_bytes(n, 'little') if n else b''
+
+
+def _compressible(rng: random.Random, size: int) -> bytes:
+    """ Return size bytes that compress about as well as real records. """
+    chunk = _randbytes(rng, min(size, 32) or 1)
+    out = bytearray()
+    while len(out) < size:
+        out += chunk if rng.random() < 0.7 else _randbytes(rng, 8)
+    return bytes(out[:size])
+
+
+def _refid(rng: random.Random) -> bytes:
+    """ Return a valid refid: a formid array index, a game form or a created one. """
+    head = rng.randrange(3)
+    value = rng.randint(1, FORMIDS) if head == 0 else rng.getrandbits(22)
+    return (head << 22 | value).to_bytes(3, 'big')
+
+
+def fill_layout(layout, game: str, rng: random.Random, values: Dict[str, Any] = None,
+                flags: Set[int] = None) -> Dict[str, Any]:
+    """
+    Return a data dict for the layout, with random values for every field
+    that isn't in values. Fields under other change flags than flags are
+    left out (if flags is given). Counts and sizes are kept small, and the
+    fields that depend on them are made to match.
+    """
+    values = values or {}
+    data = OrderedDict() # type: Dict[str, Any]
+
+    def arg(value):
+        # Layout args are either constants or the key of an earlier field
+        return data[value] if isinstance(value, str) else value
+
+    for typefunc, key, args in layout:
+        if args.get('game', game) != game:
+            continue
+        if flags is not None and args.get('flag') is not None \
+                and args['flag'] not in flags:
+            continue
+        if 'ispresent' in args and not data[args['ispresent']]:
+            continue
+        if key in values:
+            data[key] = values[key]
+        elif typefunc in (uint8, uint16, uint32, vsval):
+            data[key] = rng.randrange(8)
+        elif typefunc is float32:
+            data[key] = struct.pack('<f', rng.random() * 2 - 1)
+        elif typefunc is wstring:
+            data[key] = _words(rng)
+        elif typefunc is bytes_:
+            if 'length' not in args:
+                raise ValueError('No value given for {}'.format(key))
+            data[key] = _randbytes(rng, arg(args['length']) * args.get('chunksize', 1))
+        elif typefunc is refids:
+            data[key] = b''.join(_refid(rng) for _ in range(arg(args['num'])))
+        elif typefunc is formids:
+            data[key] = _randbytes(rng, arg(args['num']) * 4)
+        elif typefunc is screenshot:
+            data[key] = gradient(arg(args['width']), arg(args['height']),
+                                 args['colorlength'])
+        else:
+            raise ValueError('Can\'t generate {} for {}'.format(typefunc.__name__, key))
+    return data
+
+
+def gradient(width: int, height: int, colorlength: int) -> bytes:
+    """ Return a simple image so that the thumbnails show something. """
+    rows = []
+    for y in range(height):
+        pixel = bytes([y * 255 // max(height - 1, 1), 128, 255 - y * 255 // max(height - 1, 1)])
+        pixel += b'\xff' * (colorlength - 3)
+        rows.append(pixel * width)
+    return b''.join(rows)
+
+
+def make_player(spec: SaveSpec, rng: random.Random) -> bytes:
+    """ Return the encoded data of a player with random data. """
+    values = {'gender': spec.playersex, 'name': spec.playername}
+    data = fill_layout(extract.playerlayouts[spec.game], spec.game, rng,
+                       values, set(spec.playerflags))
+    return extract.encode_player(data, spec.game)
+
+
+def _record(refid: int, flags: Set[int], cftype: int, version: int,
+            data: bytes, compressed: bool) -> List[bytes]:
+    record = OrderedDict([
+        ('changeformshead', b''),
+        ('playerrefid', refid.to_bytes(3, 'big')),
+        ('playerchangeflags', flags),
+        ('playercftype', cftype),
+        ('playerversion', version),
+        ('playeruncompressedlength', len(data) if compressed else 0),
+        ('playerdata', data),
+        ('changeformstail', b''),
+    ])
+    # Fastest compression, since there can be a lot of these
+    return extract.encode_changeforms_segments(
+        record, extract.CompressionStrategy(level=1))[1:-1]
+
+
+def make_changeforms(spec: SaveSpec, rng: random.Random) -> List[bytes]:
+    """ Return the changeforms table as a list of segments. """
+    version = formversions[spec.game]
+    playerrefid = extract.default_refid(7)
+    playerindex = round(spec.playerposition * spec.changeforms)
+    cfrefids = rng.sample(range(0x800000, 0xc00000), spec.changeforms)
+    segments = []
+    for n, refid in enumerate(cfrefids):
+        if n == playerindex:
+            segments.extend(_record(playerrefid, set(spec.playerflags),
+                                    PLAYERCFTYPE, version,
+                                    make_player(spec, rng), True))
+        size = max(1, int(rng.expovariate(1 / spec.recordsize)))
+        segments.extend(_record(refid, extract.flagset(rng.getrandbits(32)),
+                                rng.randrange(CFTYPES), version,
+                                _compressible(rng, size),
+                                rng.random() < spec.compressed))
+    if playerindex >= spec.changeforms:
+        segments.extend(_record(playerrefid, set(spec.playerflags),
+                                PLAYERCFTYPE, version,
+                                make_player(spec, rng), True))
+    return segments
+
+
+def _globaldatatable(rng: random.Random, count: int) -> bytes:
+    out = []
+    for n in range(count):
+        data = _compressible(rng, rng.randrange(4, 200))
+        out.append(struct.pack('<II', n, len(data)) + data)
+    return b''.join(out)
+
+
+def make_savedata(spec: SaveSpec) -> Dict[str, Any]:
+    """
+    Return a data dict (as from extract.parse_savedata) for a new save,
+    ready for extract.encode_savedata_segments. The changeforms table is a
+    list of segments.
+    """
+    rng = random.Random(spec.seed)
+    game = spec.game
+    plugins = ['{}.esm'.format(_words(rng, 2)) for _ in range(spec.plugins)]
+    plugininfo = bytes([len(plugins)]) + b''.join(extract.encode_wstring(p) for p in plugins)
+    tables = OrderedDict([
+        ('globaldatatable1', _globaldatatable(rng, 9)),
+        ('globaldatatable2', _globaldatatable(rng, 14)),
+        ('changeforms', make_changeforms(spec, rng)),
+        ('globaldatatable3', _globaldatatable(rng, 5)),
+    ])
+    values = {
+        'magic': magics[game],
+        'version': saveversions[game],
+        'savenumber': spec.seed + 1,
+        'playername': spec.playername,
+        'playerlevel': rng.randint(1, 50),
+        'playerlocation': _words(rng, 2),
+        'gamedate': gamedates[game],
+        'playerraceeditorid': spec.playerrace or races[game],
+        'playersex': spec.playersex,
+        'shotwidth': spec.shotwidth,
+        'shotheight': spec.shotheight,
+        'formversion': formversions[game],
+        'gameversion': '1.10.163.0',
+        'plugininfosize': len(plugininfo),
+        'plugininfo': plugininfo,
+        'globaldatatablecounts': struct.pack('<III', 9, 14, 5),
+        'changeformcount': spec.changeforms + 1,
+        'flttail': bytes(15 * 4),
+        'formidarraycount': FORMIDS,
+        # Forms from the plugins, in their load order slots
+        'formidarray': b''.join(
+            struct.pack('<I', rng.randint(1, max(1, spec.plugins)) << 24 | rng.getrandbits(24))
+            for _ in range(FORMIDS)),
+        'visitedworldspacearraycount': 1,
+        'unknown3tablesize': 4,
+        'unknown3table': bytes(4),
+    }
+    # Offsets and sizes are worked out below
+    for key in ('headersize', 'formidarraycountoffset', 'unknowntable3offset',
+                'globaldatatable1offset', 'globaldatatable2offset',
+                'changeformsoffset', 'globaldatatable3offset'):
+        values[key] = 0
+    values.update(tables)
+    data = fill_layout(extract.mainlayout, game, rng, values)
+    plan = extract.compile_layout(extract.mainlayout, game)
+    # The header size is everything from the version to the screenshot size
+    keys = list(data)
+    header = OrderedDict((k, data[k]) for k in keys[keys.index('version'):
+                                                    keys.index('shotheight') + 1])
+    data['headersize'] = len(plan.encode(header))
+    # The tables start right after the file location table
+    pos = len(plan.encode(OrderedDict((k, data[k]) for k in keys[:keys.index('flttail') + 1])))
+    for name, start, end in [('globaldatatable1', 'globaldatatable1offset', None),
+                             ('globaldatatable2', 'globaldatatable2offset', None),
+                             ('changeforms', 'changeformsoffset', None),
+                             ('globaldatatable3', 'globaldatatable3offset', None)]:
+        data[start] = pos
+        pos += extract.buffer_length(data[name])
+    data['formidarraycountoffset'] = pos
+    pos += 4 + len(data['formidarray']) + 4 + len(data['visitedworldspacearray'])
+    data['unknowntable3offset'] = pos
+    return data
+
+
+def write_save(f: IO[bytes], spec: SaveSpec) -> int:
+    """ Write a new save to an open binary file. Return its size. """
+    data = make_savedata(spec)
+    return extract.write_segments(f, extract.encode_savedata_segments(data))
+
+
+def spec_for_size(size: int, **kwargs: Any) -> SaveSpec:
+    """
+    Return a spec for a save of about size bytes, with the number of
+    changeforms picked to get there. Other spec fields can be given too.
+    How well the records compress is hard to guess, so a save without
+    changeforms and one with SAMPLE of them are generated to see what they
+    really take up.
+    """
+    spec = SaveSpec(**kwargs)
+    empty = write_save(io.BytesIO(), spec._replace(changeforms=0))
+    sample = write_save(io.BytesIO(), spec._replace(changeforms=SAMPLE))
+    average = (sample - empty) / SAMPLE
+    return spec._replace(changeforms=max(1, round((size - empty) / average)))
+
+
+if __name__ == '__main__':
+    import argparse
+    defaults = SaveSpec._field_defaults
+    parser = argparse.ArgumentParser(description='Generate synthetic save files')
+    parser.add_argument('output')
+    parser.add_argument('-g', '--game', choices=sorted(magics), default='fallout4')
+    parser.add_argument('-s', '--size', type=float,
+                        help='about how big the save should be, in MB '
+                             '(picks the number of changeforms)')
+    parser.add_argument('-n', '--changeforms', type=int, default=defaults['changeforms'])
+    parser.add_argument('--recordsize', type=int, default=defaults['recordsize'])
+    parser.add_argument('--compressed', type=float, default=defaults['compressed'],
+                        help='the fraction of compressed records (default: %(default)s)')
+    parser.add_argument('--plugins', type=int, default=defaults['plugins'])
+    parser.add_argument('--shotsize', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        default=(defaults['shotwidth'], defaults['shotheight']))
+    parser.add_argument('--playerposition', type=float, default=defaults['playerposition'],
+                        help='where the player is in the changeforms table, 0-1 '
+                             '(default: %(default)s)')
+    parser.add_argument('--sex', type=int, choices=(0, 1), default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    kwargs = dict(game=args.game, recordsize=args.recordsize,
+                  compressed=args.compressed, plugins=args.plugins,
+                  shotwidth=args.shotsize[0], shotheight=args.shotsize[1],
+                  playerposition=args.playerposition, playersex=args.sex,
+                  seed=args.seed)
+    if args.size:
+        spec = spec_for_size(int(args.size * 1e6), **kwargs)
+    else:
+        spec = SaveSpec(changeforms=args.changeforms, **kwargs)
+    with open(args.output, 'wb') as f:
+        size = write_save(f, spec)
+    print('Wrote {} ({:.1f} MB, {} changeforms)'.format(args.output, size / 1e6,
+                                                         spec.changeforms + 1))
@@ -0,0 +1,109 @@
+"""
+An on-disk cache of changeform indexes and section offsets, so that saves
+that are opened over and over again don't have their changeforms table
+scanned every time.
+"""
+
+import hashlib
+import json
+import os
+import os.path
+import struct
+import sys
+
+from typing import Any, Dict, Optional, Tuple
+
+from changeforms import ChangeFormIndex
+
+
+# How much of the start and end of a file goes into its content hash
+HASHCHUNK = 64 * 1024
+
+Sections = Dict[str, Tuple[int, int]]
+
+
+def content_hash(data: bytes) -> str:
+    """
+    Return a cheap hash of a save file's contents: its size and the first
+    and last HASHCHUNK bytes. The header (with the save number and the
+    playing time) is always in there.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(struct.pack('<Q', len(data)))
+    h.update(data[:HASHCHUNK])
+    h.update(data[-HASHCHUNK:])
+    return h.hexdigest()
+
+
+class IndexCache:
+    """
+    A directory with one file per cached save, named after a hash of the
+    save's absolute path. An entry is only used if the save's size, mtime
+    and content hash all still match.
+    """
+    magic = b'FTCFIDX'
+    version = 1
+
+    def __init__(self, cachedir: str) -> None:
+        self.cachedir = cachedir
+
+    def _entry_path(self, fname: str) -> str:
+        key = hashlib.sha1(os.path.abspath(fname).encode('utf-8')).hexdigest()
+        return os.path.join(self.cachedir, key + '.cfindex')
+
+    @staticmethod
+    def _meta(fname: str, stat: os.stat_result, data: bytes) -> Dict[str, Any]:
+        return {'path': os.path.abspath(fname),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'hash': content_hash(data),
+                'byteorder': sys.byteorder}
+
+    def load(self, fname: str, stat: os.stat_result,
+             data: bytes) -> Optional[Tuple[Sections, ChangeFormIndex]]:
+        """
+        Return the cached section offsets and changeform index of the save,
+        or None if there is no valid entry for it. data is the save's
+        contents (only the start and end are read).
+        """
+        try:
+            with open(self._entry_path(fname), 'rb') as f:
+                rawentry = f.read()
+        except OSError:
+            return None
+        headerend = len(self.magic) + 6
+        if len(rawentry) < headerend or not rawentry.startswith(self.magic):
+            return None
+        version, metalength = struct.unpack('<HI', rawentry[len(self.magic):headerend])
+        if version != self.version:
+            return None
+        try:
+            meta = json.loads(rawentry[headerend:headerend+metalength].decode('utf-8'))
+        except ValueError:
+            return None
+        expected = self._meta(fname, stat, data)
+        if any(meta.get(k) != v for k, v in expected.items()):
+            return None
+        try:
+            index = ChangeFormIndex.from_bytes(rawentry[headerend+metalength:],
+                                               meta['count'])
+        except (KeyError, ValueError):
+            return None
+        sections = {k: tuple(v) for k, v in meta['sections'].items()}
+        return sections, index
+
+    def store(self, fname: str, stat: os.stat_result, data: bytes,
+              sections: Sections, index: ChangeFormIndex) -> None:
+        """ Save the section offsets and changeform index of a save. """
+        meta = self._meta(fname, stat, data)
+        meta['sections'] = sections
+        meta['count'] = len(index)
+        rawmeta = json.dumps(meta).encode('utf-8')
+        os.makedirs(self.cachedir, exist_ok=True)
+        entrypath = self._entry_path(fname)
+        temppath = entrypath + '.tmp{}'.format(os.getpid())
+        with open(temppath, 'wb') as f:
+            f.write(self.magic + struct.pack('<HI', self.version, len(rawmeta)))
+            f.write(rawmeta)
+            f.write(index.to_bytes())
+        os.replace(temppath, entrypath)
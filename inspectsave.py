@@ -3,7 +3,10 @@
 from collections import defaultdict
 from os.path import basename, join
 import pprint
+import bloat
 import extract
+import profiling
+from savefile import SaveFile
 
 
 def readable_bytes(data: bytes) -> str:
@@ -48,63 +51,56 @@ bodyslidermuscular: {bodyslidermuscular}
 bodysliderlarge: {bodysliderlarge}
 """
 
-def dump_file(fname, rawplayer, npc, achr):
-    with open(fname, 'rb') as f:
-        rawdata = f.read()
-    game, data = extract.parse_savedata(rawdata)
-    cfdata = extract.parse_changeforms(data['changeforms'])
-    if rawplayer:
-        with open(join('savedumps', basename(fname) + '.rawsavedump'), 'w') as f:
-            f.write('{}\n\n{}'.format(cfdata['playerchangeflags'],
-                                      readable_bytes(cfdata['playerdata'])))
-        return
-
-    player = extract.parse_player(cfdata['playerdata'],
-                                  cfdata['playerchangeflags'],
-                                  game)
-    if npc:
-        out = ''
-        if game == 'fallout4':
-            keys = defaultdict(str)
-            keys['fname'] = fname
-            keys['flags'] = cfdata['playerchangeflags']
-            keys.update({k:(readable_bytes(v) if isinstance(v, bytes) else v)
-                         for k,v in player.items()})
-            out = falloutformat.format_map(keys)
-        with open(join('savedumps', basename(fname) + '.savedump'), 'w') as f:
-            f.write(out)
-    if achr:
-        cfdata2 = extract.parse_changeforms(data['changeforms'], refidnr=0x14)
-        with open(join('savedumps', basename(fname) + '.ACHRsavedump'), 'w') as f:
-            flags = cfdata2['playerchangeflags']
-            f.write('{}\n\n{}'.format(flags, readable_bytes(cfdata2['playerdata'])))
-
-def dry_transfer(sourcefname, targetfname):
-    with open(sourcefname, 'rb') as f:
-        sourcerawdata = f.read()
-    with open(targetfname, 'rb') as f:
-        targetrawdata = f.read()
-    sourcegame, sourcedata = extract.parse_savedata(sourcerawdata)
-    targetgame, targetdata = extract.parse_savedata(targetrawdata)
-    # Get the player data from the source save
-    sourcecfdata = extract.parse_changeforms(sourcedata['changeforms'])
-    sourceplayer = extract.parse_player(sourcecfdata['playerdata'],
-                                        sourcecfdata['playerchangeflags'],
-                                        sourcegame)
-    # Get the data from target save
-    targetcfdata = extract.parse_changeforms(targetdata['changeforms'])
-    targetplayer = extract.parse_player(targetcfdata['playerdata'],
-                                        targetcfdata['playerchangeflags'],
-                                        targetgame)
-    # Merge players, return target player with source's face
-    newplayer, newflags = extract.merge_player(
-        sourceplayer, sourcecfdata['playerchangeflags'],
-        targetplayer, targetcfdata['playerchangeflags'],
-        sourcegame
-    )
+def dump_file(fname, rawplayer, npc, achr, cachedir=None):
+    playerrefid = extract.default_refid(7)
+    achrrefid = extract.default_refid(0x14)
+    with SaveFile(fname, cachedir) as save:
+        game = save.game
+        # Get all the records that are needed in one go
+        records = {cf.refid: cf for cf in
+                   save.find_changeforms([playerrefid, achrrefid] if achr
+                                         else [playerrefid])}
+        playercf = records[playerrefid]
+        if rawplayer:
+            with open(join('savedumps', basename(fname) + '.rawsavedump'), 'w') as f:
+                f.write('{}\n\n{}'.format(playercf.flags,
+                                          readable_bytes(playercf.data)))
+            return
+
+        player = extract.parse_player(playercf.data, playercf.flags, game)
+        if npc:
+            out = ''
+            if game == 'fallout4':
+                keys = defaultdict(str)
+                keys['fname'] = fname
+                keys['flags'] = playercf.flags
+                keys.update({k:(readable_bytes(v) if isinstance(v, bytes) else v)
+                             for k,v in player.items()})
+                out = falloutformat.format_map(keys)
+            with open(join('savedumps', basename(fname) + '.savedump'), 'w') as f:
+                f.write(out)
+        if achr:
+            achrcf = records[achrrefid]
+            with open(join('savedumps', basename(fname) + '.ACHRsavedump'), 'w') as f:
+                f.write('{}\n\n{}'.format(achrcf.flags, readable_bytes(achrcf.data)))
+
+def dry_transfer(sourcefname, targetfname, cachedir=None):
+    with SaveFile(sourcefname, cachedir) as source, \
+            SaveFile(targetfname, cachedir) as target:
+        # Merge players, return target player with source's face
+        newplayer, newflags = extract.merge_player(
+            source.player, source.changeform()['playerchangeflags'],
+            target.player, target.changeform()['playerchangeflags'],
+            source.game
+        )
     pp = pprint.PrettyPrinter(indent=4)
     pp.pprint(newplayer)
 
+def bloat_report(fname, top=bloat.TOP, cachedir=None):
+    with SaveFile(fname, cachedir) as save:
+        report = bloat.bloat_report(save.cfindex, save.game, top)
+    print(bloat.format_bloat_report(report, basename(fname)))
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
@@ -113,10 +109,41 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--achr', action='store_true')
     parser.add_argument('-p', '--raw-player', action='store_true')
     parser.add_argument('-d', '--dry-transfer', action='store_true')
+    parser.add_argument('-b', '--bloat', action='store_true',
+                        help='show what the changeforms take up space with')
+    parser.add_argument('--bloat-top', type=int, default=bloat.TOP,
+                        help='how many of the biggest records to list (default: %(default)s)')
+    parser.add_argument('-c', '--cache-dir',
+                        help='cache changeform indexes in this directory')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the run and save the cProfile stats to FILE '
+                             'and a summary to FILE.txt')
+    parser.add_argument('--profile-mode', default=profiling.CPU, type=profiling.parse_mode,
+                        help='what to profile: cpu, memory or cpu,memory '
+                             '(default: %(default)s)')
+    parser.add_argument('--profile-top', type=int, default=profiling.TOP,
+                        help='how many functions and allocation sites the summary '
+                             'lists (default: %(default)s)')
     args = parser.parse_args()
-    if args.dry_transfer:
-        dry_transfer(args.files[0], args.files[1])
+
+    def run():
+        if args.dry_transfer:
+            dry_transfer(args.files[0], args.files[1], args.cache_dir)
+        elif args.bloat:
+            for f in args.files:
+                bloat_report(f, args.bloat_top, args.cache_dir)
+                print()
+        else:
+            for f in args.files:
+                dump_file(f, args.raw_player, args.npc, args.achr, args.cache_dir)
+    if args.profile:
+        profile = profiling.Profile(args.profile, top=args.profile_top,
+                                    label='inspectsave', **args.profile_mode)
+        try:
+            with profile:
+                run()
+        finally:
+            print(profile.report)
     else:
-        for f in args.files:
-            dump_file(f, args.raw_player, args.npc, args.achr)
+        run()
 
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Face presets: the parts of a player that a transfer copies (everything
+under change flags 11 and 14), saved on their own in a small file. A preset
+can be applied to a save just like a face from another save, without having
+to open that save at all.
+
+A preset file is a header (presetlayout) followed by the face fields,
+encoded with the game's player layout limited to the face flags.
+"""
+
+from collections import OrderedDict
+import struct
+
+from typing import Any, Dict
+
+from common import FaceTransferException, GameError
+import extract
+from extract import bytes_, uint16, uint32, wstring
+from savefile import SaveFile
+
+
+MAGIC = b'FTPRESET'
+VERSION = 1
+# The change flags with the face and body data
+FACEFLAGS = (11, 14)
+
+presetlayout = [
+    (bytes_, 'magic', {'length': len(MAGIC)}),
+    (uint16, 'version', {}),
+    (wstring, 'game', {}),
+    # The same fields as in the save's header, for check_compatible
+    (uint16, 'playersex', {}),
+    (wstring, 'playerraceeditorid', {}),
+    (uint32, 'playerchangeflags', {}),
+]
+
+# The player layouts with only the face fields
+facelayouts = {game: [line for line in layout
+                      if line[2].get('flag') in FACEFLAGS]
+               for game, layout in extract.playerlayouts.items()}
+
+
+def is_preset(fname: str) -> bool:
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def encode_preset(face: Dict[str, Any]) -> bytes:
+    """
+    Encode a face from facetransfer.extract_face as a preset. Only the face
+    fields are kept.
+    """
+    game = face['game']
+    flags = set(face['playerchangeflags']) & set(FACEFLAGS)
+    plan = extract.compile_layout(facelayouts[game], game)
+    steps = plan.steps_for(flags)
+    player = OrderedDict((k, face['player'][k]) for step in steps
+                         for k in step.keys if k in face['player'])
+    header = OrderedDict([
+        ('magic', MAGIC),
+        ('version', VERSION),
+        ('game', game),
+        ('playersex', face['playersex']),
+        ('playerraceeditorid', face['playerraceeditorid']),
+        ('playerchangeflags', sum(1 << flag for flag in flags)),
+    ])
+    return extract.compile_layout(presetlayout, None).encode(header) \
+        + plan.encode(player)
+
+
+def decode_preset(rawdata: bytes) -> Dict[str, Any]:
+    """
+    Return the face in a preset, in the same format as from
+    facetransfer.extract_face, ready for facetransfer.apply_face.
+    """
+    if rawdata[:len(MAGIC)] != MAGIC:
+        raise GameError('Not a face preset')
+    try:
+        i, header = extract.compile_layout(presetlayout, None).decode(rawdata)
+    except (IndexError, struct.error, UnicodeDecodeError):
+        raise FaceTransferException('The preset is corrupt') from None
+    if header['version'] != VERSION:
+        raise FaceTransferException('Unsupported preset version {} (expected {})'
+                                    .format(header['version'], VERSION))
+    game = header['game']
+    if game not in facelayouts:
+        raise GameError('Unknown game "{}" in preset'.format(game))
+    flags = extract.flagset(header['playerchangeflags'])
+    try:
+        i, player = extract.compile_layout(facelayouts[game], game) \
+            .decode(rawdata, flags, i)
+    except (IndexError, KeyError, struct.error, UnicodeDecodeError):
+        raise FaceTransferException('The preset is corrupt') from None
+    if i != len(rawdata):
+        raise FaceTransferException('The preset is corrupt')
+    return {'game': game,
+            'playersex': header['playersex'],
+            'playerraceeditorid': header['playerraceeditorid'],
+            'player': dict(player),
+            'playerchangeflags': flags}
+
+
+def export_preset(savefname: str, presetfname: str) -> None:
+    """ Save the face of the player in a save as a preset. """
+    from facetransfer import extract_face
+    with SaveFile(savefname) as save:
+        rawdata = encode_preset(extract_face(save))
+    with open(presetfname, 'wb') as f:
+        f.write(rawdata)
+
+
+def load_preset(fname: str) -> Dict[str, Any]:
+    with open(fname, 'rb') as f:
+        return decode_preset(f.read())
+
+
+def load_face(fname: str) -> Dict[str, Any]:
+    """
+    Return the face (as from facetransfer.extract_face) from either a
+    preset or a save file.
+    """
+    if is_preset(fname):
+        return load_preset(fname)
+    from facetransfer import cachedir, extract_face
+    with SaveFile(fname, cachedir) as save:
+        return extract_face(save)
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    from facetransfer import apply_face
+    parser = argparse.ArgumentParser(description='Export and apply face presets')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    exportparser = subparsers.add_parser('export', help='save the face in a save as a preset')
+    exportparser.add_argument('save')
+    exportparser.add_argument('preset')
+    applyparser = subparsers.add_parser('apply', help='give saves the face in a preset')
+    applyparser.add_argument('preset')
+    applyparser.add_argument('saves', nargs='+')
+    args = parser.parse_args()
+    try:
+        if args.command == 'export':
+            export_preset(args.save, args.preset)
+        else:
+            face = load_preset(args.preset)
+            for fname in args.saves:
+                apply_face(face, fname)
+    except (FaceTransferException, GameError) as e:
+        sys.exit('Error: {}'.format(e))
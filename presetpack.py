@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Preset packs: lots of face presets (see preset) in one file, with an index
+at the start so the pack can be memory-mapped and listed or searched
+without reading any of the presets themselves.
+
+The file is laid out like this:
+
+    header      magic, version, preset count, hash table size
+    index       one fixed-size entry per preset (_entry)
+    hash table  uint32 slots with an index entry number + 1, or 0 if empty
+    strings     the names and races of the presets, utf-8
+    presets     every preset, exactly as in a preset file
+
+The hash table uses open addressing with the crc32 of the name, so looking
+a preset up by name only touches a slot or two and one index entry.
+"""
+
+import mmap
+import os
+import struct
+import zlib
+
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from common import FaceTransferException
+import preset
+
+
+MAGIC = b'FTPACK\x00\x00'
+VERSION = 1
+GAMES = ('skyrim', 'fallout4')
+
+# magic, version, preset count, hash table slots
+_header = struct.Struct('<8sHII')
+# preset offset, preset size, name offset, name length, race offset,
+# race length, sex, game (index in GAMES)
+_entry = struct.Struct('<QIIHIHBB')
+_slot = struct.Struct('<I')
+
+
+class PackEntry(NamedTuple):
+    name: str
+    game: str
+    race: str
+    sex: int
+    size: int
+    offset: int
+
+
+def _hash(name: bytes) -> int:
+    return zlib.crc32(name)
+
+
+def _tablesize(count: int) -> int:
+    """ Keep the hash table at most half full. """
+    size = 8
+    while size < count * 2:
+        size *= 2
+    return size
+
+
+def write_pack(fname: str, presets: Iterable[Tuple[str, Dict[str, Any]]]) -> int:
+    """
+    Write a pack with the faces (as from facetransfer.extract_face or
+    preset.load_face), given as (name, face) pairs. Names have to be unique.
+    Return the number of presets in the pack.
+    """
+    names = [] # type: List[bytes]
+    races = [] # type: List[bytes]
+    faces = [] # type: List[Dict[str, Any]]
+    seen = set()
+    for name, face in presets:
+        rawname = name.encode('utf-8')
+        if rawname in seen:
+            raise FaceTransferException('Two presets are named "{}"'.format(name))
+        seen.add(rawname)
+        names.append(rawname)
+        races.append(face['playerraceeditorid'].encode('utf-8'))
+        faces.append(face)
+    count = len(names)
+    tablesize = _tablesize(count)
+    stringsoffset = _header.size + count * _entry.size + tablesize * _slot.size
+    strings = b''.join(n + r for n, r in zip(names, races))
+    offset = stringsoffset + len(strings)
+    stringoffset = stringsoffset
+    index = []
+    table = [0] * tablesize
+    rawpresets = []
+    for n, (name, race, face) in enumerate(zip(names, races, faces)):
+        rawpreset = preset.encode_preset(face)
+        index.append(_entry.pack(offset, len(rawpreset),
+                                 stringoffset, len(name),
+                                 stringoffset + len(name), len(race),
+                                 face['playersex'], GAMES.index(face['game'])))
+        rawpresets.append(rawpreset)
+        stringoffset += len(name) + len(race)
+        offset += len(rawpreset)
+        slot = _hash(name) % tablesize
+        while table[slot]:
+            slot = (slot + 1) % tablesize
+        table[slot] = n + 1
+    temppath = fname + '.tmp'
+    with open(temppath, 'wb') as f:
+        f.write(_header.pack(MAGIC, VERSION, count, tablesize))
+        f.writelines(index)
+        f.write(struct.pack('<{}I'.format(tablesize), *table))
+        f.write(strings)
+        f.writelines(rawpresets)
+    os.replace(temppath, fname)
+    return count
+
+
+class PresetPack:
+    """
+    A memory-mapped preset pack. Use it as a context manager or call
+    close() when done.
+    """
+    def __init__(self, fname: str) -> None:
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _header.size:
+                raise FaceTransferException('Not a preset pack')
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count, self._tablesize = _header.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self.close()
+            raise FaceTransferException('Not a preset pack')
+        if version != VERSION:
+            self.close()
+            raise FaceTransferException('Unsupported preset pack version {} '
+                                        '(expected {})'.format(version, VERSION))
+        self._tableoffset = _header.size + self._count * _entry.size
+
+    def __enter__(self) -> 'PresetPack':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[PackEntry]:
+        return (self.entry(n) for n in range(self._count))
+
+    def __contains__(self, name: str) -> bool:
+        return self.find(name) is not None
+
+    def _string(self, offset: int, length: int) -> str:
+        return self._mmap[offset:offset+length].decode('utf-8')
+
+    def entry(self, n: int) -> PackEntry:
+        """ Return the n:th entry in the index. """
+        offset, size, nameoffset, namelength, raceoffset, racelength, sex, game \
+            = _entry.unpack_from(self._mmap, _header.size + n * _entry.size)
+        return PackEntry(self._string(nameoffset, namelength), GAMES[game],
+                         self._string(raceoffset, racelength), sex, size, offset)
+
+    def find(self, name: str) -> Optional[PackEntry]:
+        """ Return the entry of the preset with the name, or None. """
+        rawname = name.encode('utf-8')
+        slot = _hash(rawname) % self._tablesize
+        while True:
+            n = _slot.unpack_from(self._mmap, self._tableoffset + slot * _slot.size)[0]
+            if n == 0:
+                return None
+            _, _, nameoffset, namelength = \
+                _entry.unpack_from(self._mmap, _header.size + (n - 1) * _entry.size)[:4]
+            if self._mmap[nameoffset:nameoffset+namelength] == rawname:
+                return self.entry(n - 1)
+            slot = (slot + 1) % self._tablesize
+
+    def raw(self, name: str) -> bytes:
+        """ Return the preset as it would be in a preset file. """
+        entry = self.find(name)
+        if entry is None:
+            raise KeyError(name)
+        return self._mmap[entry.offset:entry.offset+entry.size]
+
+    def load(self, name: str) -> Dict[str, Any]:
+        """
+        Return the face of the preset with the name, ready for
+        facetransfer.apply_face.
+        """
+        return preset.decode_preset(self.raw(name))
+
+    def close(self) -> None:
+        self._mmap.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    from common import GameError
+    parser = argparse.ArgumentParser(description='Create and read preset packs')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    createparser = subparsers.add_parser('create', help='pack presets or the faces in saves')
+    createparser.add_argument('pack')
+    createparser.add_argument('files', nargs='+')
+    listparser = subparsers.add_parser('list', help='list the presets in a pack')
+    listparser.add_argument('pack')
+    extractparser = subparsers.add_parser('extract', help='save a preset in a pack as a file')
+    extractparser.add_argument('pack')
+    extractparser.add_argument('name')
+    extractparser.add_argument('preset')
+    args = parser.parse_args()
+    try:
+        if args.command == 'create':
+            count = write_pack(args.pack, (
+                (os.path.splitext(os.path.basename(fname))[0], preset.load_face(fname))
+                for fname in args.files))
+            print('Packed {} presets'.format(count))
+        elif args.command == 'list':
+            with PresetPack(args.pack) as pack:
+                for entry in pack:
+                    print('{0.name}\t{0.game}\t{0.race}\t{1}\t{0.size}'.format(
+                        entry, ['male', 'female'][entry.sex]))
+        else:
+            with PresetPack(args.pack) as pack:
+                rawdata = pack.raw(args.name)
+            with open(args.preset, 'wb') as f:
+                f.write(rawdata)
+    except KeyError as e:
+        sys.exit('Error: no preset named {}'.format(e))
+    except (FaceTransferException, GameError) as e:
+        sys.exit('Error: {}'.format(e))
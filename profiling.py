@@ -0,0 +1,205 @@
+"""
+Profiling hooks, so that a slow transfer can be reproduced and looked at
+without editing any code. An operation run inside a Profile is profiled
+with cProfile (where the time goes), tracemalloc (where the memory goes)
+or both:
+
+    with profiling.Profile('transfer.prof', memory=True) as profile:
+        ...
+    print(profile.report)
+
+The cProfile stats are saved to the file name given, ready for pstats or
+snakeviz, and a summary with the top functions and allocation sites is
+saved next to it with .txt added.
+
+inspectsave.py has --profile for this, and facetransfer.py profiles every
+operation the GUI runs if FACETRANSFER_PROFILE is set (see
+from_environment).
+"""
+
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from typing import Any, Callable, Dict, Mapping, Optional
+
+
+CPU = 'cpu'
+MEMORY = 'memory'
+# How many functions and allocation sites the summary lists
+TOP = 25
+
+# tracemalloc is global, so it's only stopped when the last profile that
+# needs it is done
+_tracemalloclock = threading.Lock()
+_tracemallocusers = 0
+
+
+def _start_tracemalloc() -> None:
+    global _tracemallocusers
+    with _tracemalloclock:
+        if _tracemallocusers == 0:
+            tracemalloc.start()
+        _tracemallocusers += 1
+
+
+def _stop_tracemalloc() -> None:
+    global _tracemallocusers
+    with _tracemalloclock:
+        _tracemallocusers -= 1
+        if _tracemallocusers == 0:
+            tracemalloc.stop()
+
+
+class Profile:
+    """
+    Profile everything run inside it (on the same thread, for cProfile)
+    and write the results when done. The summary is kept in report.
+
+    tracemalloc sees every thread, so a memory profile of an operation
+    that runs at the same time as another one includes both of them.
+    """
+    def __init__(self, fname: str, cpu: bool = True, memory: bool = False,
+                 top: int = TOP, label: str = None) -> None:
+        if not cpu and not memory:
+            raise ValueError('Nothing to profile')
+        self.fname = fname
+        self.cpu = cpu
+        self.memory = memory
+        self.top = top
+        self.label = label or os.path.basename(fname)
+        self.report = ''
+        self._profiler = None # type: Optional[cProfile.Profile]
+
+    @property
+    def summaryfname(self) -> str:
+        return self.fname + '.txt'
+
+    def __enter__(self) -> 'Profile':
+        if self.memory:
+            _start_tracemalloc()
+            # Only there since Python 3.9
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        if self.cpu:
+            self._profiler = cProfile.Profile()
+        self._start = time.perf_counter()
+        if self._profiler is not None:
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self._profiler is not None:
+            self._profiler.disable()
+        wall = time.perf_counter() - self._start
+        snapshot = peak = None
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            _stop_tracemalloc()
+        parts = ['Profile of {}: {:.3f} s'.format(self.label, wall)]
+        if self._profiler is not None:
+            self._profiler.dump_stats(self.fname)
+            parts.append(self._format_cpu(self._profiler))
+        if snapshot is not None:
+            parts.append(self._format_memory(snapshot, peak))
+        self.report = '\n\n'.join(parts)
+        with open(self.summaryfname, 'w') as f:
+            f.write(self.report + '\n')
+
+    def _format_cpu(self, profiler: cProfile.Profile) -> str:
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(self.top)
+        return 'Top {} functions by cumulative time:\n{}'.format(
+            self.top, out.getvalue().strip('\n'))
+
+    def _format_memory(self, snapshot: tracemalloc.Snapshot, peak: int) -> str:
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib.*>'),
+        ])
+        lines = ['Top {} allocation sites still alive at the end '
+                 '(peak {:.1f} KiB):'.format(self.top, peak / 1024),
+                 '{:>12} {:>8}  {}'.format('KiB', 'blocks', 'where')]
+        for stat in snapshot.statistics('lineno')[:self.top]:
+            frame = stat.traceback[0]
+            lines.append('{:>12.1f} {:>8}  {}:{}'.format(
+                stat.size / 1024, stat.count, frame.filename, frame.lineno))
+        return '\n'.join(lines)
+
+
+class Profiler:
+    """
+    Makes a Profile for every operation, numbered so that none of them
+    overwrite each other: prefix-001-name.prof, prefix-002-name.prof, ...
+    If echo is true, every report is printed when it's done.
+
+    Since Python 3.12 only one cProfile can be on at a time in a process,
+    so wrapped functions run one at a time, even if they're called from
+    different threads. That also keeps their profiles apart.
+    """
+    def __init__(self, prefix: str, cpu: bool = True, memory: bool = False,
+                 top: int = TOP, echo: bool = True) -> None:
+        self.prefix = prefix
+        self.cpu = cpu
+        self.memory = memory
+        self.top = top
+        self.echo = echo
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self._runlock = threading.Lock()
+
+    def profile(self, name: str) -> Profile:
+        with self._lock:
+            n = next(self._counter)
+        fname = '{}-{:03}-{}.prof'.format(self.prefix, n, name)
+        return Profile(fname, self.cpu, self.memory, self.top, label=name)
+
+    def wrap(self, name: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        """ Return func changed to be profiled every time it's called. """
+        def wrapper(*args, **kwargs):
+            with self._runlock:
+                profile = self.profile(name)
+                try:
+                    with profile:
+                        return func(*args, **kwargs)
+                finally:
+                    if self.echo and sys.stdout is not None:
+                        print(profile.report, file=sys.stdout)
+        return wrapper
+
+
+def parse_mode(mode: str) -> Dict[str, bool]:
+    """
+    Turn a mode like 'cpu', 'memory' or 'cpu,memory' into the cpu and
+    memory arguments of Profile.
+    """
+    kinds = {kind.strip() for kind in mode.lower().split(',') if kind.strip()}
+    unknown = kinds - {CPU, MEMORY}
+    if unknown or not kinds:
+        raise ValueError('Unknown profiling mode: {}'.format(mode))
+    return {'cpu': CPU in kinds, 'memory': MEMORY in kinds}
+
+
+def from_environment(environ: Mapping[str, str] = os.environ,
+                     var: str = 'FACETRANSFER_PROFILE') -> Optional[Profiler]:
+    """
+    Return a Profiler set up from environment variables, or None if
+    profiling isn't asked for. var is the file name prefix to use,
+    var_MODE is the mode (see parse_mode, default cpu) and var_TOP is how
+    many functions and allocation sites to list.
+    """
+    prefix = environ.get(var)
+    if not prefix:
+        return None
+    mode = parse_mode(environ.get(var + '_MODE', CPU))
+    top = int(environ.get(var + '_TOP', TOP))
+    return Profiler(prefix, top=top, **mode)
@@ -0,0 +1,239 @@
+"""
+A lazy, memory-mapped view of a save file. Fields are only decoded when
+they're asked for, so reading a couple of header fields or the player's
+changeform doesn't mean reading (or even paging in) the whole file.
+"""
+
+from collections import OrderedDict
+import mmap
+import os
+import zlib
+
+from typing import Any, Dict, Iterable, List, Tuple
+
+from changeforms import bodycache, ChangeForm, ChangeFormIndex, Predicate
+from changeforms import decompress_all
+from common import GameError
+import extract
+from indexcache import IndexCache, Sections
+
+
+# The data tables, and the file location table keys with their offsets
+tablesections = [
+    ('globaldatatable1', 'globaldatatable1offset', 'globaldatatable2offset'),
+    ('globaldatatable2', 'globaldatatable2offset', 'changeformsoffset'),
+    ('changeforms', 'changeformsoffset', 'globaldatatable3offset'),
+    ('globaldatatable3', 'globaldatatable3offset', 'formidarraycountoffset'),
+]
+
+
+class SaveFile:
+    """
+    A memory-mapped save file. Every field in mainlayout can be accessed as
+    an attribute (or with save['key']) and is decoded the first time it's
+    used. The data tables and other bulk fields are memoryviews of the
+    mapped file, so they don't cost anything until they're actually read.
+
+    Use it as a context manager or call close() when done. Don't keep any
+    of the memoryviews around after that.
+    """
+    def __init__(self, fname: str, cachedir: str = None) -> None:
+        """
+        Open and map the file. If cachedir is given, the changeform index
+        and table offsets are cached there between runs (see indexcache).
+        """
+        self.fname = fname
+        self._nextstep = 0
+        self._pos = 0
+        self._data = OrderedDict() # type: Dict[str, Any]
+        # The offset in the file of every decoded field
+        self.offsets = {} # type: Dict[str, int]
+        self._changeforms = {} # type: Dict[int, Dict[str, Any]]
+        self._player = None # type: Dict[str, Any]
+        self._cfindex = None # type: ChangeFormIndex
+        self._cache = IndexCache(cachedir) if cachedir else None
+        self._sections = None # type: Sections
+        with open(fname, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            if self.stat.st_size == 0:
+                raise GameError('The file is empty')
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if self._view[:13] == b'TESV_SAVEGAME':
+            self.game = 'skyrim'
+        elif self._view[:12] == b'FO4_SAVEGAME':
+            self.game = 'fallout4'
+        else:
+            magic = bytes(self._view[:12]).decode(errors='replace')
+            self.close()
+            raise GameError('Game not recognized. Magic is "{}"'.format(magic))
+        self._steps = extract.compile_layout(extract.mainlayout, self.game).steps
+
+    def __enter__(self) -> 'SaveFile':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.stat.st_size
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._data:
+            self._decode_until(key)
+        return self._data[key]
+
+    def __getattr__(self, key: str) -> Any:
+        # Only called when there is no normal attribute with that name
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def _decode_until(self, key: str) -> None:
+        """
+        Decode the fields in order until key is found. If key is None,
+        decode everything.
+        """
+        if self._view is None:
+            raise ValueError('I/O operation on closed save file')
+        # Bulk fields are sliced from the view, the rest from the map itself
+        buffers = (self._mmap, self._view)
+        data, steps = self._data, self._steps
+        while key not in data and self._nextstep < len(steps):
+            step = steps[self._nextstep]
+            self._nextstep += 1
+            pos = self._pos
+            self._pos = step.decode(pos, buffers[step.bulk], data)
+            for k, offset in zip(step.keys, step.offsets):
+                self.offsets[k] = pos + offset
+        if key is not None and key not in data:
+            raise KeyError(key)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Decode everything and return a dict just like the one from
+        extract.parse_savedata(..., zerocopy=True), ready for
+        extract.encode_savedata. The dict is a new copy, so it's fine to
+        modify it.
+        """
+        self._decode_until(None)
+        assert self._pos == len(self._view)
+        return OrderedDict(self._data)
+
+    def changeform(self, refidnr: int = 7) -> Dict[str, Any]:
+        """
+        Return the parsed changeform dict (as from extract.parse_changeforms)
+        for the refid. The player is 7.
+        """
+        if refidnr not in self._changeforms:
+            index = self.cfindex
+            self._changeforms[refidnr] = extract.parse_changeforms(
+                self.section('changeforms'), refidnr=refidnr, index=index,
+                decompress=self.decompress)
+        return self._changeforms[refidnr]
+
+    def find_changeforms(self, refids: Iterable[int] = None,
+                         predicate: Predicate = None) -> List[ChangeForm]:
+        """
+        Return the changeform records with the refids and/or matching the
+        predicate, in file order. See changeforms.find_changeforms.
+        """
+        return self.cfindex.select(self.section('changeforms'), refids,
+                                   predicate, self.decompress)
+
+    def decompress_all(self, workers: int = None) -> List[bytes]:
+        """
+        Return the data of every changeform in the save, in file order,
+        decompressed on several threads. See changeforms.decompress_all.
+        """
+        index = self.cfindex
+        return decompress_all(self.section('changeforms'), index, workers)
+
+    @property
+    def identity(self) -> Tuple[str, int, int]:
+        """ The absolute path, size and mtime of the file. """
+        return (os.path.abspath(self.fname), self.stat.st_size,
+                self.stat.st_mtime_ns)
+
+    def decompress(self, refid: int, data: bytes) -> bytes:
+        """
+        Decompress the body of the changeform with the refid, through the
+        shared changeforms.bodycache.
+        """
+        return bodycache.get((self.identity, refid),
+                             lambda: zlib.decompress(data))
+
+    @property
+    def cfindex(self) -> ChangeFormIndex:
+        """
+        The index of all records in the changeforms table. If the save was
+        opened with a cache directory, the index is loaded from (or saved
+        to) the cache.
+        """
+        if self._cfindex is not None:
+            return self._cfindex
+        if self._cache is not None:
+            cached = self._cache.load(self.fname, self.stat, self._view)
+            if cached is not None:
+                self._sections, self._cfindex = cached
+                return self._cfindex
+        self._cfindex = ChangeFormIndex.build(self['changeforms'],
+                                              self['changeformcount'])
+        if self._cache is not None:
+            try:
+                self._cache.store(self.fname, self.stat, self._view,
+                                  self.sections(), self._cfindex)
+            except OSError:
+                # The cache is only an optimization, so don't fail on it
+                pass
+        return self._cfindex
+
+    def sections(self) -> Sections:
+        """
+        Return the start and end offsets in the file of the data tables, as
+        given by the file location table.
+        """
+        if self._sections is None:
+            self._sections = {name: (self[start], self[end])
+                              for name, start, end in tablesections}
+        return self._sections
+
+    def section(self, name: str) -> memoryview:
+        """
+        Return one of the data tables (like 'changeforms'). If its offsets
+        are already known, nothing before it has to be decoded.
+        """
+        if name not in self._data and self._sections is not None:
+            start, end = self._sections[name]
+            return self._view[start:end]
+        return self[name]
+
+    @property
+    def player(self) -> Dict[str, Any]:
+        """ The parsed player data, as from extract.parse_player. """
+        if self._player is None:
+            cfdata = self.changeform(7)
+            self._player = extract.parse_player(
+                cfdata['playerdata'], cfdata['playerchangeflags'], self.game)
+        return self._player
+
+    def close(self) -> None:
+        """
+        Unmap the file. If some memoryview of it is still in use elsewhere,
+        the map is left for the garbage collector to close.
+        """
+        if self._view is None:
+            return
+        self._data.clear()
+        self._changeforms.clear()
+        self._player = None
+        self._view.release()
+        self._view = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+
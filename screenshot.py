@@ -0,0 +1,113 @@
+"""
+Turn the screenshots in save files into thumbnails for the GUI.
+
+Everything works on whole buffers at a time: the alpha channel is dropped
+with slice assignments, and the 2x2 box filter adds up the pixels as big
+integers with every byte in its own 16-bit lane, so there is no Python loop
+over the pixels. If NumPy is installed it's used instead, with the exact
+same results.
+
+Thumbnails are PPM images, which Tk can load straight from memory. They're
+cached by the save's identity (path, size and mtime), so browsing the same
+save again doesn't read or process the screenshot at all.
+"""
+
+import os
+import os.path
+
+from typing import Tuple
+
+from changeforms import BodyCache
+import extract
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Screenshots this high or higher are halved
+HALVEHEIGHT = 384
+
+# The thumbnails of recently browsed saves, as PPM images
+thumbnails = BodyCache(maxbytes=8 * 1024 * 1024)
+
+
+def rgba_to_rgb(data: bytes) -> bytes:
+    """ Drop every fourth byte. """
+    if numpy is not None:
+        return numpy.frombuffer(data, numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+    out = bytearray(len(data) // 4 * 3)
+    for n in range(3):
+        out[n::3] = data[n::4]
+    return bytes(out)
+
+
+def _widen(data: bytes) -> int:
+    """ Return the bytes as one int with each of them in a 16-bit lane. """
+    wide = bytearray(len(data) * 2)
+    wide[::2] = data
+    return int.from_bytes(wide, 'little')
+
+
+def halve(rgb: bytes, width: int, height: int) -> Tuple[int, int, bytes]:
+    """
+    Scale an RGB image down to half its width and height, with every new
+    pixel the (rounded down) average of a 2x2 box. An odd last row or
+    column is dropped. Return the new width, height and data.
+    """
+    newwidth, newheight = width // 2, height // 2
+    if numpy is not None:
+        pixels = numpy.frombuffer(rgb, numpy.uint8).reshape(height, width, 3)
+        boxes = pixels[:newheight*2, :newwidth*2].astype(numpy.uint16) \
+            .reshape(newheight, 2, newwidth, 2, 3).sum(axis=(1, 3)) >> 2
+        return newwidth, newheight, boxes.astype(numpy.uint8).tobytes()
+    rowlength = width * 3
+    newrowlength = newwidth * 3
+    # The four corners of every box, each as one image of the new size
+    corners = [bytearray(newrowlength * newheight) for _ in range(4)]
+    for y in range(newheight):
+        top = rgb[y*2*rowlength:(y*2+1)*rowlength]
+        bottom = rgb[(y*2+1)*rowlength:(y*2+2)*rowlength]
+        start = y * newrowlength
+        for corner, row, dx in zip(corners, (top, top, bottom, bottom), (0, 3, 0, 3)):
+            for n in range(3):
+                corner[start+n:start+newrowlength:3] = \
+                    row[dx+n:dx+n+newwidth*6:6]
+    # No lane can overflow (4 * 255 < 2**16). After the shift, the bits that
+    # spill over from the next lane end up in the high byte, which is dropped.
+    total = sum(_widen(corner) for corner in corners) >> 2
+    return newwidth, newheight, \
+        total.to_bytes(len(corners[0]) * 2, 'little')[::2]
+
+
+def to_ppm(rgb: bytes, width: int, height: int) -> bytes:
+    return 'P6\n{} {}\n255\n'.format(width, height).encode() + rgb
+
+
+def make_thumbnail(game: str, header) -> bytes:
+    """
+    Return the screenshot in a save's header (from extract.parse_header)
+    as a PPM image, halved if it's big.
+    """
+    width, height = header['shotwidth'], header['shotheight']
+    data = bytes(header['screenshotdata'])
+    if extract.shotcolorlengths[game] == 4:
+        data = rgba_to_rgb(data)
+    if height >= HALVEHEIGHT:
+        width, height, data = halve(data, width, height)
+    return to_ppm(data, width, height)
+
+
+def thumbnail(fname: str) -> bytes:
+    """
+    Return the thumbnail of a save as a PPM image. It's only made if it
+    isn't already in the cache.
+    """
+    stat = os.stat(fname)
+    identity = (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+
+    def load() -> bytes:
+        with open(fname, 'rb') as f:
+            return make_thumbnail(*extract.parse_header(f))
+    return thumbnails.get(identity, load)
@@ -0,0 +1,146 @@
+"""
+Rewrite a save file by copying the parts that didn't change straight from
+the original, and writing only the parts that did. Where the OS can, the
+unchanged parts are copied inside the kernel (copy_file_range or sendfile)
+without ever being read into memory.
+"""
+
+import errno
+import os
+
+from typing import Any, Dict, List, Tuple
+
+import extract
+import tracing
+from savefile import SaveFile
+
+
+# A byte range [start, end) in the original file and what to put there
+Patch = Tuple[int, int, bytes]
+
+# The file location table offsets that move when the changeforms table
+# changes size, see extract.update_savedata_offsets
+movedoffsets = ('formidarraycountoffset', 'unknowntable3offset',
+                'globaldatatable3offset')
+
+# Errors that mean a kernel copy method can't be used for these files
+_unsupported = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.EBADF, errno.ENOTSUP}
+
+COPYCHUNK = 1024 * 1024
+
+
+def _copy_file_range(srcfd: int, dstfd: int, offset: int, count: int) -> int:
+    return os.copy_file_range(srcfd, dstfd, count, offset)
+
+def _sendfile(srcfd: int, dstfd: int, offset: int, count: int) -> int:
+    return os.sendfile(dstfd, srcfd, offset, count)
+
+def _readwrite(srcfd: int, dstfd: int, offset: int, count: int) -> int:
+    os.lseek(srcfd, offset, os.SEEK_SET)
+    data = os.read(srcfd, min(count, COPYCHUNK))
+    _write_all(dstfd, data)
+    return len(data)
+
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class _Copier:
+    """
+    Copies byte ranges from one file to the current position of another,
+    with the fastest method that works for the two files.
+    """
+    def __init__(self, srcfd: int, dstfd: int) -> None:
+        self.srcfd = srcfd
+        self.dstfd = dstfd
+        self.methods = []
+        if hasattr(os, 'copy_file_range'):
+            self.methods.append(_copy_file_range)
+        if hasattr(os, 'sendfile'):
+            self.methods.append(_sendfile)
+        self.methods.append(_readwrite)
+
+    def copy(self, offset: int, count: int) -> None:
+        while count > 0:
+            method = self.methods[0]
+            try:
+                copied = method(self.srcfd, self.dstfd, offset, count)
+            except OSError as e:
+                if e.errno not in _unsupported or method is _readwrite:
+                    raise
+                # Nothing was copied, so just try again with the next one
+                self.methods.pop(0)
+                continue
+            if copied == 0:
+                raise EOFError('The file ended before offset {}'.format(offset + count))
+            offset += copied
+            count -= copied
+
+
+@tracing.traced('write_spliced')
+def write_spliced(srcfname: str, dstfname: str, patches: List[Patch]) -> int:
+    """
+    Write dstfname as a copy of srcfname with every patch's byte range
+    replaced with its data. The patches can't overlap. Return the size of
+    the new file.
+    """
+    patches = sorted(patches, key=lambda p: p[0])
+    with open(srcfname, 'rb') as src, open(dstfname, 'wb') as dst:
+        srcsize = os.fstat(src.fileno()).st_size
+        copier = _Copier(src.fileno(), dst.fileno())
+        pos = 0
+        size = 0
+        for start, end, data in patches:
+            if start < pos or end < start or end > srcsize:
+                raise ValueError('Invalid or overlapping patch at {}'.format(start))
+            copier.copy(pos, start - pos)
+            _write_all(dst.fileno(), data)
+            size += start - pos + len(data)
+            pos = end
+        copier.copy(pos, srcsize - pos)
+        size += srcsize - pos
+    return size
+
+
+@tracing.traced('reverse_patches')
+def reverse_patches(srcfname: str, patches: List[Patch]) -> List[Patch]:
+    """
+    Return the patches that turn the result of write_spliced(srcfname, ...,
+    patches) back into srcfname. The original bytes are read from srcfname.
+    """
+    out = []
+    shift = 0
+    with open(srcfname, 'rb') as f:
+        for start, end, data in sorted(patches, key=lambda p: p[0]):
+            f.seek(start)
+            out.append((start + shift, start + shift + len(data), f.read(end - start)))
+            shift += len(data) - (end - start)
+    return out
+
+
+@tracing.traced('changeform_patches')
+def changeform_patches(save: SaveFile, cfdata: Dict[str, Any],
+                       compression: extract.CompressionStrategy = None) -> List[Patch]:
+    """
+    Return the patches that turn the save into one with cfdata (a dict from
+    extract.parse_changeforms, probably modified) as its changeform. Only
+    the record itself and the file location table offsets after it change.
+    """
+    segments = extract.encode_changeforms_segments(cfdata, compression)
+    # Everything but the head and tail is the new record
+    newrecord = b''.join(segments[1:-1])
+    record = save.cfindex.find(int.from_bytes(cfdata['playerrefid'], 'big'))
+    start = save['changeformsoffset'] + record.offset
+    end = save['changeformsoffset'] + record.dataoffset + record.reallength
+    diff = len(newrecord) - (end - start)
+    patches = [(start, end, newrecord)]
+    if diff:
+        for key in movedoffsets:
+            # Decoding the value also gives its offset
+            value = save[key]
+            offset = save.offsets[key]
+            patches.append((offset, offset + 4, extract.encode_uint32(value + diff)))
+    return patches
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from batch import transfer_face_batch
+import extract
+import gensave
+from preset import FACEFLAGS
+from savefile import SaveFile
+from test_extract import bundled_saves
+from undo import UndoJournal
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.source = bundled_saves()[0]
+        self.targets = []
+        for n in range(3):
+            fname = os.path.join(self.tempdir.name, 'target{}.ess'.format(n))
+            shutil.copy(self.source, fname)
+            self.targets.append(fname)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_failures_are_reported(self):
+        missing = os.path.join(self.tempdir.name, 'missing.ess')
+        notasave = os.path.join(self.tempdir.name, 'notasave.ess')
+        with open(notasave, 'wb') as f:
+            f.write(b'nope' * 100)
+        targets = [missing, self.targets[0], notasave]
+        for workers in (1, 2):
+            done = []
+            results = transfer_face_batch(self.source, targets, workers,
+                                          callback=done.append)
+            self.assertEqual([r.fname for r in results], targets)
+            self.assertEqual(sorted(done), sorted(results))
+            self.assertFalse(any(r.ok for r in results))
+            self.assertIn('Game not recognized', results[2].error)
+
+    def test_transfer(self):
+        # Skyrim faces can't be merged yet, so just keep the target's player
+        merge_player = extract.merge_player
+        extract.merge_player = lambda s, sf, t, tf, game: (t, tf)
+        try:
+            # The same files again, by other names
+            link = os.path.join(self.tempdir.name, 'link.ess')
+            os.symlink(self.targets[1], link)
+            again = [os.path.relpath(self.targets[0]), link]
+            results = transfer_face_batch(self.source, self.targets + again,
+                                          workers=1)
+        finally:
+            extract.merge_player = merge_player
+        self.assertEqual([r.fname for r in results], self.targets)
+        self.assertTrue(all(r.ok for r in results))
+        for fname in self.targets:
+            self.assertEqual(len(UndoJournal(fname).entries()), 1)
+
+    def test_transfer_processes(self):
+        source = os.path.join(self.tempdir.name, 'source.fos')
+        targets = [os.path.join(self.tempdir.name, 'target{}.fos'.format(n))
+                   for n in range(4)]
+        for seed, fname in enumerate([source] + targets):
+            with open(fname, 'wb') as f:
+                gensave.write_save(f, gensave.SaveSpec(seed=seed))
+        results = transfer_face_batch(source, targets, workers=2)
+        self.assertEqual([r.fname for r in results], targets)
+        self.assertTrue(all(r.ok for r in results), results)
+        facekeys = [key for _, key, args in extract.playerlayouts['fallout4']
+                    if args.get('flag') in FACEFLAGS]
+        with SaveFile(source) as save:
+            face = {key: bytes(value) if isinstance(value, memoryview) else value
+                    for key, value in save.player.items() if key in facekeys}
+        self.assertTrue(face)
+        for fname in targets:
+            with SaveFile(fname) as save:
+                for key, value in face.items():
+                    self.assertEqual(save.player[key], value, key)
+            self.assertEqual(len(UndoJournal(fname).entries()), 1)
+
+    def test_dead_worker(self):
+        results = transfer_face_batch(self.source, self.targets, workers=2,
+                                      compression=_KillWorker())
+        self.assertEqual([r.fname for r in results], self.targets)
+        self.assertFalse(any(r.ok for r in results))
+        self.assertIn('worker process died', results[0].error)
+
+
+class _KillWorker:
+    """ Kills the worker process that unpickles it. """
+    def __reduce__(self):
+        return (os._exit, (1,))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import copy
+import os
+import tempfile
+import unittest
+
+import bench
+import gensave
+from test_extract import bundled_saves
+
+
+class BenchTest(unittest.TestCase):
+
+    def test_run_and_compare(self):
+        results = bench.run(bundled_saves()[:1], repeat=1,
+                            only=['parse_savedata', 'encode_player'])
+        self.assertEqual([r['benchmark'] for r in results['results']],
+                         ['parse_savedata', 'encode_player'])
+        for result in results['results']:
+            self.assertGreater(result['bytes'], 0)
+            self.assertGreater(result['peakmemory'], 0)
+            self.assertGreater(result['mbps'], 0)
+        self.assertEqual(bench.compare(results, results), [])
+        slower = copy.deepcopy(results)
+        slower['results'][0]['best'] *= 2
+        slower['results'][1]['peakmemory'] *= 1.1
+        regressions = bench.compare(slower, results, threshold=0.15)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('parse_savedata', regressions[0])
+
+    def test_transfer_face(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = os.path.join(tempdir, 'target.fos')
+            with open(fname, 'wb') as f:
+                gensave.write_save(f, gensave.SaveSpec(changeforms=50))
+            results = bench.run([fname], repeat=1, only=['transfer_face'])
+        self.assertEqual([r['benchmark'] for r in results['results']],
+                         ['transfer_face'])
+
+
+if __name__ == '__main__':
+    unittest.main()
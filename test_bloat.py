@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+import bloat
+from changeforms import ChangeFormIndex, numpy
+import gensave
+from savefile import SaveFile
+from test_extract import bundled_saves
+
+
+class BloatTest(unittest.TestCase):
+
+    def test_totals(self):
+        for fname in bundled_saves():
+            with SaveFile(fname) as save:
+                index = save.cfindex
+                report = bloat.bloat_report(index, save.game, top=10)
+                tablesize = len(save['changeforms'])
+            records = list(index)
+            self.assertEqual(report.count, len(records))
+            self.assertEqual(sum(t.count for t in report.types), len(records))
+            # Every record is counted, so together they're the whole table
+            self.assertEqual(report.size, tablesize)
+            self.assertEqual(report.compressed,
+                             sum(bool(r.uncompressedlength) for r in records))
+            self.assertEqual(report.uncompressedlength,
+                             sum(r.uncompressedlength for r in records))
+            # Biggest types first
+            sizes = [t.size for t in report.types]
+            self.assertEqual(sizes, sorted(sizes, reverse=True))
+            for t in report.types:
+                self.assertEqual(t.percentiles, sorted(t.percentiles))
+                self.assertLessEqual(t.percentiles[-1], t.largest)
+            # The biggest records, biggest first
+            recordsizes = sorted((r.dataoffset - r.offset + r.reallength
+                                  for r in records), reverse=True)
+            self.assertEqual([r.dataoffset - r.offset + r.reallength
+                              for r in report.biggest], recordsizes[:10])
+            self.assertIn('Biggest records', bloat.format_bloat_report(report))
+
+    def test_percentiles(self):
+        sizes = list(range(1, 101))
+        self.assertEqual([bloat._percentile(sizes, 0, 100, p) for p in (50, 90, 99)],
+                         [50, 90, 99])
+        self.assertEqual(bloat._percentile([7], 0, 1, 50), 7)
+        self.assertEqual(bloat._percentile([0, 1, 2, 3], 1, 2, 50), 1)
+
+    def test_generated(self):
+        spec = gensave.SaveSpec(game='skyrim', changeforms=300, compressed=0)
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = os.path.join(tempdir, 'save.ess')
+            with open(fname, 'wb') as f:
+                gensave.write_save(f, spec)
+            with SaveFile(fname) as save:
+                report = bloat.bloat_report(save.cfindex, save.game)
+        # Only the player is compressed
+        self.assertEqual(report.compressed, 1)
+        self.assertEqual(report.count, spec.changeforms + 1)
+        self.assertEqual(len(report.biggest), bloat.TOP)
+
+    def test_empty(self):
+        report = bloat.bloat_report(ChangeFormIndex())
+        self.assertEqual((report.count, report.size, report.types, report.biggest),
+                         (0, 0, [], []))
+        self.assertIsNone(report.ratio)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_numpy(self):
+        with SaveFile(bundled_saves()[0]) as save:
+            index = save.cfindex
+        table = index.table()
+        self.assertEqual(len(table), len(index))
+        self.assertEqual(tuple(table[5]), tuple(index.record(5)))
+        self.assertEqual(bloat._numpy_stats(index, 10), bloat._python_stats(index, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
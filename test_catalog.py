@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from catalog import SaveCatalog
+import facetransfer
+from test_extract import bundled_saves
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.savedir = os.path.join(self.tempdir.name, 'saves')
+        os.mkdir(self.savedir)
+        for fname in bundled_saves():
+            shutil.copy(fname, self.savedir)
+        with open(os.path.join(self.savedir, 'broken.ess'), 'wb') as f:
+            f.write(b'nope')
+        with open(os.path.join(self.savedir, 'notes.txt'), 'wb') as f:
+            f.write(b'not a save')
+        self.catalog = SaveCatalog(os.path.join(self.tempdir.name, 'catalog.db'))
+
+    def tearDown(self):
+        self.catalog.close()
+        self.tempdir.cleanup()
+
+    def test_scan(self):
+        count = len(bundled_saves())
+        for workers in (1, 2):
+            self.catalog.db.execute('DELETE FROM saves')
+            result = self.catalog.scan(self.savedir, workers, chunksize=1)
+            self.assertEqual(result, (count + 1, 0, 0, 0))
+        entries = self.catalog.find(self.savedir, orderby='savenumber',
+                                    descending=False)
+        self.assertEqual(len(entries), count)
+        for entry, fname in zip(entries, bundled_saves()):
+            self.assertEqual(os.path.basename(entry.path), os.path.basename(fname))
+            uidata, game = facetransfer.get_ui_data(fname)
+            self.assertEqual(entry.game, game)
+            self.assertEqual(entry.savenumber, uidata['save number'])
+            self.assertEqual(entry.name, uidata['name'])
+            self.assertEqual(entry.race, uidata['race'])
+            self.assertEqual(entry.gender, uidata['gender'])
+            self.assertEqual(entry.playingtime, uidata['playing time'])
+        broken = self.catalog.get(os.path.join(self.savedir, 'broken.ess'))
+        self.assertIn('Game not recognized', broken.error)
+        self.assertEqual(len(self.catalog.find(error=True)), count + 1)
+        self.assertEqual([e.name for e in self.catalog.find(name='lolw')], ['Lolwut'])
+
+    def test_rescan(self):
+        self.catalog.scan(self.savedir, workers=1)
+        self.assertEqual(self.catalog.scan(self.savedir, workers=1),
+                         (0, 0, 0, len(bundled_saves()) + 1))
+        first, second = [os.path.join(self.savedir, os.path.basename(fname))
+                         for fname in bundled_saves()[:2]]
+        os.remove(first)
+        with open(second, 'ab') as f:
+            f.write(b'more')
+        self.assertEqual(self.catalog.scan(self.savedir, workers=1),
+                         (0, 1, 1, len(bundled_saves()) - 1))
+        self.assertIsNone(self.catalog.get(first))
+        self.assertEqual(self.catalog.get(second).size, os.path.getsize(second))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+
+from changeforms import BodyCache, bodycache, ChangeFormIndex
+from changeforms import decompress_all, find_changeforms
+from common import GameError
+import extract
+from savefile import SaveFile
+from test_extract import bundled_saves
+
+
+def bundled_changeforms():
+    """ Yield the save data dict of every bundled save. """
+    for fname in bundled_saves():
+        with open(fname, 'rb') as f:
+            yield extract.parse_savedata(f.read(), zerocopy=True)[1]
+
+
+class ChangeFormIndexTest(unittest.TestCase):
+
+    def test_index(self):
+        for data in bundled_changeforms():
+            index = ChangeFormIndex.build(data['changeforms'],
+                                          data['changeformcount'])
+            self.assertEqual(len(index), data['changeformcount'])
+            last = index.record(len(index) - 1)
+            self.assertEqual(last.dataoffset + last.reallength,
+                             len(data['changeforms']))
+            player = index.find(extract.default_refid(7))
+            cf = extract.parse_changeforms(data['changeforms'])
+            self.assertEqual(player.offset, len(cf['changeformshead']))
+            self.assertEqual(extract.flagset(player.changeflags),
+                             cf['playerchangeflags'])
+            self.assertEqual(player.reallength, cf['playerreallength'])
+
+    def test_parse_changeforms_with_index(self):
+        for data in bundled_changeforms():
+            index = ChangeFormIndex.build(data['changeforms'])
+            for refidnr in (7, 0x14):
+                self.assertEqual(
+                    extract.parse_changeforms(data['changeforms'], refidnr),
+                    extract.parse_changeforms(data['changeforms'], refidnr,
+                                              index=index))
+
+    def test_missing_refid(self):
+        for data in bundled_changeforms():
+            index = ChangeFormIndex.build(data['changeforms'])
+            refid = extract.default_refid(0x3fffff)
+            self.assertNotIn(refid, index)
+            self.assertRaises(GameError, index.find, refid)
+            self.assertRaises(GameError, extract.parse_changeforms,
+                              data['changeforms'], 0x3fffff)
+
+    def test_find_changeforms(self):
+        refids = [extract.default_refid(0x14), extract.default_refid(7)]
+        for data in bundled_changeforms():
+            table = data['changeforms']
+            index = ChangeFormIndex.build(table)
+            found = find_changeforms(table, refids)
+            selected = index.select(table, refids)
+            self.assertEqual([cf.record for cf in found],
+                             [cf.record for cf in selected])
+            # File order, not the order they were asked for
+            self.assertEqual([cf.refid for cf in found], sorted(refids))
+            for cf in found:
+                self.assertIsNone(cf._data)
+                old = extract.parse_changeforms(table, cf.refid & 0x3fffff)
+                self.assertEqual(cf.data, old['playerdata'])
+                self.assertEqual(cf.flags, old['playerchangeflags'])
+
+    def test_find_changeforms_predicate(self):
+        for data in bundled_changeforms():
+            table = data['changeforms']
+            index = ChangeFormIndex.build(table)
+            def istype1(refid, changeflags, cftype):
+                return cftype == 1
+            found = find_changeforms(table, predicate=istype1)
+            self.assertEqual([cf.record for cf in found],
+                             [r for r in index if r.cftype == 1])
+            self.assertEqual([cf.record for cf in found],
+                             [cf.record for cf in index.select(table, predicate=istype1)])
+
+    def test_decompress_all(self):
+        for data in bundled_changeforms():
+            table = data['changeforms']
+            index = ChangeFormIndex.build(table)
+            serial = decompress_all(table, index, workers=1)
+            self.assertEqual(len(serial), len(index))
+            self.assertEqual(serial, decompress_all(table, index, workers=4,
+                                                    batchsize=100))
+            for cf in find_changeforms(table, predicate=lambda *args: True)[:200]:
+                self.assertEqual(cf.data, serial[index.row_of(cf.refid)])
+                if cf.uncompressedlength:
+                    self.assertEqual(len(cf.data), cf.uncompressedlength)
+
+    def test_truncated(self):
+        for data in bundled_changeforms():
+            self.assertRaises(GameError, ChangeFormIndex.build,
+                              data['changeforms'][:-1])
+
+
+class BodyCacheTest(unittest.TestCase):
+
+    def test_byte_budget(self):
+        cache = BodyCache(maxbytes=10)
+        self.assertEqual(cache.get('a', lambda: b'aaaa'), b'aaaa')
+        self.assertEqual(cache.get('b', lambda: b'bbbb'), b'bbbb')
+        self.assertEqual(cache.get('a', lambda: b'new!'), b'aaaa')
+        # b is the least recently used one and has to go
+        cache.get('c', lambda: b'cccc')
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.get('b', lambda: b'BBBB'), b'BBBB')
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+        # Too big to be cached at all
+        cache.get('d', lambda: b'd' * 11)
+        self.assertLessEqual(cache.size, 10)
+        self.assertEqual(cache.get('d', lambda: b'x'), b'x')
+
+    def test_shared_between_saves(self):
+        fname = bundled_saves()[0]
+        bodycache.clear()
+        with SaveFile(fname) as save:
+            compressed = save.cfindex.find(extract.default_refid(7)).uncompressedlength
+            player1 = save.changeform()['playerdata']
+        with SaveFile(fname) as save:
+            player2 = save.changeform()['playerdata']
+        self.assertEqual(player1, player2)
+        if compressed:
+            self.assertEqual(bodycache.stats()['hits'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,21 @@
+import collections
+import io
 import itertools
 import os
 import os.path
+import tempfile
 import unittest
 
 import extract
 
 
+def bundled_saves():
+    """ Return the paths of the save files bundled in testdata. """
+    root = os.path.join('testdata', 'test_extract_data')
+    return sorted(os.path.join(root, fname) for fname in os.listdir(root)
+                  if os.path.splitext(fname)[1] in ('.ess', '.fos'))
+
+
 class ExtractionTest(unittest.TestCase):
 
     def test_uint8(self):
@@ -93,6 +103,121 @@ class ExtractionTest(unittest.TestCase):
         self.assertEqual(val, decval)
         self.assertEqual(4, len(encval))
 
+    def test_compiled_layout_fuses_fixed_fields(self):
+        plan = extract.compile_layout(extract.mainlayout, 'skyrim')
+        self.assertIs(plan, extract.compile_layout(extract.mainlayout, 'skyrim'))
+        self.assertEqual(plan.steps[0].keys,
+                         ['magic', 'headersize', 'version', 'savenumber'])
+
+    def test_compiled_layout_encode_any_order(self):
+        layout = [(extract.uint32, 'a', {}), (extract.uint8, 'b', {}),
+                  (extract.wstring, 'c', {})]
+        plan = extract.compile_layout(layout, 'skyrim')
+        rawdata = extract.encode_uint32(5) + extract.encode_uint8(2) \
+                + extract.encode_wstring('abc')
+        i, data = plan.decode(rawdata)
+        self.assertEqual(i, len(rawdata))
+        self.assertEqual(list(data.items()), [('a', 5), ('b', 2), ('c', 'abc')])
+        self.assertEqual(plan.encode(data), rawdata)
+        reordered = collections.OrderedDict([('c', 'abc'), ('a', 5)])
+        self.assertEqual(plan.encode(reordered),
+                         extract.encode_wstring('abc') + extract.encode_uint32(5))
+
+    def test_decode_and_encode_testdata(self):
+        for fname in bundled_saves():
+            with open(fname, 'rb') as f:
+                rawdata = f.read()
+            game, data = extract.parse_savedata(rawdata)
+            self.assertEqual(rawdata, extract.encode_savedata(data))
+            cf = extract.parse_changeforms(data['changeforms'])
+            self.assertEqual(data['changeforms'], extract.encode_changeforms(cf))
+            player = extract.parse_player(cf['playerdata'],
+                                          cf['playerchangeflags'], game)
+            self.assertEqual(cf['playerdata'], extract.encode_player(player, game))
+
+    def test_decode_and_encode_zerocopy(self):
+        for fname in bundled_saves():
+            with open(fname, 'rb') as f:
+                rawdata = f.read()
+            game, data = extract.parse_savedata(rawdata, zerocopy=True)
+            self.assertIsInstance(data['screenshotdata'], memoryview)
+            self.assertIsInstance(data['changeforms'], memoryview)
+            cf = extract.parse_changeforms(data['changeforms'])
+            self.assertIsInstance(cf['changeformstail'], memoryview)
+            data['changeforms'] = extract.encode_changeforms(cf)
+            self.assertEqual(rawdata, extract.encode_savedata(data))
+
+    def test_parse_header(self):
+        for fname in bundled_saves():
+            with open(fname, 'rb') as f:
+                rawdata = f.read()
+                f.seek(0)
+                game, header = extract.parse_header(f)
+                end = f.tell()
+            _, data = extract.parse_savedata(rawdata)
+            self.assertEqual(list(header), list(data)[:len(header)])
+            self.assertEqual(list(header)[-1], 'screenshotdata')
+            for key, value in header.items():
+                self.assertEqual(value, data[key])
+            self.assertEqual(rawdata[:end], extract.encode_savedata(data)[:end])
+            self.assertLess(end, data['changeformsoffset'])
+            with open(fname, 'rb') as f:
+                _, shortheader = extract.parse_header(f, screenshot=False)
+                self.assertEqual(f.tell(), end - len(header['screenshotdata']))
+            self.assertEqual(list(shortheader)[-1], 'shotheight')
+            del header['screenshotdata']
+            self.assertEqual(shortheader, header)
+
+    def test_write_segments(self):
+        segments = [bytes([n % 256]) * (n % 7) for n in range(5000)]
+        # A BytesIO has no file descriptor to do vectored writes with
+        for f in (tempfile.TemporaryFile(), io.BytesIO()):
+            with self.subTest(f=type(f).__name__), f:
+                f.write(b'head')
+                written = extract.write_segments(f, segments)
+                f.write(b'tail')
+                f.seek(0)
+                self.assertEqual(f.read(), b'head' + b''.join(segments) + b'tail')
+                self.assertEqual(written, len(b''.join(segments)))
+
+    def test_decode_and_encode_segments(self):
+        for fname in bundled_saves():
+            with open(fname, 'rb') as f:
+                rawdata = f.read()
+            _, data = extract.parse_savedata(rawdata, zerocopy=True)
+            cf = extract.parse_changeforms(data['changeforms'])
+            data['changeforms'] = extract.encode_changeforms_segments(cf)
+            segments = extract.encode_savedata_segments(data)
+            self.assertIsInstance(segments[-1], memoryview)
+            self.assertEqual(rawdata, b''.join(segments))
+
+    def test_compression_strategy(self):
+        for fname in bundled_saves():
+            with open(fname, 'rb') as f:
+                rawdata = f.read()
+            _, data = extract.parse_savedata(rawdata, zerocopy=True)
+            cf = extract.parse_changeforms(data['changeforms'])
+            self.assertTrue(cf['playeruncompressedlength'])
+            # Unchanged data is passed through
+            compression = extract.CompressionStrategy(level=1)
+            self.assertEqual(data['changeforms'],
+                             extract.encode_changeforms(cf, compression))
+            self.assertTrue(compression.stats[0].passthrough)
+            # Changed data is compressed with the chosen level
+            changed = dict(cf, playerdata=bytes(cf['playerdata']) + b'!')
+            for level in (0, 1, 9):
+                compression = extract.CompressionStrategy(level=level)
+                newcf = extract.parse_changeforms(
+                    extract.encode_changeforms(changed, compression))
+                self.assertEqual(newcf['playerdata'], changed['playerdata'])
+                stat = compression.stats[0]
+                self.assertFalse(stat.passthrough)
+                self.assertEqual(stat.rawsize, len(changed['playerdata']))
+                self.assertEqual(stat.compressedsize, newcf['playerreallength'])
+                self.assertEqual(stat.refid, extract.default_refid(7))
+                if level == 0:
+                    self.assertGreater(stat.ratio, 1)
+
     def decode_and_encode(self, root):
         for path, _, fnames in os.walk(root):
             for fname in fnames:
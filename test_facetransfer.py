@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import tempfile
+import unittest
+
+import facetransfer
+from facetransfer import apply_face, Cancelled, extract_face, Job, load_save
+from savefile import SaveFile
+from test_extract import bundled_saves
+
+
+class JobTest(unittest.TestCase):
+
+    def test_load_save(self):
+        fname = bundled_saves()[0]
+        with ThreadPoolExecutor(2) as executor:
+            jobs = [Job(lambda job, withface=withface: load_save(job, fname, withface))
+                    for withface in (False, True)]
+            for job in jobs:
+                job.future = executor.submit(job.run)
+            results = [job.future.result() for job in jobs]
+        for game, header, thumbnail, face in results:
+            self.assertEqual(game, 'skyrim')
+            self.assertNotIn('screenshotdata', header)
+            self.assertTrue(thumbnail.startswith(b'P6\n'))
+            # Only Fallout 4 faces are read
+            self.assertIsNone(face)
+
+    def test_cancel(self):
+        fname = bundled_saves()[0]
+        with tempfile.TemporaryDirectory() as tempdir:
+            target = os.path.join(tempdir, 'target.ess')
+            shutil.copy(fname, target)
+            with SaveFile(fname) as source:
+                face = extract_face(source)
+            steps = []
+
+            def checkpoint(status):
+                steps.append(status)
+                if status == 'Writing the target':
+                    raise Cancelled()
+            # Skyrim faces can't be merged yet, so just keep the target's player
+            merge_player = facetransfer.extract.merge_player
+            facetransfer.extract.merge_player = lambda s, sf, t, tf, game: (t, tf)
+            try:
+                self.assertRaises(Cancelled, apply_face, face, target,
+                                  checkpoint=checkpoint)
+            finally:
+                facetransfer.extract.merge_player = merge_player
+            self.assertEqual(steps, ['Checking the target', 'Merging the face',
+                                     'Writing the target'])
+            self.assertEqual(os.listdir(tempdir), ['target.ess'])
+        job = Job(lambda job: job.step('never'))
+        with ThreadPoolExecutor(1) as executor:
+            job.future = executor.submit(lambda: None)
+            job.cancel()
+        self.assertTrue(job.cancelled)
+        self.assertRaises(Cancelled, job.run)
+
+
+if __name__ == '__main__':
+    unittest.main()
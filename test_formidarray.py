@@ -0,0 +1,76 @@
+from array import array
+import os
+import tempfile
+import unittest
+
+from common import GameError
+import formidarray
+from formidarray import FormIDArray
+import gensave
+from savefile import SaveFile
+from test_extract import bundled_saves
+
+
+class FormIDArrayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.formids = FormIDArray(array('I', [0x01000800, 0x02000123, 0x0500abcd]).tobytes())
+
+    def test_resolve(self):
+        self.assertEqual(self.formids.resolve(0), 0)
+        self.assertEqual(self.formids.resolve(2), 0x02000123)
+        self.assertEqual(self.formids.resolve(0x400007), 7)
+        self.assertEqual(self.formids.resolve(0x800010), 0xff000010)
+        with self.assertRaises(GameError):
+            self.formids.resolve(4)
+        with self.assertRaises(GameError):
+            self.formids.resolve(0xc00001)
+
+    def test_runs(self):
+        refids = [0, 3, 0x400014, 0x812345, 1, 2]
+        run = b''.join(r.to_bytes(3, 'big') for r in refids)
+        expected = [self.formids.resolve(r) for r in refids]
+        self.assertEqual(list(self.formids.resolve_run(run)), expected)
+        self.assertEqual(list(self.formids.resolve_refids(refids)), expected)
+        self.assertEqual(self.formids.encode_run(expected), run)
+        self.assertEqual(list(self.formids.resolve_run(b'')), [])
+        for bad in (b'\x00\x00\x04', b'\xc0\x00\x01', b'\x00\x00'):
+            with self.assertRaises(GameError):
+                self.formids.resolve_run(bad)
+
+    def test_reverse(self):
+        self.assertEqual(self.formids.indexes,
+                         {0x01000800: 1, 0x02000123: 2, 0x0500abcd: 3})
+        self.assertEqual(self.formids.refid_of(0x0500abcd), 3)
+        self.assertEqual(self.formids.refid_of(0x14), 0x400014)
+        with self.assertRaises(GameError):
+            self.formids.refid_of(0x06000001)
+        # Created forms round-trip as long as they fit in 22 bits
+        for formid in (0xff000000, 0xff000001, 0xff3fffff):
+            self.assertEqual(self.formids.resolve(self.formids.refid_of(formid)), formid)
+        with self.assertRaises(GameError):
+            self.formids.refid_of(0xff400000)
+        with self.assertRaises(GameError):
+            self.formids.encode_run([0x14, 0xffffffff])
+
+    def test_saves(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            generated = os.path.join(tempdir, 'save.fos')
+            with open(generated, 'wb') as f:
+                gensave.write_save(f, gensave.SaveSpec(seed=4))
+            for fname in bundled_saves() + [generated]:
+                with SaveFile(fname) as save:
+                    formids = FormIDArray(save['formidarray'])
+                    refids = save.cfindex.refids
+                    self.assertEqual(list(formids.resolve_refids(refids)),
+                                     [formids.resolve(r) for r in refids])
+                    resolved = formids.resolve_player(save.player, save.game)
+                    self.assertEqual(set(resolved), set(formidarray.refid_fields(save.game))
+                                     & set(save.player))
+                    for key, run in resolved.items():
+                        self.assertEqual(formids.encode_run(run), bytes(save.player[key]))
+                    del formids
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+
+import extract
+import facetransfer
+import gensave
+from savefile import SaveFile
+
+
+class GenSaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def generate(self, name, spec):
+        fname = os.path.join(self.tempdir.name, name)
+        with open(fname, 'wb') as f:
+            size = gensave.write_save(f, spec)
+        self.assertEqual(os.path.getsize(fname), size)
+        return fname
+
+    def test_roundtrip(self):
+        for game in ('skyrim', 'fallout4'):
+            for position in (0, 0.5, 1):
+                with self.subTest(game=game, position=position):
+                    spec = gensave.SaveSpec(game=game, changeforms=50,
+                                            playerposition=position, seed=3)
+                    fname = self.generate('save.' + game, spec)
+                    with open(fname, 'rb') as f:
+                        rawdata = f.read()
+                    parsedgame, data = extract.parse_savedata(rawdata)
+                    self.assertEqual(parsedgame, game)
+                    self.assertEqual(extract.encode_savedata(data), rawdata)
+                    cfdata = extract.parse_changeforms(data['changeforms'])
+                    self.assertEqual(extract.encode_changeforms(cfdata),
+                                     data['changeforms'])
+                    player = extract.parse_player(cfdata['playerdata'],
+                                                  cfdata['playerchangeflags'], game)
+                    self.assertEqual(player['name'], spec.playername)
+
+    def test_big_records(self):
+        # Records this big need 32-bit lengths
+        spec = gensave.SaveSpec(changeforms=5, recordsize=100000, compressed=0)
+        fname = self.generate('big.fos', spec)
+        with open(fname, 'rb') as f:
+            rawdata = f.read()
+        _, data = extract.parse_savedata(rawdata)
+        self.assertEqual(extract.encode_savedata(data), rawdata)
+
+    def test_savefile(self):
+        spec = gensave.SaveSpec(changeforms=200, seed=1)
+        fname = self.generate('save.fos', spec)
+        with SaveFile(fname) as save:
+            self.assertEqual(save.game, 'fallout4')
+            self.assertEqual(len(save.cfindex), spec.changeforms + 1)
+            self.assertIn(extract.default_refid(7), save.cfindex)
+            self.assertEqual(save.player['name'], spec.playername)
+
+    def test_spec_for_size(self):
+        target = 2 * 1000 * 1000
+        for compressed in (0, 0.5, 1):
+            with self.subTest(compressed=compressed):
+                spec = gensave.spec_for_size(target, compressed=compressed, seed=1)
+                size = os.path.getsize(self.generate('sized.fos', spec))
+                self.assertAlmostEqual(size, target, delta=target * 0.1)
+
+    def test_transfer(self):
+        source = self.generate('source.fos', gensave.SaveSpec(seed=1))
+        target = self.generate('target.fos', gensave.SaveSpec(seed=2))
+        facetransfer.transfer_face(source, target)
+        with SaveFile(source) as sourcesave, SaveFile(target) as targetsave:
+            self.assertEqual(targetsave.player['facesliders'],
+                             sourcesave.player['facesliders'])
+            self.assertNotEqual(targetsave['savenumber'], sourcesave['savenumber'])
+
+
+if __name__ == '__main__':
+    unittest.main()
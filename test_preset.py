@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+from common import FaceTransferException, GameError
+from facetransfer import extract_face
+import preset
+from savefile import SaveFile
+from test_extract import bundled_saves
+
+
+class PresetTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        for fname in bundled_saves():
+            with SaveFile(fname) as save:
+                face = extract_face(save)
+            rawdata = preset.encode_preset(face)
+            # Way smaller than the save itself
+            self.assertLess(len(rawdata), 1000)
+            newface = preset.decode_preset(rawdata)
+            for key in ('game', 'playersex', 'playerraceeditorid'):
+                self.assertEqual(newface[key], face[key])
+            self.assertEqual(newface['playerchangeflags'],
+                             face['playerchangeflags'] & set(preset.FACEFLAGS))
+            self.assertTrue(newface['player'])
+            for key, value in newface['player'].items():
+                self.assertEqual(value, face['player'][key])
+            # Nothing but the face is kept
+            self.assertNotIn('name', newface['player'])
+
+    def test_files(self):
+        fname = bundled_saves()[0]
+        with tempfile.TemporaryDirectory() as tempdir:
+            presetfname = os.path.join(tempdir, 'face.ftp')
+            preset.export_preset(fname, presetfname)
+            self.assertTrue(preset.is_preset(presetfname))
+            self.assertFalse(preset.is_preset(fname))
+            self.assertEqual(preset.load_face(presetfname),
+                             preset.load_preset(presetfname))
+            self.assertEqual(preset.load_face(fname)['player']['headparts'],
+                             preset.load_preset(presetfname)['player']['headparts'])
+
+    def test_bad_presets(self):
+        with SaveFile(bundled_saves()[0]) as save:
+            rawdata = preset.encode_preset(extract_face(save))
+        self.assertRaises(GameError, preset.decode_preset, b'nope' + rawdata)
+        self.assertRaises(FaceTransferException, preset.decode_preset, rawdata[:-3])
+        self.assertRaises(FaceTransferException, preset.decode_preset, rawdata + b'x')
+        newer = bytearray(rawdata)
+        newer[len(preset.MAGIC)] += 1
+        self.assertRaises(FaceTransferException, preset.decode_preset, bytes(newer))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+from common import FaceTransferException
+import preset
+from presetpack import PresetPack, write_pack
+from test_extract import bundled_saves
+
+
+class PresetPackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tempdir.name, 'faces.ftpack')
+        self.faces = [preset.load_face(fname) for fname in bundled_saves()]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_pack(self):
+        # Lots of names to get some hash collisions going
+        presets = [('face {} åäö'.format(n), self.faces[n % len(self.faces)])
+                   for n in range(500)]
+        self.assertEqual(write_pack(self.fname, presets), len(presets))
+        with PresetPack(self.fname) as pack:
+            self.assertEqual(len(pack), len(presets))
+            self.assertEqual([e.name for e in pack], [n for n, _ in presets])
+            for name, face in presets:
+                entry = pack.find(name)
+                self.assertEqual(entry.name, name)
+                self.assertEqual(entry.game, face['game'])
+                self.assertEqual(entry.race, face['playerraceeditorid'])
+                self.assertEqual(entry.sex, face['playersex'])
+                self.assertEqual(pack.raw(name), preset.encode_preset(face))
+            self.assertEqual(pack.load('face 1 åäö'),
+                             preset.decode_preset(preset.encode_preset(self.faces[1])))
+            self.assertNotIn('face 500 åäö', pack)
+            self.assertRaises(KeyError, pack.load, 'nope')
+
+    def test_errors(self):
+        face = self.faces[0]
+        self.assertRaises(FaceTransferException, write_pack, self.fname,
+                          [('a', face), ('a', face)])
+        write_pack(self.fname, [])
+        with PresetPack(self.fname) as pack:
+            self.assertEqual(len(pack), 0)
+            self.assertIsNone(pack.find('a'))
+        self.assertRaises(FaceTransferException, PresetPack, bundled_saves()[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import pstats
+import tempfile
+import threading
+import unittest
+
+import profiling
+from savefile import SaveFile
+from test_extract import bundled_saves
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def test_profile(self):
+        fname = os.path.join(self.tempdir.name, 'load.prof')
+        with profiling.Profile(fname, cpu=True, memory=True, top=5) as profile:
+            with SaveFile(bundled_saves()[0]) as save:
+                save.player
+        # The stats can be loaded by pstats and include the parsing
+        stats = pstats.Stats(fname)
+        self.assertTrue(any(func[2] == 'parse_player' for func in stats.stats))
+        with open(profile.summaryfname) as f:
+            self.assertEqual(f.read(), profile.report + '\n')
+        self.assertIn('functions by cumulative time', profile.report)
+        self.assertIn('allocation sites', profile.report)
+
+    def test_memory_only(self):
+        fname = os.path.join(self.tempdir.name, 'memory.prof')
+        with profiling.Profile(fname, cpu=False, memory=True) as profile:
+            data = [bytearray(1000) for _ in range(100)]
+        self.assertFalse(os.path.exists(fname))
+        self.assertNotIn('cumulative', profile.report)
+        self.assertIn(__file__, profile.report)
+        del data
+
+    def test_profiler(self):
+        prefix = os.path.join(self.tempdir.name, 'gui')
+        profiler = profiling.Profiler(prefix, echo=False)
+        wrapped = profiler.wrap('load', lambda x: x * 2)
+        self.assertEqual(wrapped(2), 4)
+        self.assertEqual(wrapped(3), 6)
+        self.assertTrue(os.path.exists(prefix + '-001-load.prof'))
+        self.assertTrue(os.path.exists(prefix + '-002-load.prof.txt'))
+        # Errors get through, but the profile is still saved
+        failing = profiler.wrap('fail', lambda: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            failing()
+        self.assertTrue(os.path.exists(prefix + '-003-fail.prof'))
+
+    def test_threads(self):
+        # Jobs on other threads don't get in each other's way
+        prefix = os.path.join(self.tempdir.name, 'job')
+        profiler = profiling.Profiler(prefix, memory=True, echo=False)
+        results = []
+        wrapped = profiler.wrap('job', lambda n: results.append(sum(range(n))))
+        threads = [threading.Thread(target=wrapped, args=(100000,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 4)
+        for n in range(1, 5):
+            self.assertTrue(os.path.exists('{}-{:03}-job.prof'.format(prefix, n)))
+
+    def test_from_environment(self):
+        self.assertIsNone(profiling.from_environment({}))
+        profiler = profiling.from_environment({
+            'FACETRANSFER_PROFILE': 'out',
+            'FACETRANSFER_PROFILE_MODE': 'memory, cpu',
+            'FACETRANSFER_PROFILE_TOP': '10'})
+        self.assertEqual((profiler.prefix, profiler.cpu, profiler.memory, profiler.top),
+                         ('out', True, True, 10))
+        with self.assertRaises(ValueError):
+            profiling.parse_mode('cpu,disk')
+        with self.assertRaises(ValueError):
+            profiling.Profile('x', cpu=False, memory=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
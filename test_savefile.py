@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import extract
+from savefile import SaveFile
+from test_extract import bundled_saves
+
+
+class SaveFileTest(unittest.TestCase):
+
+    def test_lazy_header(self):
+        for fname in bundled_saves():
+            with SaveFile(fname) as save:
+                self.assertTrue(save.playername)
+                # Nothing past the name should have been decoded
+                self.assertNotIn('playerlevel', save.offsets)
+                self.assertEqual(save.offsets['playername'], 25)
+
+    def test_to_dict_matches_parse_savedata(self):
+        for fname in bundled_saves():
+            with open(fname, 'rb') as f:
+                rawdata = f.read()
+            game, data = extract.parse_savedata(rawdata)
+            with SaveFile(fname) as save:
+                self.assertEqual(game, save.game)
+                savedata = save.to_dict()
+                self.assertEqual(list(data), list(savedata))
+                self.assertEqual(rawdata, extract.encode_savedata(savedata))
+                self.assertEqual(save.changeformsoffset,
+                                 save.offsets['changeforms'])
+                del savedata
+
+    def test_player(self):
+        for fname in bundled_saves():
+            with open(fname, 'rb') as f:
+                rawdata = f.read()
+            game, data = extract.parse_savedata(rawdata)
+            cf = extract.parse_changeforms(data['changeforms'])
+            player = extract.parse_player(cf['playerdata'],
+                                          cf['playerchangeflags'], game)
+            with SaveFile(fname) as save:
+                self.assertEqual(player, save.player)
+                self.assertEqual(cf['playerchangeflags'],
+                                 save.changeform()['playerchangeflags'])
+
+    def test_index_cache(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            cachedir = os.path.join(tempdir, 'cache')
+            fname = os.path.join(tempdir, 'save.ess')
+            shutil.copy(bundled_saves()[0], fname)
+            with SaveFile(fname, cachedir) as save:
+                cf = save.changeform()
+                index = save.cfindex
+                self.assertEqual(len(os.listdir(cachedir)), 1)
+                del cf
+            with SaveFile(fname, cachedir) as save:
+                cf = save.changeform()
+                # Straight from the cache, without decoding the header
+                self.assertEqual(save.offsets, {})
+                self.assertEqual(list(save.cfindex.columns()),
+                                 list(index.columns()))
+                self.assertEqual(save.player['name'], save.playername)
+                del cf
+            # A changed file shouldn't use the old entry
+            stat = os.stat(fname)
+            os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            with SaveFile(fname, cachedir) as save:
+                save.changeform()
+                self.assertIn('changeforms', save.offsets)
+
+
+if __name__ == '__main__':
+    unittest.main()
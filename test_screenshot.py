@@ -0,0 +1,61 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import extract
+import screenshot
+from test_extract import bundled_saves
+
+
+def slow_halve(rgb, width, height):
+    """ The old way of doing it, one pixel at a time. """
+    rows = list(zip(*[iter(rgb)]*width*3))
+    out = []
+    for y in range(0, height - 1, 2):
+        for x in range(0, (width // 2) * 6, 6):
+            for n in [0, 1, 2]:
+                out.append(int((rows[y][x+n] + rows[y][x+n+3]
+                                + rows[y+1][x+n] + rows[y+1][x+n+3]) / 4))
+    return bytes(out)
+
+
+class ScreenshotTest(unittest.TestCase):
+
+    def test_rgba_to_rgb(self):
+        data = bytes(random.randrange(256) for _ in range(4 * 1000))
+        expected = bytes(b for n, b in enumerate(data) if (n + 1) % 4 != 0)
+        self.assertEqual(screenshot.rgba_to_rgb(data), expected)
+
+    def test_halve(self):
+        for width, height in [(8, 6), (7, 5), (64, 48), (1, 3)]:
+            rgb = bytes(random.randrange(256) for _ in range(width * height * 3))
+            # Make sure the lanes can take the biggest values
+            rgb = bytes([255]) * (width * 6) + rgb[width * 6:]
+            newwidth, newheight, data = screenshot.halve(rgb, width, height)
+            self.assertEqual((newwidth, newheight), (width // 2, height // 2))
+            self.assertEqual(data, slow_halve(rgb, width, height))
+
+    def test_thumbnail(self):
+        screenshot.thumbnails.clear()
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = os.path.join(tempdir, 'save.ess')
+            shutil.copy(bundled_saves()[0], fname)
+            with open(fname, 'rb') as f:
+                game, header = extract.parse_header(f)
+            ppm = screenshot.thumbnail(fname)
+            self.assertEqual(ppm, screenshot.to_ppm(header['screenshotdata'],
+                                                    header['shotwidth'],
+                                                    header['shotheight']))
+            self.assertIs(screenshot.thumbnail(fname), ppm)
+            self.assertEqual(screenshot.thumbnails.hits, 1)
+            # A changed save gets a new thumbnail
+            with open(fname, 'ab') as f:
+                f.write(b'x')
+            screenshot.thumbnail(fname)
+            self.assertEqual(screenshot.thumbnails.misses, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
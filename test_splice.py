@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+import extract
+from savefile import SaveFile
+from splice import changeform_patches, write_spliced
+from test_extract import bundled_saves
+
+
+class SpliceTest(unittest.TestCase):
+
+    def test_write_spliced(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            src = os.path.join(tempdir, 'src')
+            dst = os.path.join(tempdir, 'dst')
+            with open(src, 'wb') as f:
+                f.write(bytes(range(256)) * 10000)
+            patches = [(2000000, 2000010, b''), (5, 6, b'abc'),
+                       (100, 100, b'inserted')]
+            size = write_spliced(src, dst, patches)
+            with open(src, 'rb') as f:
+                expected = bytearray(f.read())
+            for start, end, data in sorted(patches, reverse=True):
+                expected[start:end] = data
+            with open(dst, 'rb') as f:
+                self.assertEqual(f.read(), expected)
+            self.assertEqual(size, len(expected))
+            self.assertRaises(ValueError, write_spliced, src, dst,
+                              [(0, 10, b''), (5, 15, b'')])
+
+    def test_changeform_patches(self):
+        for fname in bundled_saves():
+            with open(fname, 'rb') as f:
+                rawdata = f.read()
+            # Make the player record bigger and compare with a full encode
+            _, data = extract.parse_savedata(rawdata)
+            cf = extract.parse_changeforms(data['changeforms'])
+            cf['playerdata'] += bytes(1000)
+            data['changeforms'] = extract.encode_changeforms(cf)
+            expected = extract.encode_savedata(data)
+            with tempfile.TemporaryDirectory() as tempdir:
+                dst = os.path.join(tempdir, 'new.ess')
+                with SaveFile(fname) as save:
+                    newcf = dict(save.changeform())
+                    newcf['playerdata'] += bytes(1000)
+                    patches = changeform_patches(save, newcf)
+                    del newcf
+                self.assertEqual(len(patches), 4)
+                write_spliced(fname, dst, patches)
+                with open(dst, 'rb') as f:
+                    self.assertEqual(f.read(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
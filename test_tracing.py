@@ -0,0 +1,61 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from savefile import SaveFile
+from test_extract import bundled_saves
+import tracing
+
+
+class TracingTest(unittest.TestCase):
+
+    def tearDown(self):
+        tracing.disable()
+        tracing.clear()
+
+    def test_disabled(self):
+        self.assertFalse(tracing.enabled)
+        with tracing.span('nothing', 10) as span:
+            span.add_bytes(5)
+        self.assertEqual(tracing.records(), [])
+
+    def test_spans(self):
+        tracing.enable()
+        with tracing.span('outer', 100, kind='test') as outer:
+            with tracing.span('inner'):
+                sum(range(10000))
+            outer.add_bytes(20)
+        thread = threading.Thread(target=lambda: tracing.span('thread').__enter__().__exit__())
+        thread.start()
+        thread.join()
+        inner, outer, other = tracing.records()
+        self.assertEqual((outer.name, outer.depth, outer.nbytes), ('outer', 0, 120))
+        self.assertEqual((inner.name, inner.depth, inner.nbytes), ('inner', 1, None))
+        self.assertEqual(other.depth, 0)
+        self.assertNotEqual(other.thread, outer.thread)
+        self.assertLessEqual(outer.start, inner.start)
+        self.assertGreaterEqual(outer.wall, inner.wall)
+        self.assertEqual(tracing.summary()['outer']['count'], 1)
+
+    def test_pipeline(self):
+        tracing.enable()
+        with SaveFile(bundled_saves()[0]) as save:
+            save.player
+        names = set(tracing.summary())
+        for name in ('build_cfindex', 'parse_changeforms', 'inflate', 'parse_player'):
+            self.assertIn(name, names)
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = os.path.join(tempdir, 'trace.json')
+            tracing.write_chrome_trace(fname)
+            with open(fname) as f:
+                trace = json.load(f)
+        events = trace['traceEvents']
+        self.assertEqual(len(events), len(tracing.records()))
+        self.assertTrue(all(e['ph'] == 'X' and e['dur'] >= 0 for e in events))
+        self.assertIn('bytes', next(e for e in events if e['name'] == 'inflate')['args'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from common import FaceTransferException
+from savefile import SaveFile
+from splice import changeform_patches
+from test_extract import bundled_saves
+import undo
+from undo import patch_save, UndoJournal
+
+
+def grow_player(fname, extra):
+    """ Make the player's data extra bytes bigger and return the patches. """
+    with SaveFile(fname) as save:
+        cf = dict(save.changeform())
+        cf['playerdata'] += bytes(extra)
+        return changeform_patches(save, cf)
+
+
+class UndoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tempdir.name, 'save.ess')
+        shutil.copy(bundled_saves()[0], self.fname)
+        with open(self.fname, 'rb') as f:
+            self.original = f.read()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def read(self):
+        with open(self.fname, 'rb') as f:
+            return f.read()
+
+    def test_undo_stack(self):
+        patch_save(self.fname, grow_player(self.fname, 100))
+        once = self.read()
+        patch_save(self.fname, grow_player(self.fname, 100000))
+        self.assertNotEqual(self.read(), once)
+        journal = UndoJournal(self.fname)
+        self.assertEqual(len(journal.entries()), 2)
+        # The journal should be a lot smaller than the save
+        self.assertLess(os.path.getsize(journal.path), len(self.original) // 10)
+        journal.undo()
+        self.assertEqual(self.read(), once)
+        journal.undo()
+        self.assertEqual(self.read(), self.original)
+        self.assertFalse(os.path.exists(journal.path))
+        self.assertRaises(FaceTransferException, journal.undo)
+
+    def test_changed_save(self):
+        patch_save(self.fname, grow_player(self.fname, 10))
+        journal = UndoJournal(self.fname)
+        meta, patches, _ = journal.latest()
+        stat = os.stat(self.fname)
+        # Changed anywhere, so the mtime is different
+        with open(self.fname, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'!')
+        os.utime(self.fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertRaises(FaceTransferException, journal.undo)
+        # Changed where the transfer patched it, even with the same mtime
+        with open(self.fname, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(self.original[-1:])
+            f.seek(patches[0][0])
+            f.write(b'!')
+        os.utime(self.fname, ns=(stat.st_atime_ns, meta['newmtime']))
+        self.assertRaises(FaceTransferException, journal.undo)
+
+    def test_failed_replace(self):
+        def fail(src, dst):
+            raise OSError('The save is locked')
+        realreplace = undo.os.replace
+        undo.os.replace = fail
+        try:
+            with self.assertRaises(OSError):
+                patch_save(self.fname, grow_player(self.fname, 10))
+        finally:
+            undo.os.replace = realreplace
+        self.assertEqual(self.read(), self.original)
+        self.assertEqual(os.listdir(self.tempdir.name), ['save.ess'])
+
+    def test_failed_replace_keeps_journal(self):
+        patch_save(self.fname, grow_player(self.fname, 10))
+        once = self.read()
+        journal = UndoJournal(self.fname)
+        with open(journal.path, 'rb') as f:
+            oldjournal = f.read()
+
+        def fail(src, dst):
+            raise OSError('The save is locked')
+        realreplace = undo.os.replace
+        undo.os.replace = fail
+        try:
+            with self.assertRaises(OSError):
+                patch_save(self.fname, grow_player(self.fname, 20))
+        finally:
+            undo.os.replace = realreplace
+        self.assertEqual(self.read(), once)
+        with open(journal.path, 'rb') as f:
+            self.assertEqual(f.read(), oldjournal)
+        journal.undo()
+        self.assertEqual(self.read(), self.original)
+
+    def test_failed_record(self):
+        def fail(*args):
+            raise OSError('The disk is full')
+        realrecord = UndoJournal.record
+        UndoJournal.record = fail
+        try:
+            with self.assertRaises(OSError):
+                patch_save(self.fname, grow_player(self.fname, 10))
+        finally:
+            UndoJournal.record = realrecord
+        self.assertEqual(self.read(), self.original)
+        self.assertEqual(os.listdir(self.tempdir.name), ['save.ess'])
+
+    def test_torn_entry(self):
+        patch_save(self.fname, grow_player(self.fname, 10))
+        once = self.read()
+        journal = UndoJournal(self.fname)
+        with open(journal.path, 'rb') as f:
+            entry = f.read()
+        # A crash while the next entry was being added
+        for torn in (entry[:3], entry[:len(entry) // 2], entry[:-1]):
+            with self.subTest(length=len(torn)):
+                with open(journal.path, 'ab') as f:
+                    f.write(torn)
+                self.assertEqual(len(journal.entries()), 1)
+                with open(journal.path, 'r+b') as f:
+                    f.truncate(len(entry))
+        with open(journal.path, 'ab') as f:
+            f.write(entry[:len(entry) // 2])
+        # The next entry goes where the torn one was
+        patch_save(self.fname, grow_player(self.fname, 20))
+        self.assertEqual(len(journal.entries()), 2)
+        journal.undo()
+        self.assertEqual(self.read(), once)
+        journal.undo()
+        self.assertEqual(self.read(), self.original)
+        self.assertFalse(os.path.exists(journal.path))
+
+    def test_keep(self):
+        patch_save(self.fname, grow_player(self.fname, 1), keep=2)
+        first = self.read()
+        for extra in (2, 3):
+            patch_save(self.fname, grow_player(self.fname, extra), keep=2)
+        journal = UndoJournal(self.fname)
+        self.assertEqual(len(journal.entries()), 2)
+        journal.undo()
+        journal.undo()
+        # The first transfer can't be undone anymore
+        self.assertEqual(self.read(), first)
+        self.assertEqual(journal.entries(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
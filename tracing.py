@@ -0,0 +1,181 @@
+"""
+Lightweight tracing of where the time goes in a transfer. Code marks its
+stages with spans:
+
+    with tracing.span('parse_player', nbytes=len(rawdata)):
+        ...
+
+Every span records its wall time, the CPU time of its thread and how many
+bytes it processed, and spans nest. Tracing is off by default, and then a
+span is a shared do-nothing object, so leaving them in costs next to
+nothing. Turn it on with enable() (or by setting FACETRANSFER_TRACE to a
+file name when running facetransfer.py), then look at summary() or export
+the spans with write_chrome_trace and open them in chrome://tracing or
+Perfetto.
+"""
+
+from collections import OrderedDict
+import functools
+import json
+import os
+import threading
+import time
+
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+
+class SpanRecord(NamedTuple):
+    name: str
+    thread: int
+    # When it started, in nanoseconds (time.perf_counter_ns)
+    start: int
+    wall: int
+    cpu: int
+    nbytes: Optional[int]
+    depth: int
+    args: Dict[str, Any]
+
+
+enabled = False
+_records = [] # type: List[SpanRecord]
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def add_bytes(self, nbytes: int) -> None:
+        pass
+
+
+_nullspan = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'nbytes', 'args', 'start', 'cpustart', 'depth')
+
+    def __init__(self, name: str, nbytes: Optional[int], args: Dict[str, Any]) -> None:
+        self.name = name
+        self.nbytes = nbytes
+        self.args = args
+
+    def add_bytes(self, nbytes: int) -> None:
+        """ Count more bytes as processed by this span. """
+        self.nbytes = (self.nbytes or 0) + nbytes
+
+    def __enter__(self) -> '_Span':
+        self.depth = getattr(_local, 'depth', 0)
+        _local.depth = self.depth + 1
+        self.cpustart = time.thread_time_ns()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args) -> None:
+        wall = time.perf_counter_ns() - self.start
+        cpu = time.thread_time_ns() - self.cpustart
+        _local.depth = self.depth
+        record = SpanRecord(self.name, threading.get_ident(), self.start, wall,
+                            cpu, self.nbytes, self.depth, self.args)
+        with _lock:
+            _records.append(record)
+
+
+def span(name: str, nbytes: int = None, **args: Any):
+    """
+    Return a context manager that records the time spent in it as a span
+    called name, if tracing is enabled. nbytes is how much data the stage
+    processes (it can be added to later with add_bytes) and args are
+    anything else worth knowing about it.
+    """
+    if not enabled:
+        return _nullspan
+    return _Span(name, nbytes, args)
+
+
+def traced(name: str) -> Callable:
+    """ Decorate a function so that every call to it is a span. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Span(name, None, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable() -> None:
+    """ Start tracing, forgetting any spans recorded before. """
+    global enabled
+    clear()
+    enabled = True
+
+
+def disable() -> None:
+    """ Stop tracing. The recorded spans are kept. """
+    global enabled
+    enabled = False
+
+
+def clear() -> None:
+    with _lock:
+        del _records[:]
+
+
+def records() -> List[SpanRecord]:
+    """ Return the finished spans, in the order they finished. """
+    with _lock:
+        return list(_records)
+
+
+def summary() -> Dict[str, Dict[str, Any]]:
+    """
+    Return the totals per span name: how many times it ran, and its total
+    wall and CPU time (in seconds) and bytes.
+    """
+    out = OrderedDict() # type: Dict[str, Dict[str, Any]]
+    for record in sorted(records(), key=lambda r: r.start):
+        total = out.setdefault(record.name, {'count': 0, 'wall': 0.0,
+                                             'cpu': 0.0, 'bytes': 0})
+        total['count'] += 1
+        total['wall'] += record.wall / 1e9
+        total['cpu'] += record.cpu / 1e9
+        total['bytes'] += record.nbytes or 0
+    return out
+
+
+def format_summary() -> str:
+    lines = ['{:<32} {:>6} {:>10} {:>10} {:>12}'.format(
+        'span', 'count', 'wall ms', 'cpu ms', 'bytes')]
+    for name, total in summary().items():
+        lines.append('{:<32} {:>6} {:>10.2f} {:>10.2f} {:>12}'.format(
+            name, total['count'], total['wall'] * 1000, total['cpu'] * 1000,
+            total['bytes']))
+    return '\n'.join(lines)
+
+
+def chrome_trace() -> Dict[str, Any]:
+    """ Return the spans as a Chrome trace-event format dict. """
+    pid = os.getpid()
+    events = []
+    for record in sorted(records(), key=lambda r: r.start):
+        args = dict(record.args, cpu_ms=record.cpu / 1e6)
+        if record.nbytes is not None:
+            args['bytes'] = record.nbytes
+        events.append({'name': record.name, 'ph': 'X', 'pid': pid,
+                       'tid': record.thread, 'ts': record.start / 1000,
+                       'dur': record.wall / 1000, 'args': args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(fname: str) -> None:
+    with open(fname, 'w') as f:
+        json.dump(chrome_trace(), f, default=str)
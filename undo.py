@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+An undo journal for face transfers. Instead of a full backup of the target,
+every transfer adds an entry with only the bytes it replaced (the old
+player changeform and file offsets) to a journal next to the save. Undoing
+a transfer splices those bytes back in.
+
+The journal is a stack of entries, each with its length at the start and
+again in a fixed-size trailer at the end, which is written last. An entry
+without a matching trailer was torn by a crash while it was being added,
+so it's ignored, and written over by the next one.
+"""
+
+from datetime import datetime
+import hashlib
+import json
+import os
+import os.path
+import struct
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from common import FaceTransferException
+from splice import Patch, reverse_patches, write_spliced
+import tracing
+
+
+JOURNALSUFFIX = '.faceundo'
+# How many transfers of one save can be undone by default
+KEEP = 10
+
+_trailer = struct.Struct('<Q4s')
+_trailermagic = b'FTUJ'
+_headerlength = struct.Struct('<I')
+
+
+def journal_path(fname: str) -> str:
+    return fname + JOURNALSUFFIX
+
+
+def range_checksum(fname: str, ranges: List[Tuple[int, int]]) -> str:
+    """
+    Return a hash of the file's size and the bytes in the ranges (start and
+    end offsets) of it. Only the patched parts of a save are hashed, so a
+    transfer doesn't have to read the whole save again.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with tracing.span('checksum') as span, open(fname, 'rb') as f:
+        h.update(struct.pack('<Q', f.seek(0, os.SEEK_END)))
+        for start, end in sorted(ranges):
+            f.seek(start)
+            chunk = f.read(end - start)
+            h.update(struct.pack('<QQ', start, end))
+            h.update(chunk)
+            span.add_bytes(len(chunk))
+    return h.hexdigest()
+
+
+def _ranges(patches: List[Patch]) -> List[Tuple[int, int]]:
+    return [(start, end) for start, end, _ in patches]
+
+
+def _encode_entry(meta: Dict[str, Any], patches: List[Patch]) -> bytes:
+    meta = dict(meta, patches=[(start, end, len(data)) for start, end, data in patches])
+    rawmeta = json.dumps(meta).encode('utf-8')
+    body = b''.join([_headerlength.pack(len(rawmeta)), rawmeta]
+                    + [data for _, _, data in patches])
+    return body + _trailer.pack(len(body), _trailermagic)
+
+
+def _decode_entry(body: bytes) -> Tuple[Dict[str, Any], List[Patch]]:
+    metalength = _headerlength.unpack_from(body)[0]
+    i = _headerlength.size
+    meta = json.loads(body[i:i+metalength].decode('utf-8'))
+    i += metalength
+    patches = []
+    for start, end, datalength in meta.pop('patches'):
+        patches.append((start, end, body[i:i+datalength]))
+        i += datalength
+    return meta, patches
+
+
+class UndoJournal:
+    """
+    The undo journal of one save file.
+    """
+    def __init__(self, fname: str, keep: int = KEEP) -> None:
+        self.fname = fname
+        self.path = journal_path(fname)
+        self.keep = keep
+
+    def _body_end(self, f, start: int, size: int) -> Optional[int]:
+        """
+        Return where the body of the entry that starts at start ends, or
+        None if the entry isn't all there.
+        """
+        f.seek(start)
+        header = f.read(_headerlength.size)
+        if len(header) < _headerlength.size:
+            return None
+        metalength = _headerlength.unpack(header)[0]
+        try:
+            meta = json.loads(f.read(metalength).decode('utf-8'))
+            bodyend = start + _headerlength.size + metalength \
+                + sum(length for _, _, length in meta['patches'])
+        except (ValueError, TypeError, KeyError):
+            return None
+        if bodyend + _trailer.size > size:
+            return None
+        f.seek(bodyend)
+        length, magic = _trailer.unpack(f.read(_trailer.size))
+        if magic != _trailermagic or length != bodyend - start:
+            return None
+        return bodyend
+
+    def _all_bounds(self, f) -> List[Tuple[int, int]]:
+        """
+        Return where the body of every entry starts and ends, oldest first.
+        A torn entry at the end, from a crash while it was being added, is
+        left out.
+        """
+        bounds = []
+        size = f.seek(0, os.SEEK_END)
+        start = 0
+        while start < size:
+            bodyend = self._body_end(f, start, size)
+            if bodyend is None:
+                break
+            bounds.append((start, bodyend))
+            start = bodyend + _trailer.size
+        return bounds
+
+    @tracing.traced('undo_journal')
+    def record(self, patches: List[Patch], oldchecksum: str, newchecksum: str,
+               newsize: int, oldmtime: int, newmtime: int) -> int:
+        """
+        Add an entry. patches should turn the save as it is after the
+        transfer (with the size newsize and mtime newmtime in nanoseconds)
+        back into how it was before (with the mtime oldmtime), see
+        splice.reverse_patches.
+        newchecksum is the range_checksum of the save over the ranges in
+        patches, and oldchecksum that of the old save over the ranges that
+        were replaced. Return where the entry starts in the journal, for
+        truncate. Entries past the keep limit aren't dropped until prune is
+        called.
+        """
+        meta = {'time': datetime.now().isoformat(timespec='seconds'),
+                'oldchecksum': oldchecksum, 'newchecksum': newchecksum,
+                'newsize': newsize, 'oldmtime': oldmtime, 'newmtime': newmtime}
+        entry = _encode_entry(meta, patches)
+        with open(self.path, 'r+b' if os.path.isfile(self.path) else 'wb') as f:
+            # Write over a torn entry, if there is one
+            bounds = self._all_bounds(f)
+            start = bounds[-1][1] + _trailer.size if bounds else 0
+            f.seek(start)
+            f.truncate()
+            f.write(entry)
+            f.flush()
+            os.fsync(f.fileno())
+        return start
+
+    def truncate(self, start: int) -> None:
+        """ Drop every entry from start on, and the journal if that's all of them. """
+        with open(self.path, 'r+b') as f:
+            f.truncate(start)
+        if start == 0:
+            os.remove(self.path)
+
+    def prune(self) -> None:
+        """ Drop the oldest entries until there are no more than keep. """
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            bounds = self._all_bounds(f)
+            if len(bounds) <= self.keep:
+                return
+            if self.keep <= 0:
+                data = b''
+            else:
+                start = bounds[-self.keep][0]
+                f.seek(start)
+                data = f.read(bounds[-1][1] + _trailer.size - start)
+        temppath = self.path + '.tmp'
+        with open(temppath, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temppath, self.path)
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """ Return the metadata of every entry, oldest first. """
+        if not os.path.isfile(self.path):
+            return []
+        out = []
+        with open(self.path, 'rb') as f:
+            for start, end in self._all_bounds(f):
+                f.seek(start)
+                out.append(_decode_entry(f.read(end - start))[0])
+        return out
+
+    def latest(self) -> Optional[Tuple[Dict[str, Any], List[Patch], int]]:
+        """
+        Return the metadata and patches of the latest entry and where it
+        starts in the journal, or None if there are no entries.
+        """
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            bounds = self._all_bounds(f)
+            if not bounds:
+                return None
+            start, bodyend = bounds[-1]
+            f.seek(start)
+            meta, patches = _decode_entry(f.read(bodyend - start))
+        return meta, patches, start
+
+    def undo(self) -> Dict[str, Any]:
+        """
+        Undo the latest transfer and remove its entry. Refuse if the save
+        has been changed since then. Return the entry's metadata.
+        """
+        latest = self.latest()
+        if latest is None:
+            raise FaceTransferException('There is nothing to undo for {}'.format(self.fname))
+        meta, patches, start = latest
+        stat = os.stat(self.fname)
+        if stat.st_size != meta['newsize'] or stat.st_mtime_ns != meta['newmtime'] \
+                or range_checksum(self.fname, _ranges(patches)) != meta['newchecksum']:
+            raise FaceTransferException('The save has been changed since the '
+                                        'transfer and can\'t be restored')
+        # Where the restored bytes end up in the restored save
+        restoredranges = _ranges(reverse_patches(self.fname, patches))
+        tempfname = self.fname + '.facetmp'
+        try:
+            write_spliced(self.fname, tempfname, patches)
+            if range_checksum(tempfname, restoredranges) != meta['oldchecksum']:
+                raise FaceTransferException('The restored save doesn\'t match '
+                                            'the original')
+        except BaseException:
+            if os.path.isfile(tempfname):
+                os.remove(tempfname)
+            raise
+        os.replace(tempfname, self.fname)
+        # Put the old mtime back, so that the entry before this one matches
+        os.utime(self.fname, ns=(stat.st_atime_ns, meta['oldmtime']))
+        # Pop the entry off the stack
+        self.truncate(start)
+        return meta
+
+
+def patch_save(fname: str, patches: List[Patch], keep: int = KEEP) -> None:
+    """
+    Apply the patches to the save (see splice.write_spliced) and add an
+    entry to its undo journal. The new save is written next to the old one
+    and only replaces it once the entry is in the journal, so there's never
+    a transfer that can't be undone. If the save can't be replaced, the
+    entry is dropped again.
+    """
+    tempfname = fname + '.facetmp'
+    stat = os.stat(fname)
+    journal = UndoJournal(fname, keep)
+    try:
+        oldchecksum = range_checksum(fname, _ranges(patches))
+        newsize = write_spliced(fname, tempfname, patches)
+        undopatches = reverse_patches(fname, patches)
+        newchecksum = range_checksum(tempfname, _ranges(undopatches))
+        # os.replace keeps the mtime, so this is the mtime the save will have
+        newmtime = time.time_ns()
+        os.utime(tempfname, ns=(stat.st_atime_ns, newmtime))
+        start = journal.record(undopatches, oldchecksum, newchecksum,
+                               newsize, stat.st_mtime_ns, newmtime)
+        try:
+            os.replace(tempfname, fname)
+        except BaseException:
+            journal.truncate(start)
+            raise
+    except BaseException:
+        if os.path.isfile(tempfname):
+            os.remove(tempfname)
+        raise
+    journal.prune()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Undo face transfers')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='list the transfers that can be undone')
+    args = parser.parse_args()
+    for fname in args.files:
+        journal = UndoJournal(fname)
+        if args.list:
+            print(fname)
+            for n, meta in enumerate(reversed(journal.entries()), 1):
+                print('  {}. {}'.format(n, meta['time']))
+        else:
+            meta = journal.undo()
+            print('Undid the transfer from {} in {}'.format(meta['time'], fname))